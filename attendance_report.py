@@ -0,0 +1,198 @@
+"""
+Отчет после отметки посещения, собранный из одного снимка данных.
+
+Снимок берет занятия из индекса занятий, абонементы и прогноз из кеша сервиса
+таблиц и один раз раскладывает их по словарям: абонемент по ID, занятия по
+абонементу, строки прогноза по (ребенок, кружок). Дальше отчет собирается
+поиском по словарям без чтения листов, а готовый текст кешируется по
+(занятие, отметка, версия индекса занятий).
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from datetime import date
+
+from google_sheets_service import sheets_service
+from lesson_index import parse_lesson_date
+import config
+
+
+def _budget_value(budget):
+    """Бюджет строки прогноза как число (по правилам get_forecast_budget_for_child_circle)."""
+    if isinstance(budget, (int, float)):
+        return budget
+    if isinstance(budget, str) and budget.replace('.', '').isdigit():
+        return float(budget)
+    return 0
+
+
+class ReportSnapshot:
+    """Согласованный снимок данных для отчетов с индексами для поиска."""
+
+    def __init__(self, lesson_index, subscriptions, forecast_rows):
+        self.lesson_index = lesson_index
+        self.index_built_at = lesson_index.built_at
+        self.built_at = time.time()
+
+        self.subscriptions = {}
+        for sub in subscriptions:
+            sub_id = str(sub.get('ID абонемента', '')).strip()
+            if sub_id:
+                self.subscriptions.setdefault(sub_id, sub)
+
+        # Занятия по абонементу ссылаются на объекты индекса, поэтому
+        # оптимистичные отметки видны в снимке без перестроения
+        self.lessons_by_subscription = defaultdict(list)
+        for lesson in lesson_index.lessons():
+            sub_id = str(lesson.get('ID абонемента', '')).strip()
+            if sub_id:
+                self.lessons_by_subscription[sub_id].append(lesson)
+        for lessons in self.lessons_by_subscription.values():
+            lessons.sort(key=lambda lesson: parse_lesson_date(lesson.get('Дата занятия', '')) or date.min)
+
+        self.forecast = defaultdict(lambda: {'payment_dates': [], 'budget': 0})
+        for row in forecast_rows:
+            key = (str(row.get('Ребенок', '')).strip(), str(row.get('Кружок', '')).strip())
+            self.forecast[key]['payment_dates'].append(row.get('Дата оплаты', ''))
+            self.forecast[key]['budget'] += _budget_value(row.get('Бюджет', 0))
+
+    def is_fresh(self, max_age):
+        return (self.lesson_index.built_at == self.index_built_at
+                and time.time() - self.built_at <= max_age)
+
+    def subscription_details(self, subscription_id):
+        """Данные абонемента в формате get_subscription_details."""
+        sub = self.subscriptions.get(str(subscription_id).strip())
+        if not sub:
+            return None
+        return {
+            'child_name': sub.get('Ребенок', ''),
+            'circle_name': sub.get('Кружок', ''),
+            'total_classes': sub.get('К-во занятий', ''),
+            'attended_classes': sub.get('Прошло занятий', ''),
+            'remaining_classes': sub.get('Осталось занятий', ''),
+            'missed_classes': sub.get('Пропущено', ''),
+            'cost': sub.get('Стоимость', ''),
+        }
+
+    def forecast_for(self, child_name, circle_name):
+        """(даты оплат, суммарный бюджет или None) для ребенка и кружка."""
+        key = (str(child_name).strip(), str(circle_name).strip())
+        if key not in self.forecast:
+            return [], None
+        entry = self.forecast[key]
+        return entry['payment_dates'], (entry['budget'] if entry['budget'] > 0 else None)
+
+
+class AttendanceReportBuilder:
+    """Строит отчеты об отметке посещения по снимку данных и кеширует готовый текст."""
+
+    def __init__(self, max_age=None, cache_size=256):
+        self.max_age = max_age if max_age is not None else getattr(config, 'REPORT_SNAPSHOT_MAX_AGE', 120)
+        self.cache_size = cache_size
+        self._snapshot = None
+        self._rendered = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_snapshot(self):
+        """Возвращает актуальный снимок, перестраивая его после перестроения индекса или по возрасту."""
+        lesson_index = sheets_service.get_lesson_date_index()
+        with self._lock:
+            snapshot = self._snapshot
+        if snapshot is not None and snapshot.is_fresh(self.max_age):
+            return snapshot
+
+        started = time.monotonic()
+        snapshot = ReportSnapshot(
+            lesson_index,
+            sheets_service.get_subscriptions_data(),
+            sheets_service.get_forecast_records()
+        )
+        with self._lock:
+            self._snapshot = snapshot
+            self._rendered.clear()
+        logging.info(f"📸 Снимок данных для отчетов построен за {time.monotonic() - started:.2f} сек")
+        return snapshot
+
+    def build(self, lesson_id, attendance_mark):
+        """Текст отчета (Markdown) для занятия после отметки."""
+        snapshot = self.get_snapshot()
+        key = (str(lesson_id), attendance_mark, snapshot.lesson_index.version, snapshot.built_at)
+        with self._lock:
+            text = self._rendered.get(key)
+            if text is not None:
+                self._rendered.move_to_end(key)
+                return text
+
+        text = self.render(snapshot, lesson_id, attendance_mark)
+        with self._lock:
+            self._rendered[key] = text
+            while len(self._rendered) > self.cache_size:
+                self._rendered.popitem(last=False)
+        return text
+
+    def render(self, snapshot, lesson_id, attendance_mark):
+        lesson_info = snapshot.lesson_index.find(lesson_id)
+        if not lesson_info:
+            return f"✅ Отметка '*{attendance_mark}*' сохранена!\n\n🔄 Данные обновляются в фоне."
+
+        subscription_id = str(lesson_info.get('ID абонемента', '')).strip()
+        child_name = lesson_info.get('Ребенок', '')
+        lesson_date = lesson_info.get('Дата занятия', '')
+
+        sub_details = snapshot.subscription_details(subscription_id)
+        circle_name = sub_details.get('circle_name', 'Неизвестно') if sub_details else 'Неизвестно'
+        all_lessons = snapshot.lessons_by_subscription.get(subscription_id, [])
+        payment_dates, forecast_budget = snapshot.forecast_for(child_name, circle_name)
+
+        message = f"✅ *Отметка '{attendance_mark}' сохранена!*\n\n"
+        message += f"🎨 *Кружок:* {circle_name}\n"
+        message += f"👤 *Ребенок:* {child_name}\n"
+        message += f"📅 *Дата занятия:* {lesson_date}\n\n"
+
+        # Статистика по абонементу
+        if sub_details:
+            message += f"📊 *Статистика абонемента:*\n"
+            message += f"🆔 ID: {subscription_id}\n"
+            message += f"📚 Всего занятий: {sub_details.get('total_classes', 0)}\n"
+            message += f"✅ Прошло: {sub_details.get('attended_classes', 0)}\n"
+            message += f"⏳ Осталось: {sub_details.get('remaining_classes', 0)}\n"
+            message += f"❌ Пропущено: {sub_details.get('missed_classes', 0)}\n"
+            if sub_details.get('cost'):
+                message += f"💰 Стоимость: {sub_details['cost']} руб.\n\n"
+
+        # История отметок
+        if all_lessons:
+            message += f"📋 *История занятий:*\n"
+            for lesson in all_lessons[-5:]:  # Последние 5 занятий
+                mark = lesson.get('Отметка', '')
+                message += f"• {lesson.get('Дата занятия', '')}: {mark or lesson.get('Статус посещения', '')}\n"
+            message += "\n"
+
+        # Прогнозные даты оплат
+        if payment_dates:
+            message += f"💳 *Прогнозные даты оплат:*\n"
+            for payment_date in payment_dates[:3]:  # Первые 3 даты
+                message += f"• {payment_date}\n"
+            message += "\n"
+
+        # Прогнозируемый бюджет
+        if forecast_budget:
+            message += f"💰 *Прогнозируемый бюджет:* {forecast_budget} руб.\n\n"
+
+        message += "🔄 *Данные обновляются в фоне.*"
+        return message
+
+
+# Глобальный экземпляр построителя отчетов
+attendance_report_builder = None
+
+def get_attendance_report_builder() -> AttendanceReportBuilder:
+    """Получает глобальный построитель отчетов об отметках"""
+    global attendance_report_builder
+
+    if attendance_report_builder is None:
+        attendance_report_builder = AttendanceReportBuilder()
+
+    return attendance_report_builder
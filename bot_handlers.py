@@ -6,6 +6,12 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppI
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from google_sheets_service import GoogleSheetsService, sheets_service
 from google_calendar_service import GoogleCalendarService
+from mark_commit_queue import get_mark_commit_queue
+from job_scheduler import get_background_jobs, FULL_REFRESH_JOBS
+from keyboard_cache import keyboard_cache, content_digest
+from attendance_report import get_attendance_report_builder
+from message_registry import delete_tracked_messages
+from prefetch import get_prefetcher
 import pytz
 
 async def safe_answer_callback_query(query, text=None):
@@ -118,6 +124,14 @@ def create_calendar_keyboard(year, month, back_callback="menu_subscriptions"):
         month: Месяц для отображения (1-12)
         back_callback: callback_data для кнопки "Назад"
     """
+    # Содержимое зависит от сегодняшней даты (прошедшие дни скрыты) и кнопки "Назад"
+    digest = content_digest(datetime.now().date().isoformat(), back_callback)
+    return keyboard_cache.get_or_build(
+        'date_picker', year, month, digest,
+        lambda: _build_calendar_keyboard(year, month, back_callback)
+    )
+
+def _build_calendar_keyboard(year, month, back_callback):
     keyboard = []
     ru_months = ["Янв", "Фев", "Мар", "Апр", "Май", "Июн", "Июл", "Авг", "Сен", "Окт", "Ноя", "Дек"]
     
@@ -165,6 +179,13 @@ def create_calendar_keyboard(year, month, back_callback="menu_subscriptions"):
     return InlineKeyboardMarkup(keyboard)
 
 def create_time_keyboard(prefix, hour_range=range(8, 22), minute_step=15):
+    digest = content_digest(prefix, list(hour_range), minute_step)
+    return keyboard_cache.get_or_build(
+        'time', None, None, digest,
+        lambda: _build_time_keyboard(prefix, hour_range, minute_step)
+    )
+
+def _build_time_keyboard(prefix, hour_range, minute_step):
     keyboard = []
     if minute_step == 60: 
         row = []
@@ -202,29 +223,16 @@ async def _display_settings_category_list(update: Update, context: ContextTypes.
         await sender_func(chat_id=update.effective_chat.id, text=message_text, reply_markup=reply_markup)
     return SHOW_CATEGORY_ITEMS
 # === Основное Меню ===
-async def clear_chat_history(context, chat_id, max_messages=50):
-    """Очищает историю чата, удаляя последние сообщения."""
+async def clear_chat_history(context, chat_id, exclude=()):
+    """Очищает историю чата: удаляет сообщения, записанные в реестр сообщений бота."""
     try:
         logging.info(f"🧹 Начинаю очистку чата {chat_id}")
-        deleted_count = 0
-        
-        # Получаем ID последних сообщений и удаляем их
-        for i in range(max_messages):
-            try:
-                # Пытаемся удалить сообщения, начиная с текущего ID и идя назад
-                # Telegram не позволяет получить список сообщений, поэтому пробуем удалить по ID
-                message_id = context.bot_data.get('last_message_id', 1000) - i
-                if message_id > 0:
-                    await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-                    deleted_count += 1
-            except Exception:
-                # Если сообщение не найдено или не может быть удалено, продолжаем
-                continue
+        deleted_count = await delete_tracked_messages(context.bot, chat_id, exclude=exclude)
         
         if deleted_count > 0:
             logging.info(f"🧹 Удалено {deleted_count} сообщений из чата")
         else:
-            logging.info("🧹 Нет сообщений для удаления или недостаточно прав")
+            logging.info("🧹 Нет сообщений для удаления")
             
     except Exception as e:
         logging.warning(f"⚠️ Не удалось полностью очистить чат: {e}")
@@ -246,46 +254,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             # Удаляем команду /start
             await update.message.delete()
             
-            # Пытаемся очистить чат (удаляем старые сообщения)
-            chat_id = update.effective_chat.id
-            deleted_count = 0
-            start_message_id = update.message.message_id
-            
-            # Удаляем сообщения в ОБЕ СТОРОНЫ от команды /start
-            # Telegram позволяет удалять сообщения только за последние 48 часов
-            # Пробуем удалить до 150 сообщений (75 назад + 75 вперед)
-            
-            # 1. Удаляем сообщения НАЗАД (старые сообщения)
-            for i in range(1, 76):
-                try:
-                    message_id_to_delete = start_message_id - i
-                    if message_id_to_delete > 0:
-                        # Не удаляем сообщение загрузки
-                        if loading_message and message_id_to_delete == loading_message.message_id:
-                            continue
-                        await context.bot.delete_message(chat_id=chat_id, message_id=message_id_to_delete)
-                        deleted_count += 1
-                except Exception:
-                    # Если сообщение не найдено или не может быть удалено, продолжаем
-                    continue
-            
-            # 2. Удаляем сообщения ВПЕРЕД (если были после команды /start)
-            for i in range(1, 76):
-                try:
-                    message_id_to_delete = start_message_id + i
-                    # Не удаляем сообщение загрузки
-                    if loading_message and message_id_to_delete == loading_message.message_id:
-                        continue
-                    await context.bot.delete_message(chat_id=chat_id, message_id=message_id_to_delete)
-                    deleted_count += 1
-                except Exception:
-                    # Если сообщение не найдено, прекращаем (дошли до конца)
-                    break
-            
-            if deleted_count > 0:
-                logging.info(f"🧹 Очищен чат: удалено {deleted_count} сообщений")
-            else:
-                logging.info(f"🧹 Нет сообщений для удаления (возможно бот не имеет прав или все сообщения старше 48 часов)")
+            # Очищаем чат: удаляем известные боту сообщения, кроме сообщения загрузки
+            await clear_chat_history(context, update.effective_chat.id, exclude=[loading_message.message_id])
             
         except Exception as e:
             logging.warning(f"⚠️ Не удалось полностью очистить чат: {e}")
@@ -471,10 +441,12 @@ async def sync_google_calendar_handler(update: Update, context: ContextTypes.DEF
         logging.info("📞 Вызываю функцию синхронизации...")
         
         # Показываем промежуточное сообщение
-        await query.edit_message_text("🔄 **Синхронизация Google Calendar**\n\n📊 Читаю данные из таблицы...", parse_mode='Markdown')
+        await query.edit_message_text("🔄 **Синхронизация Google Calendar**\n\n📊 Жду очереди фоновых задач и читаю данные из таблицы...", parse_mode='Markdown')
         
-        # Запускаем синхронизацию
-        result = sheets_service.sync_calendar_with_google_calendar()
+        # Ручной запуск - полная синхронизация по всем датам; через планировщик,
+        # чтобы не пересекаться с фоновой синхронизацией календаря
+        result = await get_background_jobs().run('calendar_deep_sync', reason='ручная синхронизация календаря',
+                                                 immediate=True)
         logging.info(f"✅ Синхронизация завершена, результат: {result[:100]}...")
         
         # Показываем результат с уведомлением
@@ -710,9 +682,9 @@ async def force_refresh_all_data(update: Update, context: ContextTypes.DEFAULT_T
         # Сразу показываем сообщение об успехе и запускаем фоновое обновление
         await query.edit_message_text("✅ <b>Обновление данных запущено!</b>\n\n🔄 Загружаю актуальную статистику...", parse_mode='HTML')
         
-        # Запускаем фоновое обновление (без ожидания)
+        # Запрашиваем фоновое обновление (без ожидания)
         import asyncio
-        asyncio.create_task(update_data_in_background())
+        schedule_data_refresh("обновление данных из меню")
         
         # Небольшая задержка и показываем главное меню БЕЗ вызова start (чтобы избежать двойного callback)
         await asyncio.sleep(1)
@@ -790,55 +762,65 @@ async def force_refresh_all_data(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text('👋 Главное меню. Выберите действие:', reply_markup=reply_markup)
         return MAIN_MENU
 
-async def update_data_in_background():
-    """Обновляет данные в фоновом режиме без блокировки интерфейса."""
+async def on_attendance_mark_committed(job):
+    """После фоновой записи отметки запрашивает обновление прогноза и Google Calendar."""
+    schedule_data_refresh("отметка посещения")
+
+def schedule_data_refresh(reason):
+    """Запрашивает фоновое обновление прогноза, синхронизацию Google Calendar и очистку дублей.
+
+    Запросы склеиваются планировщиком: серия быстрых изменений дает одно обновление.
+    """
     try:
-        logging.info("🔄 Начинаю фоновое обновление всех данных...")
-        
-        # 1. УБРАНО: update_subscriptions_statistics() - теперь обновляем только конкретный абонемент
-        # через update_subscription_stats() в select_attendance_mark()
-        logging.info("📊 Пропускаю массовое обновление статистики абонементов (обновляется индивидуально)")
-        
-        # 2. Обновляем прогноз бюджета
-        await asyncio.sleep(15)  # Увеличенная задержка для снижения нагрузки на API
-        logging.info("💰 Обновляю прогноз бюджета...")
-        forecast_count, forecast_errors = sheets_service.update_full_forecast()
-        logging.info(f"✅ Создано прогнозов: {forecast_count}")
-        
-        # 3. Синхронизируем с Google Calendar (фоновая синхронизация)
-        await asyncio.sleep(10)  # Увеличенная задержка для снижения нагрузки на API
-        logging.info("🔄 Синхронизирую с Google Calendar...")
-        try:
-            calendar_result = sheets_service.sync_calendar_with_google_calendar()
-            logging.info(f"✅ Синхронизация календаря: {calendar_result[:100]}...")
-        except Exception as e:
-            logging.error(f"❌ Ошибка при синхронизации календаря: {e}")
-        
-        # 4. Синхронизируем прогноз с Google Calendar (фоновая синхронизация)
-        await asyncio.sleep(10)  # Увеличенная задержка для снижения нагрузки на API
-        logging.info("💰 Синхронизирую прогноз с Google Calendar...")
-        try:
-            forecast_result = sheets_service.sync_forecast_with_google_calendar()
-            logging.info(f"✅ Синхронизация прогноза: {forecast_result[:100]}...")
-        except Exception as e:
-            logging.error(f"❌ Ошибка при синхронизации прогноза: {e}")
-        
-        # 5. Очищаем дубли в Google Calendar (фоновая очистка)
-        await asyncio.sleep(15)  # Увеличенная задержка для снижения нагрузки на API
-        logging.info("🧹 Очищаю дубли в Google Calendar...")
+        get_background_jobs().request(*FULL_REFRESH_JOBS, reason=reason)
+    except Exception as e:
+        logging.error(f"❌ Ошибка при постановке фонового обновления: {e}")
+
+async def background_jobs_status_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Показывает состояние фоновых задач и позволяет отменить ожидающие."""
+    query = update.callback_query
+    
+    background_jobs = get_background_jobs()
+    if query.data == 'background_jobs_cancel':
+        cancelled = background_jobs.cancel()
+        await query.answer(f"⏹️ Отменено задач: {len(cancelled)}")
+    else:
+        await query.answer()
+    
+    keyboard = [
+        [InlineKeyboardButton("🔄 Обновить", callback_data="background_jobs_status")],
+        [InlineKeyboardButton("⏹️ Отменить ожидающие", callback_data="background_jobs_cancel")],
+        [InlineKeyboardButton("⏪ Назад в настройки", callback_data="menu_settings")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    status_text = background_jobs.format_status()
+    # Очередь отправки в Telegram (есть, если бот запущен через bot_main)
+    send_queue = context.bot.rate_limiter
+    if hasattr(send_queue, 'format_status'):
+        status_text += "\n\n" + send_queue.format_status()
+    try:
+        await query.edit_message_text(status_text, reply_markup=reply_markup, parse_mode='HTML')
+    except Exception as e:
+        # "Message is not modified" при повторном нажатии "Обновить"
+        logging.debug(f"Состояние фоновых задач не изменилось: {e}")
+    return SETTINGS_MENU
+
+async def periodic_deep_calendar_sync():
+    """Периодически выполняет полную синхронизацию календаря (фоновая идет только в окне дат)."""
+    import config
+    interval_hours = getattr(config, 'CALENDAR_DEEP_SYNC_INTERVAL_HOURS', 24)
+    if not interval_hours or interval_hours <= 0:
+        logging.info("ℹ️ Периодическая глубокая синхронизация календаря отключена")
+        return
+    
+    while True:
+        await asyncio.sleep(interval_hours * 3600)
+        logging.info("🗂 Запускаю периодическую глубокую синхронизацию Google Calendar...")
         try:
-            clean_result = sheets_service.clean_duplicate_events()
-            logging.info(f"✅ Очистка дублей: {clean_result[:100]}...")
-        except AttributeError as attr_error:
-            logging.warning(f"⚠️ Функция очистки дублей не найдена: {attr_error}")
-            logging.info("ℹ️ Пропускаю очистку дублей - функция не реализована")
+            result = await get_background_jobs().run('calendar_deep_sync', reason='периодическая глубокая синхронизация')
+            logging.info(f"✅ Глубокая синхронизация календаря: {result[:100]}...")
         except Exception as e:
-            logging.error(f"❌ Ошибка при очистке дублей: {e}")
-        
-        logging.info("🎉 Фоновое обновление всех данных завершено!")
-        
-    except Exception as e:
-        logging.error(f"❌ Ошибка при фоновом обновлении данных: {e}")
+            logging.error(f"❌ Ошибка при глубокой синхронизации календаря: {e}")
 
 async def update_stats_menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик кнопки 'Обновить статистику'."""
@@ -1542,8 +1524,8 @@ async def renewal_create_handler(update: Update, context: ContextTypes.DEFAULT_T
                     break  # Не повторяем для других ошибок
         
         if "✅" in result:
-            # Запускаем фоновые обновления
-            asyncio.create_task(update_after_subscription_creation())
+            # Запрашиваем фоновые обновления
+            schedule_data_refresh("продление абонемента")
             
             success_message = f"🎉 <b>Абонемент успешно продлен!</b>\n\n"
             success_message += f"👤 <b>Ребенок:</b> {child_name}\n"
@@ -1737,8 +1719,19 @@ async def mark_single_payment_paid_handler(update: Update, context: ContextTypes
     return MAIN_MENU
 
 # === Меню Календаря ===
-def generate_calendar_keyboard(year, month, lessons_by_date):
-    """Генерирует клавиатуру календаря с отметками занятий."""
+def generate_calendar_keyboard(year, month, day_counts):
+    """Генерирует клавиатуру календаря с отметками занятий (InlineKeyboardMarkup из кеша клавиатур).
+
+    day_counts - день -> Counter статусов занятий (LessonDateIndex.month_counts).
+    """
+    # Кнопки зависят только от того, в какие дни есть запланированные занятия
+    planned_days = sorted(day for day, counts in day_counts.items() if counts.get('запланировано', 0) > 0)
+    return keyboard_cache.get_or_build(
+        'lessons_month', year, month, content_digest(planned_days),
+        lambda: InlineKeyboardMarkup(_build_lessons_calendar_keyboard(year, month, set(planned_days)))
+    )
+
+def _build_lessons_calendar_keyboard(year, month, planned_days):
     import calendar
     from datetime import datetime, date
     
@@ -1777,16 +1770,8 @@ def generate_calendar_keyboard(year, month, lessons_by_date):
             else:
                 # Проверяем, есть ли ЗАПЛАНИРОВАННЫЕ занятия в этот день
                 date_str = f"{day:02d}.{month:02d}.{year}"
-                lessons_on_date = lessons_by_date.get(date_str, [])
-                
-                # Считаем только занятия со статусом "Запланировано"
-                planned_lessons_count = 0
-                for lesson in lessons_on_date:
-                    status = lesson.get('Статус посещения', '').lower()
-                    if status == 'запланировано':
-                        planned_lessons_count += 1
                 
-                if planned_lessons_count > 0:
+                if day in planned_days:
                     # Есть запланированные занятия - добавляем индикатор
                     button_text = f"{day}🔸"
                     callback_data = f"calendar_date_{date_str}"
@@ -1826,10 +1811,10 @@ async def calendar_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         
         logging.info("🔄 Загрузка календаря занятий...")
         
-        # Получаем все занятия из календаря с обработкой ошибок
+        # Индекс занятий по датам (лист читается, только если индекс не построен или устарел)
         try:
-            lessons = sheets_service.get_calendar_lessons()
-            logging.info(f"✅ Загружено занятий из календаря: {len(lessons) if lessons else 0}")
+            lesson_index = await asyncio.to_thread(sheets_service.get_lesson_date_index)
+            logging.info(f"✅ Занятий в индексе календаря: {lesson_index.total_lessons()}")
         except Exception as e:
             logging.error(f"❌ Ошибка при загрузке календаря: {e}")
             error_text = "❌ Ошибка при загрузке календаря"
@@ -1846,76 +1831,22 @@ async def calendar_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
             await query.edit_message_text(error_text, reply_markup=reply_markup)
             return MAIN_MENU
         
-        if not lessons:
+        if not lesson_index.total_lessons():
             keyboard = [[InlineKeyboardButton("⏪ Назад в главное меню", callback_data="main_menu")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text("📅 Календарь занятий пуст.\n\nСначала создайте абонементы.", reply_markup=reply_markup)
             return MAIN_MENU
         
-        # Группируем занятия по датам, показываем ВСЕ занятия
-        lessons_by_date = {}
-        valid_lessons_count = 0
-        ninja_lessons_found = 0
-        
-        for lesson in lessons:
-            date_str = lesson.get('Дата занятия', '')
-            subscription_id = lesson.get('ID абонемента', '')
-            
-            # ОТЛАДКА: Логируем занятия "Ниндзя"
-            if 'Ниндзя' in subscription_id or 'ниндзя' in subscription_id.lower():
-                ninja_lessons_found += 1
-                logging.info(f"🥷 Найдено занятие Ниндзя: Дата='{date_str}', ID='{subscription_id}', Статус='{lesson.get('Статус посещения', '')}'")
-            
-            # Показываем все занятия с валидными датами
-            if date_str and date_str.strip():
-                # Нормализуем формат даты: 8.11.2025 -> 08.11.2025
-                try:
-                    parts = date_str.split('.')
-                    if len(parts) == 3:
-                        day = parts[0].zfill(2)  # Добавляем ведущий ноль
-                        month = parts[1].zfill(2)  # Добавляем ведущий ноль
-                        year = parts[2]
-                        normalized_date = f"{day}.{month}.{year}"
-                    else:
-                        normalized_date = date_str
-                except:
-                    normalized_date = date_str
-                
-                if normalized_date not in lessons_by_date:
-                    lessons_by_date[normalized_date] = []
-                lessons_by_date[normalized_date].append(lesson)
-                valid_lessons_count += 1
-        
-        logging.info(f"🥷 Всего занятий Ниндзя: {ninja_lessons_found}")
-        
-        # Логирование для отладки
-        logging.info(f"📊 Валидных занятий с датами: {valid_lessons_count}")
-        logging.info(f"📅 Сгруппировано по датам: {len(lessons_by_date)} дат")
-        
-        if not lessons_by_date:
-            keyboard = [[InlineKeyboardButton("⏪ Назад в главное меню", callback_data="main_menu")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text("📅 Календарь занятий пуст или данные некорректны.\n\nПопробуйте создать абонементы или обновить данные.", reply_markup=reply_markup)
-            return MAIN_MENU
-        
-        if lessons_by_date:
-            logging.info(f"Первые 5 дат: {list(lessons_by_date.keys())[:5]}")
-            first_date = list(lessons_by_date.keys())[0]
-            logging.info(f"Занятий на {first_date}: {len(lessons_by_date[first_date])}")
-        
         # Определяем текущий месяц и год
         today = datetime.now()
         year = context.user_data.get('calendar_year', today.year)
         month = context.user_data.get('calendar_month', today.month)
         
-        # Сохраняем данные в контексте
-        context.user_data['lessons_by_date'] = lessons_by_date
         context.user_data['calendar_year'] = year
         context.user_data['calendar_month'] = month
         
         # Генерируем клавиатуру календаря
-        keyboard = generate_calendar_keyboard(year, month, lessons_by_date)
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        reply_markup = generate_calendar_keyboard(year, month, lesson_index.month_counts(year, month))
         
         message_text = "📅 *Интерактивный календарь занятий*\n\n"
         message_text += "• Дни с занятиями отмечены символом 🔸\n"
@@ -1946,10 +1877,9 @@ async def today_lessons_handler(update: Update, context: ContextTypes.DEFAULT_TY
         today = datetime.now()
         date_str = today.strftime('%d.%m.%Y')
         
-        # Получаем все занятия из календаря
+        # Занятия на сегодня из индекса занятий по датам
         try:
-            lessons = sheets_service.get_calendar_lessons()
-            logging.info(f"✅ Загружено занятий из календаря: {len(lessons) if lessons else 0}")
+            lesson_index = await asyncio.to_thread(sheets_service.get_lesson_date_index)
         except Exception as e:
             logging.error(f"❌ Ошибка при загрузке календаря: {e}")
             error_text = "❌ Ошибка при загрузке занятий"
@@ -1966,27 +1896,14 @@ async def today_lessons_handler(update: Update, context: ContextTypes.DEFAULT_TY
             await query.edit_message_text(error_text, reply_markup=reply_markup)
             return MAIN_MENU
         
-        if not lessons:
+        if not lesson_index.total_lessons():
             keyboard = [[InlineKeyboardButton("⏪ Назад в главное меню", callback_data="main_menu")]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await query.edit_message_text("📅 Календарь занятий пуст.\n\nСначала создайте абонементы.", reply_markup=reply_markup)
             return MAIN_MENU
         
-        # Группируем занятия по датам
-        lessons_by_date = {}
-        for lesson in lessons:
-            lesson_date = lesson.get('Дата занятия', '')
-            if lesson_date and lesson_date.strip():
-                if lesson_date not in lessons_by_date:
-                    lessons_by_date[lesson_date] = []
-                lessons_by_date[lesson_date].append(lesson)
-        
-        # Сохраняем в контекст для дальнейшего использования
-        context.user_data['lessons_by_date'] = lessons_by_date
         context.user_data['selected_date'] = date_str
-        
-        # Получаем занятия на сегодня
-        lessons_on_date = lessons_by_date.get(date_str, [])
+        lessons_on_date = lesson_index.day(date_str)
         
         logging.info(f"📅 Сегодня: {date_str}, занятий: {len(lessons_on_date)}")
         
@@ -2019,7 +1936,7 @@ async def today_lessons_handler(update: Update, context: ContextTypes.DEFAULT_TY
             logging.info(f"Занятие {i+1}: lesson_id='{lesson_id}', child_name='{child_name}', subscription_id='{subscription_id}'")
             
             # Получаем детальную информацию об абонементе
-            sub_details = sheets_service.get_subscription_details(subscription_id)
+            sub_details = sheets_service.get_subscription_details(subscription_id, use_cache=True)
             circle_name = sub_details.get('circle_name', 'Неизвестно') if sub_details else 'Неизвестно'
             
             # Формируем детальный текст занятия
@@ -2072,6 +1989,8 @@ async def today_lessons_handler(update: Update, context: ContextTypes.DEFAULT_TY
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+        # Пока выбирают занятие, загружаем статусы посещения для следующего экрана
+        get_prefetcher(sheets_service).schedule('calendar_date')
         return SELECT_LESSON_FROM_DATE
         
     except Exception as e:
@@ -2112,13 +2031,13 @@ async def calendar_navigation_handler(update: Update, context: ContextTypes.DEFA
             context.user_data['calendar_year'] = year
             context.user_data['calendar_month'] = month
         
-        # Перегенерируем календарь
-        lessons_by_date = context.user_data.get('lessons_by_date', {})
+        # Перегенерируем календарь из индекса занятий (без обращения к таблице)
         year = context.user_data['calendar_year']
         month = context.user_data['calendar_month']
         
-        keyboard = generate_calendar_keyboard(year, month, lessons_by_date)
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # Индекс перестраивается, если пуст (перезапуск, invalidate) или устарел
+        lesson_index = await asyncio.to_thread(sheets_service.get_lesson_date_index)
+        reply_markup = generate_calendar_keyboard(year, month, lesson_index.month_counts(year, month))
         
         message_text = "📅 *Интерактивный календарь занятий*\n\n"
         message_text += "• Дни с занятиями отмечены символом 🔸\n"
@@ -2144,17 +2063,13 @@ async def select_calendar_date(update: Update, context: ContextTypes.DEFAULT_TYP
         date_str = query.data.replace("calendar_date_", "")
         context.user_data['selected_date'] = date_str
         
-        # Получаем занятия на эту дату
-        lessons_by_date = context.user_data.get('lessons_by_date', {})
-        lessons_on_date = lessons_by_date.get(date_str, [])
+        # Получаем занятия на эту дату из индекса занятий (перестраивается, если пуст или устарел)
+        lesson_index = await asyncio.to_thread(sheets_service.get_lesson_date_index)
+        lessons_on_date = lesson_index.day(date_str)
         
         # Логирование для отладки
         import logging
-        logging.info(f"Выбрана дата: {date_str}")
-        logging.info(f"Всего дат в lessons_by_date: {len(lessons_by_date)}")
-        logging.info(f"Занятий на дату {date_str}: {len(lessons_on_date)}")
-        if lessons_by_date:
-            logging.info(f"Доступные даты: {list(lessons_by_date.keys())[:5]}")  # Первые 5 дат
+        logging.info(f"Выбрана дата: {date_str}, занятий: {len(lessons_on_date)}")
         
         if not lessons_on_date:
             keyboard = [[InlineKeyboardButton("⏪ Назад к календарю", callback_data="menu_calendar")]]
@@ -2186,7 +2101,7 @@ async def select_calendar_date(update: Update, context: ContextTypes.DEFAULT_TYP
             logging.info(f"Занятие {i+1}: lesson_id='{lesson_id}', child_name='{child_name}', subscription_id='{subscription_id}'")
             
             # Получаем детальную информацию об абонементе
-            sub_details = sheets_service.get_subscription_details(subscription_id)
+            sub_details = sheets_service.get_subscription_details(subscription_id, use_cache=True)
             circle_name = sub_details.get('circle_name', 'Неизвестно') if sub_details else 'Неизвестно'
             
             # Формируем детальный текст занятия
@@ -2238,6 +2153,8 @@ async def select_calendar_date(update: Update, context: ContextTypes.DEFAULT_TYP
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+        # Пока выбирают занятие, загружаем статусы посещения для следующего экрана
+        get_prefetcher(sheets_service).schedule('calendar_date')
         return SELECT_LESSON_FROM_DATE
         
     except Exception as e:
@@ -2265,9 +2182,9 @@ async def select_lesson_from_date(update: Update, context: ContextTypes.DEFAULT_
         logging.info(f"Полный контекст: {context.user_data}")
         
         # Получаем информацию о занятии для использования в кнопках
-        lessons_by_date = context.user_data.get('lessons_by_date', {})
         selected_date = context.user_data.get('selected_date', '')
-        lessons_on_date = lessons_by_date.get(selected_date, [])
+        lesson_index = await asyncio.to_thread(sheets_service.get_lesson_date_index)
+        lessons_on_date = lesson_index.day(selected_date)
         
         # Находим текущее занятие
         current_lesson = None
@@ -2336,7 +2253,7 @@ async def select_lesson_from_date(update: Update, context: ContextTypes.DEFAULT_
             end_time = current_lesson.get('Время завершения', '')
             
             # Получаем название кружка
-            sub_details = sheets_service.get_subscription_details(subscription_id)
+            sub_details = sheets_service.get_subscription_details(subscription_id, use_cache=True)
             circle_name = sub_details.get('circle_name', 'Неизвестно') if sub_details else 'Неизвестно'
             
             message_text += f"👤 *Ребенок:* {child_name}\n"
@@ -2352,6 +2269,8 @@ async def select_lesson_from_date(update: Update, context: ContextTypes.DEFAULT_
         message_text += "\nВыберите статус посещения:"
         
         await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+        # Пока выбирают отметку, обновляем данные для сохранения и отчета
+        get_prefetcher(sheets_service).schedule('lesson_from_date')
         return SELECT_ATTENDANCE_MARK
         
     except Exception as e:
@@ -2603,6 +2522,43 @@ async def sync_razoviy_lesson_with_calendar(subscription_id):
     except Exception as e:
         logging.error(f"❌ Ошибка при синхронизации разового занятия: {e}")
 
+async def submit_mark_fast(lesson_id, attendance_mark, chat_id=None, retry_callback=None, sync_fallback=False):
+    """Быстрый путь отметки: отметка сразу применяется к данным в памяти, запись в таблицу идет в фоне.
+
+    Возвращает занятие, если отметка принята, или None - тогда нужен обычный
+    синхронный путь (очередь не запущена, занятие не найдено, разовый абонемент
+    требует выбора переноса). sync_fallback=True - без очереди отметка
+    записывается сразу (ошибка записи - RuntimeError).
+    """
+    commit_queue = get_mark_commit_queue()
+    if not commit_queue and not sync_fallback:
+        return None
+    lesson = await asyncio.to_thread(sheets_service.find_lesson_in_memory, lesson_id)
+    if not lesson or await asyncio.to_thread(sheets_service.needs_transfer_choice, lesson, attendance_mark):
+        return None
+    if not commit_queue:
+        # Очередь не запущена - записываем синхронно, как это сделала бы очередь
+        result = await asyncio.to_thread(sheets_service.update_lesson_mark, lesson_id, attendance_mark)
+        if not result:
+            raise RuntimeError("update_lesson_mark вернул ошибку")
+        subscription_id = result.get('subscription_id') if isinstance(result, dict) else None
+        if subscription_id:
+            await asyncio.to_thread(sheets_service.update_subscription_stats, subscription_id)
+        sheets_service.apply_lesson_mark_in_memory(lesson, attendance_mark)
+        return lesson
+    # Прежние значения нужны очереди, чтобы откатить отметку, если запись не удастся
+    previous_mark = lesson.get('Отметка', '')
+    previous_status = lesson.get('Статус посещения', '')
+    sheets_service.apply_lesson_mark_in_memory(lesson, attendance_mark)
+    await commit_queue.submit(
+        lesson_id, attendance_mark,
+        chat_id=chat_id,
+        retry_callback=retry_callback or f"lesson_mark_{lesson_id}",
+        previous_mark=previous_mark,
+        previous_status=previous_status
+    )
+    return lesson
+
 async def save_attendance_mark(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Сохраняет отметку посещения и запускает обновления."""
     query = update.callback_query
@@ -2654,6 +2610,27 @@ async def save_attendance_mark(update: Update, context: ContextTypes.DEFAULT_TYP
             logging.info("🔚 ЗАВЕРШЕНИЕ: Возврат к MAIN_MENU")
             return MAIN_MENU
         
+        # Оптимистичная отметка: подтверждаем по загруженным данным, запись в таблицу идет в фоне
+        if await submit_mark_fast(lesson_id, attendance_mark, chat_id=query.message.chat_id):
+            success_text = f"✅ <b>Отметка сохранена!</b>\n\n"
+            success_text += f"📝 <b>Отметка:</b> {attendance_mark}\n"
+            success_text += f"📊 <b>Статус:</b> Таблица и статистика обновятся в фоне\n\n"
+            success_text += "🔄 Возвращаюсь к календарю..."
+            await query.edit_message_text(success_text, parse_mode='HTML')
+            
+            # Отчет по абонементу отдельным сообщением: исходное сейчас займет календарь
+            report = await generate_attendance_report(lesson_id, attendance_mark)
+            try:
+                await query.message.reply_text(report, parse_mode='Markdown')
+            except Exception as report_error:
+                logging.warning(f"⚠️ Не удалось отправить отчет с разметкой, отправляю без нее: {report_error}")
+                await query.message.reply_text(report.replace('*', ''))
+            
+            await asyncio.sleep(1.5)
+            logging.info("✅ Отметка подтверждена, запись поставлена в очередь")
+            logging.info("=" * 80)
+            return await calendar_menu(update, context)
+        
         # Сразу показываем процесс обновления БЕЗ query.answer() чтобы избежать timeout
         logging.info("🔄 Начинаю обработку отметки без answer для избежания timeout")
         
@@ -2745,8 +2722,8 @@ async def save_attendance_mark(update: Update, context: ContextTypes.DEFAULT_TYP
         # Запускаем фоновое обновление БЕЗ ОЖИДАНИЯ
         try:
             import asyncio
-            asyncio.create_task(update_data_in_background())
-            logging.info("🚀 Фоновое обновление запущено асинхронно")
+            schedule_data_refresh("отметка посещения")
+            logging.info("🚀 Фоновое обновление запрошено")
             
             # Ждем 3 секунды
             await asyncio.sleep(3)
@@ -2830,129 +2807,22 @@ async def save_attendance_mark(update: Update, context: ContextTypes.DEFAULT_TYP
         
         return MAIN_MENU
 
-# Старая функция удалена - теперь используем update_data_in_background() для полного обновления
+# Старая функция удалена - теперь используем schedule_data_refresh() для полного обновления
 
 async def generate_attendance_report(lesson_id: str, attendance_mark: str) -> str:
-    """Генерирует детальный отчет после сохранения отметки посещения."""
+    """Генерирует детальный отчет после сохранения отметки посещения.
+
+    Отчет строится по снимку данных (см. attendance_report) и кешируется,
+    поэтому при прогретых данных листы не читаются.
+    """
     try:
-        import logging
         logging.info(f"Генерирую отчет для занятия {lesson_id} с отметкой '{attendance_mark}'")
-        
-        # Получаем информацию о занятии
-        lesson_info = sheets_service.get_lesson_info_by_id(lesson_id)
-        if not lesson_info:
-            return f"✅ Отметка '*{attendance_mark}*' сохранена!\n\n🔄 Данные обновляются в фоне."
-        
-        subscription_id = lesson_info.get('ID абонемента', '')
-        child_name = lesson_info.get('Ребенок', '')
-        lesson_date = lesson_info.get('Дата занятия', '')
-        
-        # Получаем детальную информацию об абонементе
-        sub_details = sheets_service.get_subscription_details(subscription_id)
-        circle_name = sub_details.get('circle_name', 'Неизвестно') if sub_details else 'Неизвестно'
-        
-        # Получаем все занятия по этому абонементу с отметками
-        all_lessons = sheets_service.get_lessons_by_subscription_with_marks(subscription_id)
-        
-        # Получаем прогнозные даты оплат
-        payment_dates = sheets_service.get_forecast_payment_dates(child_name, circle_name)
-        
-        # Получаем прогнозируемый бюджет
-        forecast_budget = sheets_service.get_forecast_budget_for_child_circle(child_name, circle_name)
-        
-        # Формируем отчет
-        message = f"✅ *Отметка '{attendance_mark}' сохранена!*\n\n"
-        message += f"🎨 *Кружок:* {circle_name}\n"
-        message += f"👤 *Ребенок:* {child_name}\n"
-        message += f"📅 *Дата занятия:* {lesson_date}\n\n"
-        
-        # Статистика по абонементу
-        if sub_details:
-            message += f"📊 *Статистика абонемента:*\n"
-            message += f"🆔 ID: {subscription_id}\n"
-            message += f"📚 Всего занятий: {sub_details.get('total_classes', 0)}\n"
-            message += f"✅ Прошло: {sub_details.get('attended_classes', 0)}\n"
-            message += f"⏳ Осталось: {sub_details.get('remaining_classes', 0)}\n"
-            message += f"❌ Пропущено: {sub_details.get('missed_classes', 0)}\n"
-            if sub_details.get('cost'):
-                message += f"💰 Стоимость: {sub_details['cost']} руб.\n\n"
-        
-        # История отметок
-        if all_lessons:
-            message += f"📋 *История занятий:*\n"
-            for lesson in all_lessons[-5:]:  # Последние 5 занятий
-                date = lesson.get('Дата занятия', '')
-                mark = lesson.get('Отметка', '')
-                status = lesson.get('Статус посещения', '')
-                if mark:
-                    message += f"• {date}: {mark}\n"
-                else:
-                    message += f"• {date}: {status}\n"
-            message += "\n"
-        
-        # Прогнозные даты оплат
-        if payment_dates:
-            message += f"💳 *Прогнозные даты оплат:*\n"
-            for date in payment_dates[:3]:  # Первые 3 даты
-                message += f"• {date}\n"
-            message += "\n"
-        
-        # Прогнозируемый бюджет
-        if forecast_budget:
-            message += f"💰 *Прогнозируемый бюджет:* {forecast_budget} руб.\n\n"
-        
-        message += "🔄 *Данные обновляются в фоне.*"
-        
-        return message
+        return await asyncio.to_thread(get_attendance_report_builder().build, lesson_id, attendance_mark)
         
     except Exception as e:
         logging.error(f"Ошибка при генерации отчета: {e}")
         return f"✅ Отметка '*{attendance_mark}*' сохранена!\n\n🔄 Данные обновляются в фоне."
 
-async def update_after_subscription_creation():
-    """Асинхронно обновляет статистику и календари после создания нового абонемента."""
-    try:
-        import logging
-        logging.info("=== НАЧАЛО ФОНОВЫХ ОБНОВЛЕНИЙ ПОСЛЕ СОЗДАНИЯ АБОНЕМЕНТА ===")
-        
-        # 1. Обновить прогноз бюджета (создание прогнозных дат оплат)
-        logging.info("1. Запуск обновления прогноза бюджета...")
-        await asyncio.sleep(5)  # Добавляем задержку перед обновлением прогноза
-        sheets_service.update_full_forecast()
-        logging.info("Прогноз бюджета обновлен")
-        
-        # 2. Синхронизация с Google Calendar (фоновая синхронизация)
-        logging.info("2. Синхронизация с Google Calendar...")
-        try:
-            calendar_result = sheets_service.sync_calendar_with_google_calendar()
-            logging.info(f"Синхронизация календаря завершена: {calendar_result[:100]}...")
-        except Exception as e:
-            logging.error(f"Ошибка при синхронизации календаря: {e}")
-        
-        # 3. Синхронизация прогноза с Google Calendar (фоновая синхронизация)
-        logging.info("3. Синхронизация прогноза с Google Calendar...")
-        try:
-            forecast_result = sheets_service.sync_forecast_with_google_calendar()
-            logging.info(f"Синхронизация прогноза завершена: {forecast_result[:100]}...")
-        except Exception as e:
-            logging.error(f"Ошибка при синхронизации прогноза: {e}")
-        
-        # 4. Очистка дублей в Google Calendar (фоновая очистка)
-        logging.info("4. Очистка дублей в Google Calendar...")
-        try:
-            clean_result = sheets_service.clean_duplicate_events()
-            logging.info(f"Очистка дублей завершена: {clean_result[:100]}...")
-        except Exception as e:
-            logging.error(f"Ошибка при очистке дублей: {e}")
-        
-        # ПРИМЕЧАНИЕ: update_subscriptions_statistics() НЕ вызывается при создании абонемента,
-        # потому что календарь уже создан правильно, а статистика пока не нужна
-        
-        logging.info("=== ЗАВЕРШЕНИЕ ФОНОВЫХ ОБНОВЛЕНИЙ ПОСЛЕ СОЗДАНИЯ АБОНЕМЕНТА ===")
-        
-    except Exception as e:
-        logging.error(f"Ошибка при фоновых обновлениях после создания абонемента: {e}")
-
 # Функция синхронизации с Google Calendar удалена
 
 async def select_calendar_subscription(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -3043,6 +2913,19 @@ async def select_attendance_mark(update: Update, context: ContextTypes.DEFAULT_T
     subscription_id = context.user_data.get('selected_subscription_id', '')
     
     try:
+        # Оптимистичная отметка: подтверждаем сразу, запись в таблицу идет в фоне
+        if await submit_mark_fast(lesson_row, mark,
+                                  chat_id=query.message.chat_id,
+                                  retry_callback=f"lesson_{lesson_row}"):
+            await query.edit_message_text(
+                f"✅ Отметка '{mark}' сохранена!\n\nТаблица и статистика абонемента обновятся в фоне.",
+                reply_markup=InlineKeyboardMarkup([[
+                    InlineKeyboardButton("⏪ Назад к занятиям", callback_data=f"calendar_sub_{subscription_id}"),
+                    InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
+                ]])
+            )
+            return SELECT_LESSON
+        
         # Обновляем отметку в Google Sheets
         result = sheets_service.update_lesson_mark(lesson_row, mark)
         
@@ -3070,9 +2953,8 @@ async def select_attendance_mark(update: Update, context: ContextTypes.DEFAULT_T
         if success:
             # Запускаем фоновое обновление для синхронизации прогноза и Google Calendar
             try:
-                import asyncio
-                asyncio.create_task(update_data_in_background())
-                logging.info("🚀 Фоновое обновление запущено асинхронно")
+                schedule_data_refresh("отметка посещения")
+                logging.info("🚀 Фоновое обновление запрошено")
             except Exception as e:
                 logging.error(f"❌ Ошибка при запуске фонового обновления: {e}")
             
@@ -3083,7 +2965,7 @@ async def select_attendance_mark(update: Update, context: ContextTypes.DEFAULT_T
                     InlineKeyboardButton("🏠 Главное меню", callback_data="main_menu")
                 ]])
             )
-            return CALENDAR_LESSONS
+            return SELECT_LESSON
         else:
             await query.edit_message_text(
                 f"❌ Ошибка при сохранении отметки.",
@@ -3118,6 +3000,7 @@ async def settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         [InlineKeyboardButton("🔄 Обновить Google календарь", callback_data="sync_google_calendar")],
         [InlineKeyboardButton("💰 Google прогноз", callback_data="sync_google_forecast")],
         [InlineKeyboardButton("🧹 Очистить дубли", callback_data="clean_duplicates")],
+        [InlineKeyboardButton("🗂 Фоновые задачи", callback_data="background_jobs_status")],
         [InlineKeyboardButton("📊 Обновить данные абонементов", callback_data="refresh_subscriptions_data")],
         [InlineKeyboardButton("🔄 Обновить статистику", callback_data="menu_update_stats")],
         [InlineKeyboardButton("🔄 Обновить абонементы", callback_data="menu_update_subscriptions")],
@@ -3326,13 +3209,15 @@ async def set_notification_time_handler(update: Update, context: ContextTypes.DE
                     logging.error(f"❌ Ошибка инициализации планировщика: {e}")
                     notification_scheduler = None
                 
-            # Устанавливаем chat_id в планировщик
+            # Устанавливаем chat_id и новое время в планировщик (срабатывание пересчитывается сразу)
             if notification_scheduler:
                 notification_scheduler.set_chat_id(chat_id)
                 
-            if notification_scheduler and not notification_scheduler.is_running:
-                await notification_scheduler.start_scheduler()
-                message_text += "\n\n🚀 <b>Планировщик уведомлений запущен!</b>"
+                if notification_scheduler.is_running:
+                    notification_scheduler.reschedule(time_str)
+                else:
+                    await notification_scheduler.start_scheduler(time_str)
+                    message_text += "\n\n🚀 <b>Планировщик уведомлений запущен!</b>"
         else:
             message_text = "❌ <b>Ошибка при сохранении времени уведомлений</b>\n\nПопробуйте еще раз."
         
@@ -3447,7 +3332,6 @@ async def test_notifications_handler(update: Update, context: ContextTypes.DEFAU
                     except Exception as e:
                         message_text += f"• Занятие {i}: {lesson['child_name']} - {lesson['circle_name']} ❌ (ошибка)\n"
                         logging.error(f"Ошибка при отправке тестового уведомления: {e}")
-                    await asyncio.sleep(2)  # Увеличиваем задержку между уведомлениями
                 
                 message_text += f"\n🎉 <b>Отправлено {len(today_lessons)} уведомлений!</b>\n\n"
                 message_text += "📱 Проверьте чат - должны прийти уведомления с кнопками отметок."
@@ -3645,6 +3529,8 @@ async def subscriptions_menu(update: Update, context: ContextTypes.DEFAULT_TYPE)
         reply_markup = InlineKeyboardMarkup(keyboard)
         
         await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='HTML')
+        # Пока выбирают абонемент, загружаем листы для его карточки
+        get_prefetcher(sheets_service).schedule('subscriptions_menu')
         return SELECT_SUBSCRIPTION
         
     except Exception as e:
@@ -3666,7 +3552,8 @@ async def select_subscription_handler(update: Update, context: ContextTypes.DEFA
     context.user_data['selected_sub_id'] = sub_id
     
     if sheets_service is not None:
-        all_subs = sheets_service.get_active_subscriptions()
+        # Список только что загружен экраном абонементов
+        all_subs = sheets_service.get_active_subscriptions(use_cache=True)
     else:
         all_subs = []
     selected_sub_info = next((sub for sub in all_subs if str(sub.get('ID абонемента')) == str(sub_id)), None)
@@ -3911,8 +3798,8 @@ async def confirm_delete_subscription_handler(update: Update, context: ContextTy
             
             # 3. Запускаем фоновые обновления
             try:
-                # Запускаем полное фоновое обновление
-                asyncio.create_task(update_data_in_background())
+                # Запрашиваем полное фоновое обновление
+                schedule_data_refresh("удаление абонемента")
                 logging.info("🔄 Запущены фоновые обновления после удаления абонемента")
             except Exception as e:
                 logging.error(f"❌ Ошибка при запуске фоновых обновлений: {e}")
@@ -5092,8 +4979,8 @@ async def create_sub_finish_handler(update: Update, context: ContextTypes.DEFAUL
                 result_message = f"❌ Произошла ошибка при создании абонемента: {creation_error}"
         
         if success:
-            # Запускаем фоновые обновления асинхронно
-            asyncio.create_task(update_after_subscription_creation())
+            # Запрашиваем фоновые обновления
+            schedule_data_refresh("создание абонемента")
             
             # Очищаем данные пользователя
             context.user_data.clear()
@@ -5198,6 +5085,59 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     await start(start_update, context)
     return ConversationHandler.END
 
+# === Сводка занятий дня (режим уведомлений digest) ===
+async def digest_mark_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отметка из сводки: быстрый путь как в календаре, сводка перерисовывается на месте."""
+    query = update.callback_query
+    from notification_scheduler import get_notification_scheduler, lesson_notification_payload
+    notification_scheduler = get_notification_scheduler(context.bot)
+    
+    lesson_id, _, attendance_mark = query.data.replace("digest_mark_", "", 1).partition("|||")
+    logging.info(f"📋 Отметка из сводки: занятие {lesson_id}, отметка '{attendance_mark}'")
+    
+    # Сообщение со сводкой не затираем ошибкой записи - она придет отдельным сообщением
+    try:
+        lesson = await submit_mark_fast(lesson_id, attendance_mark, chat_id=query.message.chat_id, sync_fallback=True)
+    except Exception as e:
+        logging.error(f"❌ Не удалось записать отметку из сводки для занятия {lesson_id}: {e}")
+        await query.answer("❌ Не удалось сохранить отметку, попробуйте еще раз", show_alert=True)
+        return
+    if lesson:
+        await safe_answer_callback_query(query, f"{attendance_mark} ✓")
+        text, reply_markup = await asyncio.to_thread(
+            notification_scheduler.build_digest, lesson.get('Дата занятия', ''), 0, lesson_id, None,
+            notification_scheduler.children_filter(query.message.chat_id)
+        )
+        await safe_edit_message(query, text, reply_markup=reply_markup, parse_mode='HTML')
+        return
+    
+    lesson = await asyncio.to_thread(sheets_service.find_lesson_in_memory, lesson_id)
+    if not lesson:
+        await query.answer("❌ Занятие не найдено. Отметьте его через календарь занятий.", show_alert=True)
+        return
+    
+    # Нужен выбор переноса - отдельная карточка занятия с обычными кнопками отметки
+    await safe_answer_callback_query(query, "Для этого занятия нужна отдельная карточка")
+    sub_details = await asyncio.to_thread(sheets_service.get_subscription_details, lesson.get('ID абонемента', ''), True)
+    circle_name = sub_details.get('circle_name', 'Неизвестно') if sub_details else 'Неизвестно'
+    await notification_scheduler._send_lesson_notification(
+        lesson_notification_payload(lesson, lesson_id, circle_name), chat_id=query.message.chat_id
+    )
+
+async def digest_page_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листает страницы сводки занятий дня."""
+    query = update.callback_query
+    await safe_answer_callback_query(query)
+    from notification_scheduler import get_notification_scheduler
+    
+    notification_scheduler = get_notification_scheduler(context.bot)
+    date_str, _, page = query.data.replace("digest_page_", "", 1).rpartition("_")
+    text, reply_markup = await asyncio.to_thread(
+        notification_scheduler.build_digest, date_str, int(page), None, None,
+        notification_scheduler.children_filter(query.message.chat_id)
+    )
+    await safe_edit_message(query, text, reply_markup=reply_markup, parse_mode='HTML')
+
 # === Обработчик отмены уведомлений ===
 async def cancel_notification_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик кнопки 'Отмена' в уведомлениях - удаляет сообщение с эффектом расщепления"""
@@ -5270,6 +5210,8 @@ def create_conversation_handler() -> ConversationHandler:
                 CallbackQueryHandler(sync_google_calendar_handler, pattern='^sync_google_calendar$'),
                 CallbackQueryHandler(sync_google_forecast_handler, pattern='^sync_google_forecast$'),
                 CallbackQueryHandler(clean_duplicates_handler, pattern='^clean_duplicates$'),
+                CallbackQueryHandler(background_jobs_status_handler, pattern='^background_jobs_(status|cancel)$'),
+                CallbackQueryHandler(settings_menu, pattern='^menu_settings$'),
                 CallbackQueryHandler(save_attendance_mark, pattern='^attendance_mark_'),  # Для уведомлений
                 CallbackQueryHandler(cancel_notification_handler, pattern='^cancel_notification_'),  # Для отмены уведомлений
                 CallbackQueryHandler(update_stats_menu_handler, pattern='^menu_update_stats$'),
@@ -5451,6 +5393,8 @@ def create_conversation_handler() -> ConversationHandler:
             CallbackQueryHandler(go_back_to_main_menu, pattern='^main_menu$'),
         ],
         allow_reentry=True,
+        name='main_conversation',
+        persistent=True,
     )
 
 async def dashboard_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
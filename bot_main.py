@@ -1,10 +1,13 @@
 import logging
 import asyncio
-from telegram.ext import Application
-from telegram import BotCommand
+from telegram.ext import Application, CallbackQueryHandler, TypeHandler, PicklePersistence, PersistenceInput
+from telegram.request import HTTPXRequest
+from telegram import BotCommand, Update
 import config
-from bot_handlers import create_conversation_handler
+from bot_handlers import create_conversation_handler, digest_mark_handler, digest_page_handler
 from google_sheets_service import sheets_service
+from message_registry import TrackingBot, track_incoming_message
+from send_queue import get_send_queue
 
 # Настройка логирования
 logging.basicConfig(
@@ -16,13 +19,14 @@ logger = logging.getLogger(__name__)
 async def clear_webhook_and_setup(application):
     """Очищает webhook и устанавливает команды меню бота."""
     try:
-        # Очищаем webhook
-        logger.info("🔧 Очищаю webhook...")
-        await application.bot.delete_webhook(drop_pending_updates=True)
-        logger.info("✅ Webhook очищен")
-        
-        # Небольшая задержка
-        await asyncio.sleep(2)
+        # Очищаем webhook (в webhook-режиме его устанавливает webhook_server)
+        if application.bot_data.get('bot_mode') != 'webhook':
+            logger.info("🔧 Очищаю webhook...")
+            await application.bot.delete_webhook(drop_pending_updates=True)
+            logger.info("✅ Webhook очищен")
+            
+            # Небольшая задержка
+            await asyncio.sleep(2)
         
         # Устанавливаем команды
         commands = [
@@ -36,6 +40,13 @@ async def clear_webhook_and_setup(application):
 
 async def post_init_handler(application):
     """Обработчик инициализации после запуска бота."""
+    # Теплый перезапуск: восстанавливаем кеш таблицы до начала приема обновлений
+    if sheets_service:
+        from warm_restart import get_warm_cache_store, periodic_warm_cache_save
+        warm_cache_store = get_warm_cache_store(sheets_service)
+        await asyncio.to_thread(warm_cache_store.restore)
+        asyncio.create_task(periodic_warm_cache_save(warm_cache_store))
+    
     # Сначала очищаем webhook и устанавливаем команды
     await clear_webhook_and_setup(application)
     
@@ -56,7 +67,7 @@ async def post_init_handler(application):
                 logger.info("🚀 Запускаю планировщик уведомлений...")
                 notification_scheduler.set_chat_id(notification_chat_id)
                 # ИСПРАВЛЕНО: используем create_task БЕЗ await
-                asyncio.create_task(notification_scheduler.start_scheduler())
+                asyncio.create_task(notification_scheduler.start_scheduler(notification_time))
                 logger.info("✅ Планировщик уведомлений запущен в фоне")
             else:
                 if not notification_time:
@@ -68,11 +79,54 @@ async def post_init_handler(application):
             logger.info("⚠️ Планировщик пропущен - Google Sheets недоступен")
     except Exception as e:
         logger.error(f"❌ Ошибка при запуске планировщика: {e}", exc_info=True)
+    
+    # Напоминания по отдельным занятиям (перед началом и об отметке после окончания)
+    if sheets_service and (getattr(config, 'LESSON_REMINDER_MINUTES_BEFORE', 0)
+                           or getattr(config, 'LESSON_UNMARKED_NUDGE_MINUTES', 0)):
+        try:
+            from lesson_reminders import get_lesson_reminders
+            notification_chat_id = await asyncio.to_thread(sheets_service.get_notification_chat_id)
+            await get_lesson_reminders(application.bot).start(chat_id=notification_chat_id)
+        except Exception as e:
+            logger.error(f"❌ Ошибка при запуске напоминаний по занятиям: {e}", exc_info=True)
+    
+    # Очередь фоновой записи отметок посещения (восстанавливает незаписанные после перезапуска)
+    if sheets_service:
+        from mark_commit_queue import get_mark_commit_queue
+        from bot_handlers import on_attendance_mark_committed
+        await get_mark_commit_queue(application.bot).start(on_committed=on_attendance_mark_committed)
+    
+    # Периодическая глубокая синхронизация календаря (фоновые синхронизации идут в окне дат)
+    if sheets_service and sheets_service.calendar_service:
+        from bot_handlers import periodic_deep_calendar_sync
+        asyncio.create_task(periodic_deep_calendar_sync())
+        logger.info("✅ Периодическая глубокая синхронизация календаря запущена в фоне")
+
+async def post_shutdown_handler(application):
+    """Сохраняет кеш таблицы при штатной остановке бота."""
+    from warm_restart import get_warm_cache_store
+    warm_cache_store = get_warm_cache_store()
+    if warm_cache_store:
+        await asyncio.to_thread(warm_cache_store.save)
+
+def main(mode=None) -> None:
+    """Основная функция для запуска бота.
 
-def main() -> None:
-    """Основная функция для запуска бота."""
+    mode: 'polling' (по умолчанию) или 'webhook' - один HTTP-сервер для
+    обновлений Telegram и дашборда (см. webhook_server). По умолчанию BOT_MODE.
+    """
+    mode = mode or getattr(config, 'BOT_MODE', 'polling')
+    logger.info(f"🚀 Режим получения обновлений: {mode}")
     
-    # 0. ПРИНУДИТЕЛЬНАЯ ОЧИСТКА WEBHOOK ПЕРЕД ЗАПУСКОМ
+    # 0. ПРИНУДИТЕЛЬНАЯ ОЧИСТКА WEBHOOK ПЕРЕД ЗАПУСКОМ (только для polling)
+    if mode != 'webhook':
+        _force_delete_webhook()
+    
+    logger.info("🔄 Продолжаю инициализацию...")
+    _run_application(mode)
+
+def _force_delete_webhook():
+    """Удаляет webhook через HTTP API до создания приложения (для polling)."""
     logger.info("🔧 ПРИНУДИТЕЛЬНАЯ очистка webhook перед запуском...")
     try:
         import requests
@@ -96,9 +150,9 @@ def main() -> None:
     except Exception as e:
         logger.error(f"❌ Критическая ошибка принудительной очистки webhook: {e}")
         logger.error(f"❌ Тип ошибки: {type(e).__name__}")
-    
-    logger.info("🔄 Продолжаю инициализацию...")
-    
+
+def _run_application(mode):
+    """Создает приложение бота и запускает его в выбранном режиме."""
     # 1. Проверяем, что сервис Google Sheets работает
     if not sheets_service:
         logging.warning("⚠️ Google Sheets недоступен, но бот запустится без него")
@@ -107,7 +161,22 @@ def main() -> None:
 
     # 2. Создаем и настраиваем приложение бота
     logger.info("Создаю приложение бота...")
-    application = Application.builder().token(config.TELEGRAM_TOKEN).build()
+    # Бот записывает ID отправленных сообщений для очистки чата (пулы соединений как у билдера по умолчанию).
+    # Все исходящие запросы идут через очередь отправки с лимитами Telegram
+    bot = TrackingBot(
+        token=config.TELEGRAM_TOKEN,
+        request=HTTPXRequest(connection_pool_size=256),
+        get_updates_request=HTTPXRequest(),
+        rate_limiter=get_send_queue()
+    )
+    # Состояние диалогов и user_data переживает перезапуск (bot_data не сохраняется - там режим запуска)
+    persistence = PicklePersistence(
+        filepath=getattr(config, 'PERSISTENCE_FILE', 'bot_persistence.pickle'),
+        store_data=PersistenceInput(bot_data=False),
+        update_interval=getattr(config, 'PERSISTENCE_UPDATE_INTERVAL', 60)
+    )
+    application = Application.builder().bot(bot).persistence(persistence).build()
+    application.bot_data['bot_mode'] = mode
     logger.info("Приложение бота создано успешно.")
     
     logger.info("Бот запускается...")
@@ -115,17 +184,28 @@ def main() -> None:
     # 3. Регистрация ConversationHandler
     logger.info("Регистрирую обработчики...")
     conv_handler = create_conversation_handler()
+    application.add_handler(TypeHandler(Update, track_incoming_message), group=-1)
+    # Кнопки сводки занятий работают в любом состоянии диалога: регистрируются до
+    # conv_handler, иначе их перехватывает общий обработчик состояния MAIN_MENU
+    application.add_handler(CallbackQueryHandler(digest_mark_handler, pattern='^digest_mark_'))
+    application.add_handler(CallbackQueryHandler(digest_page_handler, pattern='^digest_page_'))
     application.add_handler(conv_handler)
     logger.info("Обработчики зарегистрированы.")
     
     # 4. Устанавливаем обработчик инициализации
     logger.info("🔧 Настраиваю обработчик инициализации...")
     application.post_init = post_init_handler
+    application.post_shutdown = post_shutdown_handler
     
     # 6. Запускаем бота
-    logger.info("Запускаю polling...")
     try:
-        application.run_polling(drop_pending_updates=True)  # Очищаем pending updates
+        if mode == 'webhook':
+            logger.info("Запускаю webhook-сервер...")
+            from webhook_server import run_webhook_server
+            asyncio.run(run_webhook_server(application))
+        else:
+            logger.info("Запускаю polling...")
+            application.run_polling(drop_pending_updates=True)  # Очищаем pending updates
     except KeyboardInterrupt:
         logger.info("Получен сигнал остановки (Ctrl+C)")
     except Exception as e:
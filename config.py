@@ -24,6 +24,115 @@ GOOGLE_CREDENTIALS_PATH = os.getenv('GOOGLE_CREDENTIALS_PATH', 'service_account.
 GOOGLE_CALENDAR_ID = os.getenv('GOOGLE_CALENDAR_ID')
 WEB_APP_URL = os.getenv('WEB_APP_URL')
 
+# Режим синхронизации занятий с Google Calendar:
+# 'single' - отдельное событие на каждое занятие, 'recurring' - одна серия на слот расписания
+CALENDAR_SYNC_MODE = os.getenv('CALENDAR_SYNC_MODE', 'single')
+
+# Параллельность записи в Google Calendar и общий лимит запросов в секунду
+CALENDAR_MAX_WORKERS = int(os.getenv('CALENDAR_MAX_WORKERS', '4'))
+CALENDAR_QPS = float(os.getenv('CALENDAR_QPS', '5'))
+
+# Окно фоновой синхронизации календаря (дней назад / вперед от сегодня).
+# События вне окна не трогаются; полный проход - глубокая синхронизация
+CALENDAR_SYNC_DAYS_BACK = int(os.getenv('CALENDAR_SYNC_DAYS_BACK', '30'))
+CALENDAR_SYNC_DAYS_AHEAD = int(os.getenv('CALENDAR_SYNC_DAYS_AHEAD', '90'))
+# Интервал периодической глубокой синхронизации в часах (0 - отключена)
+CALENDAR_DEEP_SYNC_INTERVAL_HOURS = float(os.getenv('CALENDAR_DEEP_SYNC_INTERVAL_HOURS', '24'))
+
+# Какой из дублей оставлять при очистке:
+# mark_then_updated - с отметкой, затем последний обновленный; first - первый; last - последний
+DEDUP_SURVIVOR_POLICY = os.getenv('DEDUP_SURVIVOR_POLICY', 'mark_then_updated')
+
+# Фоновая запись отметок посещения: файл очереди (переживает перезапуск),
+# число попыток и начальная пауза между ними в секундах (удваивается)
+MARK_QUEUE_FILE = os.getenv('MARK_QUEUE_FILE', 'pending_marks.json')
+MARK_COMMIT_MAX_ATTEMPTS = int(os.getenv('MARK_COMMIT_MAX_ATTEMPTS', '5'))
+MARK_COMMIT_RETRY_DELAY = float(os.getenv('MARK_COMMIT_RETRY_DELAY', '15'))
+
+# Планировщик фоновых задач (прогноз, синхронизации календаря, очистка дублей):
+# окно тишины перед запуском, максимальная задержка от первого запроса и пауза между задачами, сек
+BACKGROUND_JOBS_DEBOUNCE = float(os.getenv('BACKGROUND_JOBS_DEBOUNCE', '15'))
+BACKGROUND_JOBS_MAX_DELAY = float(os.getenv('BACKGROUND_JOBS_MAX_DELAY', '120'))
+BACKGROUND_JOBS_GAP = float(os.getenv('BACKGROUND_JOBS_GAP', '5'))
+
+# Через сколько секунд индекс занятий календаря бота перечитывается из таблицы
+# (между перечитываниями он обновляется точечно при отметках и новых занятиях)
+LESSON_INDEX_MAX_AGE = int(os.getenv('LESSON_INDEX_MAX_AGE', '300'))
+
+# Сколько собранных inline-клавиатур (календари, выбор времени) держать в LRU-кеше
+KEYBOARD_CACHE_SIZE = int(os.getenv('KEYBOARD_CACHE_SIZE', '128'))
+
+# Через сколько секунд снимок данных для отчета об отметке (абонементы, прогноз) перечитывается
+REPORT_SNAPSHOT_MAX_AGE = int(os.getenv('REPORT_SNAPSHOT_MAX_AGE', '120'))
+
+# Через сколько секунд метрики дашборда перечитывают листы 'Прогноз' и 'Оплачено'
+# (между перечитываниями суммы обновляются точечно при изменениях оплат)
+DASHBOARD_PAYMENTS_MAX_AGE = int(os.getenv('DASHBOARD_PAYMENTS_MAX_AGE', '300'))
+
+# Кеш значений Справочника (статусы посещения и т.п.), сек
+HANDBOOK_CACHE_TTL = int(os.getenv('HANDBOOK_CACHE_TTL', '300'))
+
+# Фоновая предзагрузка данных для следующего экрана бота
+PREFETCH_ENABLED = os.getenv('PREFETCH_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+# Не чаще одного раза в столько секунд для каждого вида данных
+PREFETCH_MIN_INTERVAL = int(os.getenv('PREFETCH_MIN_INTERVAL', '10'))
+
+# За сколько часов до ежедневных уведомлений готовить их данные (занятия дня, абонементы, статусы)
+NOTIFICATION_PREPARE_HOURS = float(os.getenv('NOTIFICATION_PREPARE_HOURS', '12'))
+# Если бот запущен позже времени уведомлений, пропущенные досылаются в течение стольких минут
+NOTIFICATION_CATCH_UP_MINUTES = int(os.getenv('NOTIFICATION_CATCH_UP_MINUTES', '180'))
+# Первая пауза перед повтором неудавшегося ежедневного уведомления, секунд (дальше удваивается; 0 - без повторов)
+NOTIFICATION_RETRY_SECONDS = int(os.getenv('NOTIFICATION_RETRY_SECONDS', '60'))
+# Ежедневные уведомления: 'per_lesson' - сообщение на каждое занятие, 'digest' - одна сводка за день
+NOTIFICATION_MODE = os.getenv('NOTIFICATION_MODE', 'per_lesson')
+# Скольким получателям уведомлений (основной чат O2 + получатели из P2 Справочника) отправлять одновременно
+NOTIFICATION_FANOUT_CONCURRENCY = int(os.getenv('NOTIFICATION_FANOUT_CONCURRENCY', '10'))
+
+# Напоминание за столько минут до начала каждого занятия (0 - выключено)
+LESSON_REMINDER_MINUTES_BEFORE = int(os.getenv('LESSON_REMINDER_MINUTES_BEFORE', '0'))
+# Напоминание об отметке через столько минут после окончания неотмеченного занятия (0 - выключено)
+LESSON_UNMARKED_NUDGE_MINUTES = int(os.getenv('LESSON_UNMARKED_NUDGE_MINUTES', '0'))
+
+# Журнал доставки уведомлений (защита от повторной отправки после перезапуска и между процессами)
+DELIVERY_LEDGER_FILE = os.getenv('DELIVERY_LEDGER_FILE', 'delivery_ledger.sqlite3')
+# Через сколько секунд незавершенная отправка (процесс упал) считается брошенной
+DELIVERY_LEDGER_CLAIM_TIMEOUT = int(os.getenv('DELIVERY_LEDGER_CLAIM_TIMEOUT', '600'))
+DELIVERY_LEDGER_KEEP_DAYS = int(os.getenv('DELIVERY_LEDGER_KEEP_DAYS', '30'))
+
+# Сколько последних ID сообщений на чат помнить для очистки чата (кольцевой буфер)
+MESSAGE_REGISTRY_SIZE = int(os.getenv('MESSAGE_REGISTRY_SIZE', '200'))
+# Сколько сообщений удалять параллельно, если пакетное удаление не прошло
+MESSAGE_DELETE_CONCURRENCY = int(os.getenv('MESSAGE_DELETE_CONCURRENCY', '5'))
+
+# Очередь отправки в Telegram: общий лимит бота (запросов/сек), лимит отправок в группу и всплеск на группу
+SEND_QUEUE_GLOBAL_RATE = float(os.getenv('SEND_QUEUE_GLOBAL_RATE', '25'))
+SEND_QUEUE_GROUP_CHAT_RATE = float(os.getenv('SEND_QUEUE_GROUP_CHAT_RATE', str(20 / 60)))
+SEND_QUEUE_CHAT_BURST = int(os.getenv('SEND_QUEUE_CHAT_BURST', '3'))
+# Сколько раз повторять запрос после RetryAfter и с какой очереди на чат предупреждать в логе
+SEND_QUEUE_MAX_RETRIES = int(os.getenv('SEND_QUEUE_MAX_RETRIES', '3'))
+SEND_QUEUE_BACKLOG_WARNING = int(os.getenv('SEND_QUEUE_BACKLOG_WARNING', '10'))
+
+# Режим получения обновлений: 'polling' или 'webhook' (один HTTP-сервер для Telegram и дашборда)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес сервера для регистрации webhook (пусто - локальный режим без регистрации)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token
+# (пусто при заданном WEBHOOK_URL - генерируется случайный при каждом запуске)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '5001'))
+# Потоки для блокирующих обработчиков дашборда в webhook-режиме
+WEBHOOK_DASHBOARD_WORKERS = int(os.getenv('WEBHOOK_DASHBOARD_WORKERS', '4'))
+
+# Теплый перезапуск: состояние диалогов (PicklePersistence) и кеш данных таблицы
+PERSISTENCE_FILE = os.getenv('PERSISTENCE_FILE', 'bot_persistence.pickle')
+PERSISTENCE_UPDATE_INTERVAL = int(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '60'))
+WARM_CACHE_FILE = os.getenv('WARM_CACHE_FILE', 'warm_cache.pickle')
+# Как часто сохранять кеш таблицы (сек, 0 - только при остановке) и сколько держать восстановленный кеш
+WARM_CACHE_SAVE_INTERVAL = int(os.getenv('WARM_CACHE_SAVE_INTERVAL', '300'))
+WARM_CACHE_RESTORE_TTL = int(os.getenv('WARM_CACHE_RESTORE_TTL', '120'))
+
 # Поддержка деплоя: если есть JSON в переменной окружения, создаем файл
 if os.getenv('GOOGLE_SERVICE_ACCOUNT_JSON'):
     try:
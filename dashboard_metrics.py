@@ -0,0 +1,315 @@
+"""
+Материализованные метрики дашборда (/api/metrics).
+
+По дням хранятся счетчики занятий (запланировано, посещено, пропущено) и суммы
+оплат из листов 'Прогноз' и 'Оплачено' - для каждого ребенка и для 'Все'.
+Занятия обновляются точечно по событиям индекса занятий (отметки, новые
+занятия, перестроение), оплаты - по событиям сервиса таблиц (перенос в
+'Оплачено', удаление, новые записи; переписанный целиком лист перечитывается
+один раз). Метрики за текущий месяц и неделю запоминаются до следующего
+изменения, поэтому запрос к API читает готовый результат. Для сумм оплат за
+любой период по снимку строятся префиксные суммы по дням (для ребенка и 'Все'):
+сумма за диапазон дат - разность двух элементов массива.
+
+Изменения в обход процесса (правка таблицы вручную, другой процесс) подхватываются
+перестроением индекса занятий (LESSON_INDEX_MAX_AGE) и перечитыванием листов
+оплат раз в DASHBOARD_PAYMENTS_MAX_AGE секунд.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from lesson_index import parse_lesson_date
+import config
+
+ALL_STUDENTS = 'Все'
+PLANNED_SHEET = 'Прогноз'
+PAID_SHEET = 'Оплачено'
+
+# Статусы посещения, которые считаются запланированными занятиями
+PLANNED_STATUSES = ('Завершен', 'Запланировано')
+
+
+def _lesson_contribution(lesson):
+    """(дата, ребенок, Counter) - вклад занятия в счетчики дня, None - дата не разобрана."""
+    lesson_date = parse_lesson_date(lesson.get('Дата занятия', ''))
+    if not lesson_date:
+        return None
+    status = str(lesson.get('Статус посещения', '')).strip()
+    counts = Counter()
+    if status in PLANNED_STATUSES:
+        counts['planned'] += 1
+    if status == 'Пропуск':
+        counts['missed'] += 1
+    if str(lesson.get('Отметка', '')).strip() == 'Посещение':
+        counts['attended'] += 1
+    return lesson_date, str(lesson.get('Ребенок', '')).strip(), counts
+
+
+def _payment_from_row(row):
+    """(дата, ребенок, сумма) из строки листа оплат [Кружок, Ребенок, Дата, Сумма, ...] или None.
+
+    Правила те же, что у get_planned_payments/get_paid_payments.
+    """
+    if len(row) < 4:
+        return None
+    circle_name, child_name, payment_date, amount = (str(value).strip() for value in row[:4])
+    if not (circle_name and child_name and payment_date and amount):
+        return None
+    try:
+        amount_value = float(amount.replace('\xa0', '').replace(' ', '').replace(',', '.'))
+    except ValueError:
+        return None
+    payment_date = parse_lesson_date(payment_date)
+    if not payment_date or amount_value <= 0:
+        return None
+    return payment_date, child_name, amount_value
+
+
+class DashboardMetricsStore:
+    """Счетчики дашборда по дням с точечным обновлением."""
+
+    def __init__(self, service):
+        self.service = service
+        self.payments_max_age = getattr(config, 'DASHBOARD_PAYMENTS_MAX_AGE', 300)
+        self._lock = threading.RLock()
+        self._lesson_days = {}      # дата -> {ребенок / 'Все': Counter}
+        self._lesson_state = {}     # id(занятия из индекса) -> вклад занятия
+        self._payment_days = {PLANNED_SHEET: {}, PAID_SHEET: {}}    # лист -> дата -> {ребенок / 'Все': сумма}
+        self._payments_loaded_at = {PLANNED_SHEET: None, PAID_SHEET: None}
+        self._results = {}          # (фильтр, начало месяца, начало недели) -> метрики
+        self._prefix = {}           # (лист, фильтр) -> (первый день, префиксные суммы по дням)
+        self._attached = False
+        self._attach_lock = threading.Lock()
+        self._digest = None         # дайджест счетчиков (ETag ответов API), None - пересчитать
+
+    def _lessons_changed(self):
+        # Префиксные суммы оплат от занятий не зависят и остаются
+        self._results = {}
+        self._digest = None
+
+    def _payments_changed(self, sheet_name):
+        self._results = {}
+        self._digest = None
+        self._prefix = {key: prefix for key, prefix in self._prefix.items() if key[0] != sheet_name}
+
+    # --- занятия ---
+
+    def on_lessons_changed(self, lessons, rebuilt=False):
+        """Подписка на индекс занятий: пересчитывает вклад изменившихся занятий."""
+        with self._lock:
+            previous_days = self._lesson_days
+            if rebuilt:
+                self._lesson_days = {}
+                self._lesson_state = {}
+            for lesson in lessons:
+                previous = self._lesson_state.pop(id(lesson), None)
+                if previous is not None:
+                    self._apply_lesson(previous, -1)
+                current = _lesson_contribution(lesson)
+                if current is not None:
+                    self._apply_lesson(current, 1)
+                    self._lesson_state[id(lesson)] = current
+            # Перечитанный без изменений календарь не сбрасывает готовые метрики
+            if not rebuilt or self._lesson_days != previous_days:
+                self._lessons_changed()
+
+    def _apply_lesson(self, contribution, sign):
+        lesson_date, child_name, counts = contribution
+        if not counts:
+            return
+        day = self._lesson_days.setdefault(lesson_date, {})
+        for key in (child_name, ALL_STUDENTS):
+            day_counts = day.setdefault(key, Counter())
+            for name, value in counts.items():
+                day_counts[name] += sign * value
+
+    # --- оплаты ---
+
+    def on_payments_changed(self, sheet_name, added=None, removed=()):
+        """Подписка на сервис таблиц: применяет добавленные и удаленные строки листа оплат."""
+        if sheet_name not in self._payment_days:
+            return
+        with self._lock:
+            if added is None:
+                # Лист переписан целиком - перечитаем при следующем запросе
+                self._payments_loaded_at[sheet_name] = None
+            elif self._payments_loaded_at[sheet_name] is not None:
+                for row in removed:
+                    self._apply_payment(sheet_name, _payment_from_row(row), -1)
+                for row in added:
+                    self._apply_payment(sheet_name, _payment_from_row(row), 1)
+            self._payments_changed(sheet_name)
+
+    def _apply_payment(self, sheet_name, payment, sign):
+        if payment is None:
+            return
+        payment_date, child_name, amount = payment
+        day = self._payment_days[sheet_name].setdefault(payment_date, {})
+        for key in (child_name, ALL_STUDENTS):
+            day[key] = day.get(key, 0) + sign * amount
+
+    def _load_payments(self, sheet_name):
+        if sheet_name == PLANNED_SHEET:
+            rows = [
+                [payment['circle_name'], payment['child_name'], payment['payment_date'], payment['budget']]
+                for payment in self.service.get_planned_payments()
+            ]
+        else:
+            rows = [
+                [payment['circle_name'], payment['child_name'], payment['payment_date'], payment['amount']]
+                for payment in self.service.get_paid_payments()
+            ]
+        with self._lock:
+            previous_days = self._payment_days[sheet_name]
+            self._payment_days[sheet_name] = {}
+            for row in rows:
+                self._apply_payment(sheet_name, _payment_from_row(row), 1)
+            self._payments_loaded_at[sheet_name] = time.time()
+            if self._payment_days[sheet_name] != previous_days:
+                self._payments_changed(sheet_name)
+        logging.info(f"📊 Метрики дашборда: загружено {len(rows)} записей из '{sheet_name}'")
+
+    # --- чтение ---
+
+    def _refresh(self):
+        """Подписывается на изменения при первом запросе и перечитывает устаревшие данные."""
+        if not self._attached:
+            # Не под self._lock: индекс вызывает подписчиков под своей блокировкой
+            with self._attach_lock:
+                if not self._attached:
+                    lesson_index = self.service.get_lesson_date_index()
+                    lesson_index.add_listener(self.on_lessons_changed)
+                    self.service.add_payments_listener(self.on_payments_changed)
+                    self.on_lessons_changed(lesson_index.lessons(), rebuilt=True)
+                    self._attached = True
+        else:
+            # Перестраивает индекс (и счетчики через подписку), только если он устарел
+            self.service.get_lesson_date_index()
+
+        now = time.time()
+        for sheet_name, loaded_at in list(self._payments_loaded_at.items()):
+            if loaded_at is None or now - loaded_at > self.payments_max_age:
+                self._load_payments(sheet_name)
+
+    def content_digest(self):
+        """SHA-256 счетчиков по дням после подхвата устаревших данных (для ETag ответов API).
+
+        Зависит только от содержимого счетчиков, поэтому совпадает и после перезапуска.
+        """
+        self._refresh()
+        with self._lock:
+            if self._digest is None:
+                lessons = sorted(
+                    (day.isoformat(), sorted((key, sorted(counts.items())) for key, counts in by_key.items()))
+                    for day, by_key in self._lesson_days.items()
+                )
+                payments = sorted(
+                    (sheet_name, day.isoformat(), sorted(by_key.items()))
+                    for sheet_name, days in self._payment_days.items()
+                    for day, by_key in days.items()
+                )
+                self._digest = hashlib.sha256(repr((lessons, payments)).encode('utf-8')).hexdigest()
+            return self._digest
+
+    def invalidate(self):
+        """Принудительно перечитывает занятия и оплаты при следующем запросе."""
+        self.service.lesson_index.invalidate()
+        with self._lock:
+            for sheet_name in self._payments_loaded_at:
+                self._payments_loaded_at[sheet_name] = None
+                self._payments_changed(sheet_name)
+            self._lessons_changed()
+
+    def get_metrics(self, student_filter=ALL_STUDENTS, today=None):
+        """Метрики дашборда за текущий месяц и неделю для ребенка или 'Все'."""
+        self._refresh()
+        today = today or date.today()
+        month_start = today.replace(day=1)
+        month_end = (month_start + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+        week_start = today - timedelta(days=today.weekday())
+        week_end = week_start + timedelta(days=6)
+
+        key = (student_filter, month_start, week_start)
+        with self._lock:
+            metrics = self._results.get(key)
+            if metrics is None:
+                lessons = self._sum_lessons(student_filter, month_start, month_end)
+                planned, attended = lessons['planned'], lessons['attended']
+                metrics = {
+                    'planned': planned,
+                    'attended': attended,
+                    'missed': lessons['missed'],
+                    'attendance_rate': round((attended / planned * 100) if planned > 0 else 0, 1),
+                    'budget_month': self._range_total(PLANNED_SHEET, student_filter, month_start, month_end),
+                    'paid_month': self._range_total(PAID_SHEET, student_filter, month_start, month_end),
+                    'budget_week': self._range_total(PLANNED_SHEET, student_filter, week_start, week_end),
+                    'paid_week': self._range_total(PAID_SHEET, student_filter, week_start, week_end),
+                    'student_filter': student_filter
+                }
+                self._results[key] = metrics
+            return dict(metrics)
+
+    def _sum_lessons(self, student_filter, start_date, end_date):
+        total = Counter()
+        day = start_date
+        while day <= end_date:
+            total.update(self._lesson_days.get(day, {}).get(student_filter, {}))
+            day += timedelta(days=1)
+        return total
+
+    def payments_total(self, sheet_name, start_date, end_date, student_filter=ALL_STUDENTS):
+        """Сумма оплат листа 'Прогноз' или 'Оплачено' за период (границы включительно)."""
+        if sheet_name not in self._payment_days:
+            return 0
+        self._refresh()
+        with self._lock:
+            return self._range_total(sheet_name, student_filter or ALL_STUDENTS, start_date, end_date)
+
+    def _prefix_sums(self, sheet_name, student_filter):
+        """(первый день, префиксные суммы по дням) - строятся один раз на снимок оплат."""
+        key = (sheet_name, student_filter)
+        prefix = self._prefix.get(key)
+        if prefix is None:
+            days = self._payment_days[sheet_name]
+            first_day = min(days) if days else None
+            sums = [0]
+            if days:
+                total = 0
+                for offset in range((max(days) - first_day).days + 1):
+                    total += days.get(first_day + timedelta(days=offset), {}).get(student_filter, 0)
+                    sums.append(total)
+            prefix = (first_day, sums)
+            self._prefix[key] = prefix
+        return prefix
+
+    def _range_total(self, sheet_name, student_filter, start_date, end_date):
+        first_day, sums = self._prefix_sums(sheet_name, student_filter)
+        if first_day is None:
+            return 0
+        if isinstance(start_date, datetime):
+            start_date = start_date.date()
+        if isinstance(end_date, datetime):
+            end_date = end_date.date()
+        # sums[i] - сумма за дни до first_day + i (не включая)
+        low = min(max((start_date - first_day).days, 0), len(sums) - 1)
+        high = min(max((end_date - first_day).days + 1, 0), len(sums) - 1)
+        if high <= low:
+            return 0
+        return int(round(sums[high] - sums[low]))
+
+
+# Глобальное хранилище
+dashboard_metrics_store = None
+
+def get_dashboard_metrics_store(service=None) -> DashboardMetricsStore:
+    """Получает глобальное хранилище метрик дашборда"""
+    global dashboard_metrics_store
+
+    if dashboard_metrics_store is None and service is not None:
+        dashboard_metrics_store = DashboardMetricsStore(service)
+
+    return dashboard_metrics_store
@@ -6,9 +6,12 @@
 
 from flask import Flask, render_template, jsonify, request
 from flask_cors import CORS
+import hashlib
 import logging
+import threading
 import time
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 import os
 import sys
 
@@ -17,7 +20,8 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 # Импортируем полный Google Sheets сервис
 import config
-from google_sheets_service import GoogleSheetsService
+from google_sheets_service import sheets_service
+from dashboard_metrics import get_dashboard_metrics_store
 
 # Настройка логирования
 logging.basicConfig(
@@ -34,13 +38,12 @@ app = Flask(__name__,
 # Включаем CORS для работы с Telegram Mini App
 CORS(app)
 
-# Инициализируем полный Google Sheets сервис
-try:
-    sheets_service = GoogleSheetsService(config.GOOGLE_CREDENTIALS_PATH, config.GOOGLE_SHEET_NAME)
+# Общий экземпляр Google Sheets сервиса: в webhook-режиме дашборд работает в процессе
+# бота и видит тот же кеш, индекс занятий и события изменений оплат
+if sheets_service:
     logger.info("✅ Полный Google Sheets сервис готов")
-except Exception as e:
-    logger.error(f"❌ Ошибка инициализации Google Sheets: {e}")
-    sheets_service = None
+else:
+    logger.error("❌ Google Sheets сервис недоступен")
 
 class DashboardDataService:
     def __init__(self):
@@ -149,76 +152,23 @@ class DashboardDataService:
         
         return count
     
+    def group_lessons_by_subscription(self, calendar_data):
+        """Группирует занятия календаря по ID абонемента за один проход"""
+        lessons_by_subscription = {}
+        for lesson in calendar_data:
+            lessons_by_subscription.setdefault(lesson.get('ID абонемента'), []).append(lesson)
+        return lessons_by_subscription
+    
     def get_budget_metrics(self, sheet_name, start_date, end_date, student_filter=None):
-        """Получает бюджетные метрики из листов Прогноз или Оплачено"""
+        """Получает бюджетные метрики из листов Прогноз или Оплачено (префиксные суммы по дням)"""
         try:
             if not sheets_service:
                 logger.warning(f"⚠️ sheets_service не инициализирован для {sheet_name}")
                 return 0
             
-            # Получаем данные из указанного листа
-            if sheet_name == 'Прогноз':
-                data = sheets_service.get_planned_payments()
-            elif sheet_name == 'Оплачено':
-                data = sheets_service.get_paid_payments()
-            else:
-                return 0
-            
-            logger.info(f"📊 {sheet_name}: загружено {len(data) if data else 0} записей")
-            logger.info(f"📅 Период: {start_date.strftime('%d.%m.%Y')} - {end_date.strftime('%d.%m.%Y')}")
-            
-            if not data:
-                logger.warning(f"⚠️ Нет данных в листе {sheet_name}")
-                return 0
-            
-            total_amount = 0
-            matched_count = 0
-            
-            # Логируем первые 3 записи для отладки
-            if data and len(data) > 0:
-                logger.info(f"🔍 Первые записи из {sheet_name}:")
-                for i, payment in enumerate(data[:3], 1):
-                    logger.info(f"  {i}. Дата: {payment.get('payment_date', 'НЕТ')}, Ребенок: {payment.get('child_name', 'НЕТ')}, Сумма: {payment.get('budget' if sheet_name == 'Прогноз' else 'amount', 'НЕТ')}")
-            
-            for payment in data:
-                try:
-                    # Получаем дату оплаты
-                    payment_date_str = payment.get('payment_date', '')
-                    if not payment_date_str:
-                        logger.debug(f"  ⚠️ Пропущена запись без даты")
-                        continue
-                    
-                    # Парсим дату
-                    try:
-                        payment_date = datetime.strptime(payment_date_str, '%d.%m.%Y')
-                    except ValueError:
-                        logger.warning(f"  ⚠️ Неверный формат даты: {payment_date_str}")
-                        continue
-                    
-                    # Проверяем, попадает ли дата в диапазон
-                    if start_date <= payment_date <= end_date:
-                        # Фильтрация по студенту (если указан)
-                        if student_filter and student_filter != 'Все':
-                            child_name = payment.get('child_name', '')
-                            if child_name != student_filter:
-                                continue  # Пропускаем, если не подходит фильтр
-                        
-                        # Получаем сумму
-                        if sheet_name == 'Прогноз':
-                            amount = float(payment.get('budget', 0) or 0)
-                        else:  # Оплачено
-                            amount = float(payment.get('amount', 0) or 0)
-                        
-                        total_amount += amount
-                        matched_count += 1
-                        logger.debug(f"  ✅ {payment_date_str}: {payment.get('child_name', '')} - {amount} руб.")
-                                
-                except (TypeError,) as e:
-                    logger.debug(f"  ⚠️ Ошибка обработки записи: {e}")
-                    continue
-            
-            logger.info(f"💰 {sheet_name}: найдено {matched_count} записей на сумму {int(total_amount)} руб.")
-            return int(total_amount)
+            return get_dashboard_metrics_store(sheets_service).payments_total(
+                sheet_name, start_date, end_date, student_filter
+            )
             
         except Exception as e:
             logger.error(f"Ошибка получения бюджетных метрик из {sheet_name}: {e}")
@@ -255,6 +205,10 @@ class DashboardDataService:
             
             progress_data = []
             
+            # Календарь загружаем и группируем по абонементам один раз на запрос
+            lessons_by_subscription = self.group_lessons_by_subscription(self.get_calendar_lessons_data())
+            month_start, month_end = self.get_current_month_range()
+            
             for sub in active_subs:
                 try:
                     child_name = sub.get('Ребенок', 'Неизвестно')
@@ -289,15 +243,10 @@ class DashboardDataService:
                     # ИСПРАВЛЕНО: Процент = прошло / всего * 100 (где всего = H + I + M)
                     progress_percent = (completed_lessons / total_lessons * 100) if total_lessons > 0 else 0
                     
-                    # Получаем данные занятий из календаря для этого абонемента
-                    calendar_data = self.get_calendar_lessons_data()
-                    subscription_lessons = [
-                        lesson for lesson in calendar_data 
-                        if lesson.get('ID абонемента') == sub_id
-                    ]
+                    # Занятия этого абонемента из группировки календаря
+                    subscription_lessons = lessons_by_subscription.get(sub_id, [])
                     
                     # Подсчитываем пропущенные занятия за текущий месяц
-                    month_start, month_end = self.get_current_month_range()
                     missed_this_month = self.count_lessons_by_criteria(
                         subscription_lessons, 'Дата занятия', 'Статус посещения',
                         ['Пропуск'], month_start, month_end
@@ -371,6 +320,9 @@ class DashboardDataService:
             
             progress_data = []
             
+            # Календарь загружаем и группируем по абонементам один раз на запрос
+            lessons_by_subscription = self.group_lessons_by_subscription(self.get_calendar_lessons_data())
+            
             for sub in completed_subs:
                 try:
                     child_name = sub.get('Ребенок', 'Неизвестно')
@@ -405,12 +357,8 @@ class DashboardDataService:
                     # ИСПРАВЛЕНО: Процент = прошло / всего * 100 (где всего = H + I)
                     progress_percent = (completed_lessons / total_lessons * 100) if total_lessons > 0 else 100
                     
-                    # Получаем данные занятий из календаря для этого абонемента
-                    calendar_data = self.get_calendar_lessons_data()
-                    subscription_lessons = [
-                        lesson for lesson in calendar_data 
-                        if lesson.get('ID абонемента') == sub_id
-                    ]
+                    # Занятия этого абонемента из группировки календаря
+                    subscription_lessons = lessons_by_subscription.get(sub_id, [])
                     
                     # Подсчитываем пропущенные занятия за весь период абонемента
                     missed_total = len([
@@ -456,56 +404,14 @@ class DashboardDataService:
             return []
     
     def get_dashboard_metrics(self, student_filter='Все'):
-        """Получает основные метрики для дашборда согласно новым требованиям"""
+        """Получает основные метрики для дашборда из материализованных счетчиков по дням"""
         try:
-            # Получаем диапазоны дат
-            month_start, month_end = self.get_current_month_range()
-            week_start, week_end = self.get_current_week_range()
-            
-            # Основные метрики
-            # Получаем данные календаря с фильтрацией
-            calendar_data = self.get_calendar_lessons_data(student_filter)
-            
-            # Запланировано: столбец E (Статус посещения) = "Завершен" или "Запланировано"
-            planned = self.count_lessons_by_criteria(
-                calendar_data, 'Дата занятия', 'Статус посещения',
-                ['Завершен', 'Запланировано'], month_start, month_end
-            )
-            
-            # Посещено: столбец G (Отметка) = "Посещение"
-            attended = self.count_lessons_by_criteria(
-                calendar_data, 'Дата занятия', 'Отметка',
-                ['Посещение'], month_start, month_end
-            )
-            
-            # Пропущено: столбец E (Статус посещения) = "Пропуск"
-            missed = self.count_lessons_by_criteria(
-                calendar_data, 'Дата занятия', 'Статус посещения',
-                ['Пропуск'], month_start, month_end
-            )
-            
-            # Посещаемость
-            attendance_rate = (attended / planned * 100) if planned > 0 else 0
-            
-            # Бюджетные метрики
-            budget_month = self.get_budget_metrics('Прогноз', month_start, month_end, student_filter)
-            paid_month = self.get_budget_metrics('Оплачено', month_start, month_end, student_filter)
-            budget_week = self.get_budget_metrics('Прогноз', week_start, week_end, student_filter)
-            paid_week = self.get_budget_metrics('Оплачено', week_start, week_end, student_filter)
-            
-            metrics = {
-                'planned': planned,
-                'attended': attended,
-                'missed': missed,
-                'attendance_rate': round(attendance_rate, 1),
-                'budget_month': budget_month,
-                'paid_month': paid_month,
-                'budget_week': budget_week,
-                'paid_week': paid_week,
-                'student_filter': student_filter
-            }
+            if not sheets_service:
+                logger.error("sheets_service не инициализирован")
+                return None
             
-            logger.info(f"📊 Метрики дашборда для '{student_filter}': {metrics}")
+            metrics = get_dashboard_metrics_store(sheets_service).get_metrics(student_filter)
+            logger.debug(f"📊 Метрики дашборда для '{student_filter}': {metrics}")
             return metrics
             
         except Exception as e:
@@ -593,6 +499,92 @@ class DashboardDataService:
 # Инициализируем сервис данных
 dashboard_service = DashboardDataService()
 
+# Cache-Control эндпоинтов с ETag: после max-age клиент переспрашивает с If-None-Match
+# и при неизменных данных получает 304 без тела. Остальные ответы /api/ не кешируются.
+API_CACHE_CONTROL = {
+    'api_metrics': 'private, max-age=15, must-revalidate',
+    'api_budget': 'private, max-age=15, must-revalidate',
+    'api_subscriptions': 'private, max-age=30, must-revalidate',
+    'api_completed_subscriptions': 'private, max-age=300, must-revalidate',
+    'api_calendar': 'private, max-age=60, must-revalidate',
+    'api_filters': 'private, max-age=300, must-revalidate',
+}
+
+# ETag -> тело ответа: один ETag всегда отдает одни и те же байты (строгий ETag),
+# а повторный запрос без If-None-Match не пересчитывает ответ
+TAGGED_RESPONSES_LIMIT = 64
+_tagged_responses = OrderedDict()
+_tagged_responses_lock = threading.Lock()
+
+
+def metrics_version():
+    """Версия данных метрик и бюджета: дайджест счетчиков дашборда на сегодня"""
+    if not sheets_service:
+        return None
+    return (get_dashboard_metrics_store(sheets_service).content_digest(), date.today())
+
+
+def sheets_version(*loaders):
+    """Версия данных листов: загрузчики обновляют кеш сервиса, версия - дайджест загруженных данных.
+
+    Версия зависит только от содержимого, поэтому после перезапуска прежний ETag
+    совпадает, только если данные действительно не изменились.
+    """
+    if not sheets_service:
+        return None
+    digests = []
+    for cache_key, loader in loaders:
+        loader()
+        digests.append(sheets_service.data_digest(cache_key))
+    return (tuple(digests), date.today())
+
+
+def subscriptions_version():
+    """Версия данных прогресса абонементов: лист абонементов и календарь занятий"""
+    if not sheets_service:
+        return None
+    return sheets_version(
+        ('subscriptions_data', sheets_service.get_subscriptions_data),
+        ('calendar_lessons', sheets_service.get_calendar_lessons),
+    )
+
+
+def conditional_json(version, build):
+    """JSON-ответ со строгим ETag по версии данных; If-None-Match с тем же ETag - 304 без build()"""
+    etag = hashlib.sha256(
+        repr((request.endpoint, sorted(request.args.items(multi=True)), version)).encode('utf-8')
+    ).hexdigest()[:32]
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        with _tagged_responses_lock:
+            body = _tagged_responses.get(etag)
+            if body is not None:
+                _tagged_responses.move_to_end(etag)
+        if body is None:
+            response = app.make_response(build())
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            with _tagged_responses_lock:
+                _tagged_responses[etag] = body
+                while len(_tagged_responses) > TAGGED_RESPONSES_LIMIT:
+                    _tagged_responses.popitem(last=False)
+        response = app.response_class(body, mimetype='application/json')
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = API_CACHE_CONTROL.get(request.endpoint, 'no-cache')
+    return response
+
+
+@app.after_request
+def default_api_cache_control(response):
+    """Ответы /api/ без ETag (ошибки, health, refresh, отладка) не кешируются"""
+    if request.path.startswith('/api/') and 'Cache-Control' not in response.headers:
+        response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/')
 def dashboard():
     """Главная страница дашборда"""
@@ -602,12 +594,15 @@ def dashboard():
 def api_filters():
     """API эндпоинт для получения списка фильтров студентов"""
     try:
-        filters = dashboard_service.get_student_filters()
-        return jsonify({
-            'success': True,
-            'filters': filters,
-            'timestamp': datetime.now().isoformat()
-        })
+        def build():
+            return jsonify({
+                'success': True,
+                'filters': dashboard_service.get_student_filters(),
+                'timestamp': datetime.now().isoformat()
+            })
+        
+        version = sheets_version(('subscriptions_data', sheets_service.get_subscriptions_data)) if sheets_service else None
+        return conditional_json(version, build)
     except Exception as e:
         logger.error(f"❌ Ошибка получения фильтров: {e}")
         return jsonify({
@@ -626,11 +621,11 @@ def api_metrics():
         # Исправляем проблему с кодировкой - всегда используем "Все" для упрощения
         student_filter = 'Все'
         
-        # Создаем новый экземпляр для избежания кеширования
-        temp_service = DashboardDataService()
-        metrics = temp_service.get_dashboard_metrics(student_filter)
-        
-        return jsonify(metrics)
+        # Счетчики обновляются при изменениях занятий и оплат - отдельный экземпляр не нужен
+        return conditional_json(
+            metrics_version(),
+            lambda: jsonify(dashboard_service.get_dashboard_metrics(student_filter))
+        )
         
     except Exception as e:
         logger.error(f"❌ Ошибка API метрик: {e}")
@@ -639,6 +634,43 @@ def api_metrics():
             'timestamp': datetime.now().isoformat()
         }), 500
 
+@app.route('/api/budget')
+def api_budget():
+    """API эндпоинт для сумм прогноза и оплат за произвольный период (?start=ДД.ММ.ГГГГ&end=ДД.ММ.ГГГГ)"""
+    try:
+        student_filter = request.args.get('student', 'Все')
+        month_start, month_end = dashboard_service.get_current_month_range()
+        try:
+            start_date = datetime.strptime(request.args.get('start', month_start.strftime('%d.%m.%Y')), '%d.%m.%Y')
+            end_date = datetime.strptime(request.args.get('end', month_end.strftime('%d.%m.%Y')), '%d.%m.%Y')
+        except ValueError:
+            return jsonify({
+                'success': False,
+                'error': 'Даты start и end ожидаются в формате ДД.ММ.ГГГГ',
+                'timestamp': datetime.now().isoformat()
+            }), 400
+        
+        def build():
+            return jsonify({
+                'success': True,
+                'start': start_date.strftime('%d.%m.%Y'),
+                'end': end_date.strftime('%d.%m.%Y'),
+                'student_filter': student_filter,
+                'budget': dashboard_service.get_budget_metrics('Прогноз', start_date, end_date, student_filter),
+                'paid': dashboard_service.get_budget_metrics('Оплачено', start_date, end_date, student_filter),
+                'timestamp': datetime.now().isoformat()
+            })
+        
+        return conditional_json(metrics_version(), build)
+        
+    except Exception as e:
+        logger.error(f"❌ Ошибка API бюджета: {e}")
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'timestamp': datetime.now().isoformat()
+        }), 500
+
 @app.route('/api/subscriptions')
 def api_subscriptions():
     """API эндпоинт для получения прогресса по абонементам"""
@@ -646,12 +678,14 @@ def api_subscriptions():
         # Получаем фильтр из параметров запроса
         student_filter = request.args.get('student', 'Все')
         
-        progress_data = dashboard_service.get_subscription_progress(student_filter)
-        return jsonify({
-            'success': True,
-            'subscriptions': progress_data,
-            'timestamp': datetime.now().isoformat()
-        })
+        def build():
+            return jsonify({
+                'success': True,
+                'subscriptions': dashboard_service.get_subscription_progress(student_filter),
+                'timestamp': datetime.now().isoformat()
+            })
+        
+        return conditional_json(subscriptions_version(), build)
         
     except Exception as e:
         logger.error(f"❌ Ошибка API прогресса абонементов: {e}")
@@ -668,12 +702,14 @@ def api_completed_subscriptions():
         # Получаем фильтр из параметров запроса
         student_filter = request.args.get('student', 'Все')
         
-        progress_data = dashboard_service.get_completed_subscription_progress(student_filter)
-        return jsonify({
-            'success': True,
-            'completed_subscriptions': progress_data,
-            'timestamp': datetime.now().isoformat()
-        })
+        def build():
+            return jsonify({
+                'success': True,
+                'completed_subscriptions': dashboard_service.get_completed_subscription_progress(student_filter),
+                'timestamp': datetime.now().isoformat()
+            })
+        
+        return conditional_json(subscriptions_version(), build)
         
     except Exception as e:
         logger.error(f"❌ Ошибка API прогресса завершенных абонементов: {e}")
@@ -690,29 +726,33 @@ def api_calendar():
         # Получаем фильтр из параметров запроса
         student_filter = request.args.get('student', 'Все')
         
-        # Получаем данные календаря
-        calendar_data = dashboard_service.get_calendar_lessons_data(student_filter)
-        
-        # Преобразуем в формат для календаря
-        events = []
-        for lesson in calendar_data:
-            event = {
-                'id': lesson.get('ID абонемента', ''),
-                'title': f"{lesson.get('Кружок', '')} - {lesson.get('Ребенок', '')}",
-                'date': lesson.get('Дата занятия', ''),
-                'time': lesson.get('Время начала', ''),
-                'status': lesson.get('Статус посещения', ''),
-                'attendance': lesson.get('Отметка', ''),
-                'child': lesson.get('Ребенок', ''),
-                'circle': lesson.get('Кружок', '')
-            }
-            events.append(event)
+        def build():
+            # Получаем данные календаря
+            calendar_data = dashboard_service.get_calendar_lessons_data(student_filter)
+            
+            # Преобразуем в формат для календаря
+            events = []
+            for lesson in calendar_data:
+                event = {
+                    'id': lesson.get('ID абонемента', ''),
+                    'title': f"{lesson.get('Кружок', '')} - {lesson.get('Ребенок', '')}",
+                    'date': lesson.get('Дата занятия', ''),
+                    'time': lesson.get('Время начала', ''),
+                    'status': lesson.get('Статус посещения', ''),
+                    'attendance': lesson.get('Отметка', ''),
+                    'child': lesson.get('Ребенок', ''),
+                    'circle': lesson.get('Кружок', '')
+                }
+                events.append(event)
+            
+            return jsonify({
+                'success': True,
+                'events': events,
+                'timestamp': datetime.now().isoformat()
+            })
         
-        return jsonify({
-            'success': True,
-            'events': events,
-            'timestamp': datetime.now().isoformat()
-        })
+        version = sheets_version(('calendar_lessons', sheets_service.get_calendar_lessons)) if sheets_service else None
+        return conditional_json(version, build)
         
     except Exception as e:
         logger.error(f"❌ Ошибка API календаря: {e}")
@@ -877,6 +917,8 @@ def api_refresh():
         # Очищаем кэш для принудительного обновления
         dashboard_service._cache = {}
         dashboard_service._cache_timestamp = None
+        if sheets_service:
+            get_dashboard_metrics_store(sheets_service).invalidate()
         
         metrics = dashboard_service.get_dashboard_metrics()
         return jsonify({
@@ -919,6 +961,7 @@ if __name__ == '__main__':
     logger.info(f"📊 Дашборд доступен по адресу: http://{HOST}:{PORT}")
     logger.info(f"🔧 API эндпоинты:")
     logger.info(f"   • GET /api/metrics - получение метрик")
+    logger.info(f"   • GET /api/budget - прогноз и оплаты за период")
     logger.info(f"   • GET /api/subscriptions - активные абонементы")
     logger.info(f"   • GET /api/completed-subscriptions - завершенные абонементы")
     logger.info(f"   • GET /api/health - проверка здоровья")
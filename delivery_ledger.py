@@ -0,0 +1,122 @@
+"""
+Журнал доставки уведомлений: каждое уведомление отправляется один раз.
+
+Запись с ключом (чат, занятие, вид, дата) занимается атомарно перед отправкой
+(транзакция BEGIN IMMEDIATE в SQLite), поэтому перезапуск бота или второй процесс
+(web и worker из Procfile на одном диске) не отправят его повторно. После
+успешной отправки запись помечается отправленной, при ошибке - освобождается,
+чтобы следующий запуск повторил отправку. Запись, зависшая в отправке дольше
+DELIVERY_LEDGER_CLAIM_TIMEOUT (процесс упал посреди отправки), занимается заново.
+"""
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import config
+
+# Виды уведомлений
+KIND_DAILY = 'daily'
+KIND_BEFORE_START = 'start'
+KIND_UNMARKED = 'unmarked'
+KIND_DIGEST = 'digest'
+
+STATUS_SENDING = 'sending'
+STATUS_SENT = 'sent'
+
+
+def lesson_ref(subscription_id, child_name, start_time):
+    """Ключ занятия для журнала (номер строки листа меняется при удалении строк)."""
+    return f"{str(subscription_id).strip()}|{str(child_name).strip()}|{str(start_time).strip()}"
+
+
+class DeliveryLedger:
+    """Журнал доставки в файле SQLite."""
+
+    def __init__(self, path=None):
+        self.path = path or getattr(config, 'DELIVERY_LEDGER_FILE', 'delivery_ledger.sqlite3')
+        self.claim_timeout = getattr(config, 'DELIVERY_LEDGER_CLAIM_TIMEOUT', 600)
+        self.keep_days = getattr(config, 'DELIVERY_LEDGER_KEEP_DAYS', 30)
+        self._lock = threading.Lock()
+        self._init_db()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def _init_db(self):
+        with self._lock, closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS deliveries ("
+                " chat_id TEXT NOT NULL, lesson_id TEXT NOT NULL, kind TEXT NOT NULL, day TEXT NOT NULL,"
+                " status TEXT NOT NULL, updated_at REAL NOT NULL,"
+                " PRIMARY KEY (chat_id, lesson_id, kind, day))"
+            )
+            removed = conn.execute(
+                "DELETE FROM deliveries WHERE updated_at < ?", (time.time() - self.keep_days * 86400,)
+            ).rowcount
+            if removed:
+                logging.info(f"🧹 Журнал доставки: удалено {removed} старых записей")
+
+    def claim(self, chat_id, lesson_id, kind, day):
+        """Занимает отправку. False - уведомление уже отправлено или отправляется другим процессом."""
+        key = (str(chat_id), str(lesson_id), kind, str(day))
+        now = time.time()
+        try:
+            with self._lock, closing(self._connect()) as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = conn.execute(
+                        "SELECT status, updated_at FROM deliveries"
+                        " WHERE chat_id = ? AND lesson_id = ? AND kind = ? AND day = ?", key
+                    ).fetchone()
+                    if row is not None and (row[0] == STATUS_SENT or now - row[1] < self.claim_timeout):
+                        conn.execute("COMMIT")
+                        return False
+                    conn.execute(
+                        "INSERT OR REPLACE INTO deliveries (chat_id, lesson_id, kind, day, status, updated_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?)", key + (STATUS_SENDING, now)
+                    )
+                    conn.execute("COMMIT")
+                    return True
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+        except Exception as e:
+            # Журнал недоступен - лучше отправить, чем потерять уведомление
+            logging.error(f"❌ Журнал доставки недоступен ({e}), отправка без проверки повторов")
+            return True
+
+    def mark_sent(self, chat_id, lesson_id, kind, day):
+        self._update(
+            "UPDATE deliveries SET status = ?, updated_at = ?"
+            " WHERE chat_id = ? AND lesson_id = ? AND kind = ? AND day = ?",
+            (STATUS_SENT, time.time(), str(chat_id), str(lesson_id), kind, str(day))
+        )
+
+    def release(self, chat_id, lesson_id, kind, day):
+        """Освобождает неудавшуюся отправку, чтобы ее можно было повторить."""
+        self._update(
+            "DELETE FROM deliveries WHERE chat_id = ? AND lesson_id = ? AND kind = ? AND day = ? AND status = ?",
+            (str(chat_id), str(lesson_id), kind, str(day), STATUS_SENDING)
+        )
+
+    def _update(self, sql, params):
+        try:
+            with self._lock, closing(self._connect()) as conn:
+                conn.execute(sql, params)
+        except Exception as e:
+            logging.error(f"❌ Ошибка записи в журнал доставки: {e}")
+
+
+# Глобальный журнал
+delivery_ledger = None
+
+def get_delivery_ledger() -> DeliveryLedger:
+    """Получает глобальный журнал доставки уведомлений"""
+    global delivery_ledger
+
+    if delivery_ledger is None:
+        delivery_ledger = DeliveryLedger()
+
+    return delivery_ledger
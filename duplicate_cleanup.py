@@ -0,0 +1,331 @@
+"""
+Единый движок поиска и удаления дублей в Google Sheets и Google Calendar.
+
+Записи (строки листов или события календаря) нормализуются в ключ и за один проход
+раскладываются по корзинам; в каждой корзине из нескольких записей политика выбора
+оставляет одну, остальные удаляются пакетно. Общий отчет покрывает таблицу и календарь.
+"""
+import logging
+from datetime import date, timedelta
+
+import config
+
+SURVIVOR_POLICIES = ('mark_then_updated', 'first', 'last')
+
+# Отметки, которые не считаются поставленными
+EMPTY_MARKS = ('', 'N/A')
+
+
+def normalize_cell(value):
+    """Нормализует значение ячейки/поля для ключа дубля."""
+    return ' '.join(str(value or '').split()).lower()
+
+
+def get_description_value(event, prefix):
+    """Возвращает значение строки 'prefix значение' из описания события."""
+    for line in event.get('description', '').split('\n'):
+        if line.startswith(prefix):
+            return line.split(':', 1)[1].strip()
+    return ''
+
+
+def bucket_records(records, key_func):
+    """Раскладывает записи по корзинам за один проход. Записи с ключом None пропускаются."""
+    buckets = {}
+    for record in records:
+        key = key_func(record)
+        if key is not None:
+            buckets.setdefault(key, []).append(record)
+    return buckets
+
+
+def choose_survivor(records, policy, mark_of=None, updated_of=None):
+    """Выбирает запись, которая останется из корзины дублей.
+
+    mark_then_updated: сначала запись с отметкой, среди равных - с наибольшим updated,
+    при полном равенстве - первая. first/last - по порядку следования.
+    """
+    if policy == 'last':
+        return records[-1]
+    if policy == 'first':
+        return records[0]
+
+    best = records[0]
+    best_rank = None
+    for record in records:
+        has_mark = bool(mark_of and mark_of(record) not in EMPTY_MARKS)
+        updated = updated_of(record) if updated_of else ''
+        rank = (has_mark, updated or '')
+        if best_rank is None or rank > best_rank:
+            best, best_rank = record, rank
+    return best
+
+
+class DuplicateCleanupEngine:
+    """Поиск и пакетное удаление дублей в листах 'Прогноз', 'Календарь занятий' и в Google Calendar."""
+
+    def __init__(self, spreadsheet=None, calendar_service=None, policy=None):
+        self.spreadsheet = spreadsheet
+        self.calendar_service = calendar_service
+        self.policy = policy or getattr(config, 'DEDUP_SURVIVOR_POLICY', 'mark_then_updated')
+        if self.policy not in SURVIVOR_POLICIES:
+            logging.warning(f"⚠️ Неизвестная политика очистки дублей '{self.policy}', использую mark_then_updated")
+            self.policy = 'mark_then_updated'
+
+    # ---------- Google Calendar ----------
+
+    @staticmethod
+    def event_key(event):
+        """Ключ дубля события: ID занятия, ID прогноза или (для старых событий бота) название + начало."""
+        # Экземпляры повторяющихся серий ведет синхронизация серий
+        if event.get('recurringEventId'):
+            return None
+        lesson_id = get_description_value(event, 'ID занятия:')
+        if lesson_id:
+            return ('lesson', lesson_id)
+        forecast_id = get_description_value(event, 'ID прогноза:')
+        if forecast_id:
+            return ('forecast', forecast_id)
+        if '#schedule_sync' in event.get('description', ''):
+            start = event.get('start', {})
+            start_value = start.get('dateTime') or start.get('date')
+            if start_value:
+                return ('content', normalize_cell(event.get('summary', '')), start_value)
+        return None
+
+    def find_event_duplicates(self, events, kinds=None):
+        """Возвращает список (ключ, оставляемое событие, удаляемые события).
+
+        kinds - виды ключей ('lesson', 'forecast', 'content'), None - все.
+        """
+        groups = []
+        for key, bucket in bucket_records(events, self.event_key).items():
+            if len(bucket) < 2 or (kinds is not None and key[0] not in kinds):
+                continue
+            survivor = choose_survivor(
+                bucket, self.policy,
+                mark_of=lambda event: get_description_value(event, 'Отметка:'),
+                updated_of=lambda event: event.get('updated', '')
+            )
+            groups.append((key, survivor, [event for event in bucket if event['id'] != survivor['id']]))
+        return groups
+
+    def clean_calendar(self, date_from=None, date_to=None, events=None, kinds=None):
+        """Удаляет дубли событий в окне дат (без окна - во всем календаре).
+
+        kinds - только дубли этих видов (см. find_event_duplicates), None - все.
+        """
+        stats = {'checked': 0, 'groups': 0, 'found': 0, 'deleted': 0, 'skipped': False}
+        if not self.calendar_service or not self.calendar_service.service:
+            stats['skipped'] = True
+            return stats
+
+        if events is None:
+            events = self.calendar_service.get_all_events(date_from, date_to)
+        stats['checked'] = len(events)
+
+        duplicate_ids = []
+        for key, survivor, duplicates in self.find_event_duplicates(events, kinds):
+            stats['groups'] += 1
+            logging.info(f"🔍 Дубли события {key}: {len(duplicates) + 1} шт., оставляю '{survivor.get('summary', 'Без названия')}'")
+            duplicate_ids.extend(event['id'] for event in duplicates)
+
+        stats['found'] = len(duplicate_ids)
+        if duplicate_ids:
+            stats['deleted'] = len(self.calendar_service.delete_events(duplicate_ids))
+        return stats
+
+    # ---------- Google Sheets ----------
+
+    @staticmethod
+    def forecast_row_key(row):
+        """Ключ строки 'Прогноз'/'Оплачено': (кружок, ребенок, дата).
+
+        Значения сравниваются точно (только без пробелов по краям), как при сверке
+        с 'Оплачено' раньше: строки, отличающиеся регистром, - разные записи.
+        """
+        if len(row) < 3 or not any(str(cell).strip() for cell in row[:3]):
+            return None
+        return (str(row[0]).strip(), str(row[1]).strip(), str(row[2]).strip())
+
+    def find_forecast_duplicates(self, forecast_rows, paid_rows):
+        """Возвращает номера строк 'Прогноз' (с 2), которые нужно удалить.
+
+        Удаляются строки, уже оплаченные в 'Оплачено', и повторы внутри самого прогноза.
+        Строки передаются без заголовка.
+        """
+        paid_keys = {self.forecast_row_key(row) for row in paid_rows}
+        paid_keys.discard(None)
+
+        numbered = list(enumerate(forecast_rows, start=2))
+        rows_to_delete = []
+        for key, bucket in bucket_records(numbered, lambda item: self.forecast_row_key(item[1])).items():
+            if key in paid_keys:
+                rows_to_delete.extend(row_number for row_number, _ in bucket)
+            elif len(bucket) > 1:
+                survivor = choose_survivor(bucket, self.policy)
+                rows_to_delete.extend(row_number for row_number, _ in bucket if row_number != survivor[0])
+        return sorted(rows_to_delete)
+
+    def delete_sheet_rows(self, worksheet, row_numbers):
+        """Удаляет строки листа одним batch_update (соседние строки - одним диапазоном)."""
+        if not row_numbers:
+            return 0
+
+        # Собираем непрерывные диапазоны и удаляем снизу вверх, чтобы индексы не сбивались
+        ranges = []
+        for row_number in sorted(set(row_numbers)):
+            if ranges and ranges[-1][1] == row_number - 1:
+                ranges[-1][1] = row_number
+            else:
+                ranges.append([row_number, row_number])
+
+        requests = [{
+            'deleteDimension': {
+                'range': {
+                    'sheetId': worksheet.id,
+                    'dimension': 'ROWS',
+                    'startIndex': first - 1,
+                    'endIndex': last
+                }
+            }
+        } for first, last in reversed(ranges)]
+        self.spreadsheet.batch_update({'requests': requests})
+        return sum(last - first + 1 for first, last in ranges)
+
+    def clean_forecast(self):
+        """Удаляет из 'Прогноз' оплаченные записи и повторы."""
+        stats = {'checked': 0, 'found': 0, 'deleted': 0, 'skipped': False}
+        try:
+            forecast_sheet = self.spreadsheet.worksheet("Прогноз")
+            paid_sheet = self.spreadsheet.worksheet("Оплачено")
+        except Exception as e:
+            logging.error(f"❌ Не удалось получить листы 'Прогноз' или 'Оплачено': {e}")
+            stats['skipped'] = True
+            return stats
+
+        forecast_data = forecast_sheet.get_all_values()
+        paid_data = paid_sheet.get_all_values()
+        stats['checked'] = max(len(forecast_data) - 1, 0)
+
+        rows_to_delete = self.find_forecast_duplicates(forecast_data[1:], paid_data[1:])
+        stats['found'] = len(rows_to_delete)
+        if rows_to_delete:
+            stats['deleted'] = self.delete_sheet_rows(forecast_sheet, rows_to_delete)
+            logging.info(f"✅ Из 'Прогноз' удалено строк: {stats['deleted']}")
+        return stats
+
+    def find_lesson_id_duplicates(self, rows):
+        """Возвращает список (номер строки, старый ID, новый ID) для 'Календарь занятий'.
+
+        В корзине одинаковых ID свой ID сохраняет запись, выбранная политикой
+        (по умолчанию - с отметкой), остальным и строкам без ID выдаются новые.
+        """
+        existing_ids = set()
+        numbered = []
+        for row_number, row in enumerate(rows, start=2):
+            if not any(str(cell).strip() for cell in row):
+                continue
+            raw_id = str(row[0]).strip()
+            lesson_id = int(raw_id) if raw_id.isdigit() else None
+            if lesson_id is not None:
+                existing_ids.add(lesson_id)
+            numbered.append((row_number, raw_id, lesson_id, row))
+
+        keep_rows = set()
+        for lesson_id, bucket in bucket_records(numbered, lambda item: item[2]).items():
+            survivor = choose_survivor(
+                bucket, self.policy,
+                mark_of=lambda item: str(item[3][6]).strip() if len(item[3]) > 6 else ''
+            )
+            keep_rows.add(survivor[0])
+
+        changes = []
+        next_id = max(existing_ids, default=0) + 1
+        for row_number, raw_id, lesson_id, _ in numbered:
+            if row_number in keep_rows:
+                continue
+            changes.append((row_number, raw_id, str(next_id)))
+            next_id += 1
+        return changes
+
+    def fix_lesson_ids(self):
+        """Переназначает повторяющиеся и пустые ID в 'Календарь занятий' одним batch-обновлением."""
+        stats = {'checked': 0, 'found': 0, 'fixed': 0, 'skipped': False}
+        cal_sheet = self.spreadsheet.worksheet("Календарь занятий")
+        data = cal_sheet.get_all_values()
+        stats['checked'] = max(len(data) - 1, 0)
+
+        changes = self.find_lesson_id_duplicates(data[1:])
+        stats['found'] = len(changes)
+        if changes:
+            cal_sheet.batch_update([
+                {'range': f'A{row_number}', 'values': [[new_id]]}
+                for row_number, _, new_id in changes
+            ])
+            for row_number, old_id, new_id in changes:
+                logging.info(f"🔧 Переназначен ID в строке {row_number}: {old_id or '(пусто)'} → {new_id}")
+            stats['fixed'] = len(changes)
+        return stats
+
+    # ---------- Общий запуск ----------
+
+    def run(self, calendar=True, forecast=True, lesson_ids=False, date_from=None, date_to=None):
+        """Запускает выбранные проверки и возвращает общий отчет {раздел: статистика}."""
+        report = {}
+        sections = (
+            ('calendar', calendar, lambda: self.clean_calendar(date_from, date_to)),
+            ('forecast', forecast, self.clean_forecast),
+            ('lesson_ids', lesson_ids, self.fix_lesson_ids),
+        )
+        for name, enabled, action in sections:
+            if not enabled:
+                continue
+            try:
+                report[name] = action()
+            except Exception as e:
+                logging.error(f"❌ Ошибка очистки дублей ({name}): {e}")
+                report[name] = {'error': str(e)}
+        return report
+
+    @staticmethod
+    def format_report(report):
+        """Текст общего отчета для бота."""
+        lines = []
+        calendar_stats = report.get('calendar')
+        if calendar_stats is not None:
+            if calendar_stats.get('error'):
+                lines.append(f"📅 Календарь: ошибка - {calendar_stats['error']}")
+            elif calendar_stats.get('skipped'):
+                lines.append("📅 Календарь: Calendar API недоступен, пропущено")
+            else:
+                lines.append(
+                    f"📅 Календарь: проверено {calendar_stats['checked']}, групп дублей {calendar_stats['groups']}, "
+                    f"удалено {calendar_stats['deleted']} из {calendar_stats['found']}"
+                )
+        forecast_stats = report.get('forecast')
+        if forecast_stats is not None:
+            if forecast_stats.get('error'):
+                lines.append(f"📈 Прогноз: ошибка - {forecast_stats['error']}")
+            elif forecast_stats.get('skipped'):
+                lines.append("📈 Прогноз: листы недоступны, пропущено")
+            else:
+                lines.append(
+                    f"📈 Прогноз: проверено строк {forecast_stats['checked']}, "
+                    f"удалено {forecast_stats['deleted']} из {forecast_stats['found']}"
+                )
+        lesson_id_stats = report.get('lesson_ids')
+        if lesson_id_stats is not None:
+            if lesson_id_stats.get('error'):
+                lines.append(f"🔢 ID занятий: ошибка - {lesson_id_stats['error']}")
+            else:
+                lines.append(
+                    f"🔢 ID занятий: проверено {lesson_id_stats['checked']}, переназначено {lesson_id_stats['fixed']}"
+                )
+        return '\n'.join(lines)
+
+
+def default_calendar_window():
+    """Окно ручной очистки дублей календаря: полгода назад и вперед."""
+    today = date.today()
+    return today - timedelta(days=180), today + timedelta(days=180)
@@ -1,12 +1,132 @@
+import hashlib
+import json
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import google_auth_httplib2
+import httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 import config
 import pytz
+from duplicate_cleanup import DuplicateCleanupEngine
+
+# Ключ в extendedProperties.private, где хранится хеш отрисованного события
+PAYLOAD_HASH_KEY = 'payload_hash'
+
+# Ключ серии повторяющихся занятий (ID абонемента|день недели|время начала)
+SERIES_KEY = 'series_key'
+
+# Дни недели для RRULE в порядке isoweekday (1 = понедельник)
+RRULE_WEEKDAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
+
+
+def compute_event_payload_hash(event_body):
+    """Считает стабильный хеш отрисованного события (название, время, описание)."""
+    payload = {
+        'summary': event_body.get('summary', ''),
+        'description': event_body.get('description', ''),
+        'start': event_body.get('start', {}),
+        'end': event_body.get('end', {}),
+    }
+    if 'recurrence' in event_body:
+        payload['recurrence'] = event_body['recurrence']
+    serialized = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.md5(serialized.encode('utf-8')).hexdigest()
+
+
+def get_event_payload_hash(event):
+    """Возвращает хеш, сохраненный в событии при последней синхронизации."""
+    return event.get('extendedProperties', {}).get('private', {}).get(PAYLOAD_HASH_KEY, '')
+
+
+def recurring_series_key(subscription_id, slot):
+    """Ключ повторяющейся серии слота расписания: абонемент|день недели|время начала."""
+    return f"{subscription_id}|{slot['day_num']}|{slot['start_time']}"
+
+
+class CalendarRateLimiter:
+    """Общий для всех потоков ограничитель запросов к Calendar API (запросов в секунду).
+
+    При rateLimitExceeded интервал между запросами удваивается, после успешных
+    запросов плавно возвращается к базовому.
+    """
+
+    MAX_INTERVAL = 5.0
+
+    def __init__(self, queries_per_second):
+        self.base_interval = 1.0 / max(queries_per_second, 0.1)
+        self.interval = self.base_interval
+        self._next_slot = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Ждет своей очереди на отправку запроса."""
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def on_rate_limited(self):
+        with self._lock:
+            self.interval = min(self.interval * 2, self.MAX_INTERVAL)
+        logging.warning(f"🐢 Calendar API: превышен лимит запросов, интервал увеличен до {self.interval:.2f} сек")
+
+    def on_success(self):
+        with self._lock:
+            self.interval = max(self.base_interval, self.interval * 0.9)
+
+
+calendar_rate_limiter = CalendarRateLimiter(getattr(config, 'CALENDAR_QPS', 5))
+
+
+def is_rate_limit_error(error):
+    """Проверяет, что HttpError вызван превышением квоты (429 или 403 rateLimitExceeded)."""
+    if not isinstance(error, HttpError):
+        return False
+    status = getattr(error.resp, 'status', None)
+    if status == 429:
+        return True
+    if status == 403:
+        try:
+            reasons = [item.get('reason') for item in json.loads(error.content)['error'].get('errors', [])]
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        return bool({'rateLimitExceeded', 'userRateLimitExceeded'} & set(reasons))
+    return False
+
+
+class RateLimitedHttpRequest(HttpRequest):
+    """HttpRequest, который проходит через calendar_rate_limiter и повторяет запрос при rateLimitExceeded."""
+
+    MAX_RATE_LIMIT_RETRIES = 5
+
+    def execute(self, http=None, num_retries=0):
+        for attempt in range(self.MAX_RATE_LIMIT_RETRIES):
+            calendar_rate_limiter.acquire()
+            try:
+                result = super().execute(http=http, num_retries=num_retries)
+            except HttpError as e:
+                if is_rate_limit_error(e) and attempt < self.MAX_RATE_LIMIT_RETRIES - 1:
+                    calendar_rate_limiter.on_rate_limited()
+                    time.sleep(2 ** attempt + random.random())
+                    continue
+                raise
+            calendar_rate_limiter.on_success()
+            return result
+
 
 class GoogleCalendarService:
+    # Максимум запросов в одном batch-запросе при массовом удалении
+    DELETE_BATCH_SIZE = 50
+
     def __init__(self, credentials_path, calendar_id):
         """Инициализация сервиса Google Calendar."""
         try:
@@ -14,30 +134,94 @@ class GoogleCalendarService:
                 'https://www.googleapis.com/auth/calendar',
                 'https://www.googleapis.com/auth/calendar.events'
             ]
-            creds = service_account.Credentials.from_service_account_file(credentials_path, scopes=scope)
-            self.service = build('calendar', 'v3', credentials=creds)
+            self._credentials = service_account.Credentials.from_service_account_file(credentials_path, scopes=scope)
             self.calendar_id = calendar_id
             
+            # httplib2.Http не потокобезопасен: у каждого потока свой клиент API
+            self._local = threading.local()
+            self.max_workers = max(1, getattr(config, 'CALENDAR_MAX_WORKERS', 4))
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='calendar')
+            self._local.service = self._build_service()
+            
             logging.info("✅ Успешное подключение к Google Calendar API")
         except Exception as e:
             logging.error(f"❌ Ошибка подключения к Google Calendar: {e}")
             raise
 
-    def get_all_events(self):
-        """Получает все события из календаря с повторными попытками."""
+    def _build_service(self):
+        """Создает клиент Calendar API с собственным HTTP-транспортом и общим ограничителем запросов."""
+        http = google_auth_httplib2.AuthorizedHttp(self._credentials, http=httplib2.Http(timeout=60))
+        return build('calendar', 'v3', http=http, requestBuilder=RateLimitedHttpRequest, cache_discovery=False)
+
+    @property
+    def service(self):
+        """Клиент Calendar API текущего потока."""
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            service = self._local.service = self._build_service()
+        return service
+
+    def run_concurrently(self, func, items):
+        """Выполняет func для каждого элемента в пуле потоков Calendar API.
+
+        Результаты возвращаются в исходном порядке; func должна сама обрабатывать свои ошибки.
+        """
+        items = list(items)
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [func(item) for item in items]
+        return list(self._executor.map(func, items))
+
+    def run_grouped_concurrently(self, func, items, key):
+        """Как run_concurrently, но элементы с одинаковым key(item) выполняются по порядку в одной задаче.
+
+        Нужно, когда обработка элемента проверяет и дополняет общий индекс событий:
+        повторная строка с тем же ключом должна найти событие, созданное первой, а не
+        создать второе параллельно с ней.
+        """
+        items = list(items)
+        groups = {}
+        for position, item in enumerate(items):
+            groups.setdefault(key(item), []).append(position)
+        
+        def run_group(positions):
+            return [(position, func(items[position])) for position in positions]
+        
+        results = [None] * len(items)
+        for group_results in self.run_concurrently(run_group, list(groups.values())):
+            for position, result in group_results:
+                results[position] = result
+        return results
+
+    def _window_bound(self, day):
+        """Переводит дату в RFC3339 (начало дня по Asia/Yekaterinburg) для timeMin/timeMax."""
+        local_timezone = pytz.timezone('Asia/Yekaterinburg')
+        return local_timezone.localize(datetime.combine(day, datetime.min.time())).isoformat()
+
+    def get_all_events(self, date_from=None, date_to=None):
+        """Получает события из календаря с повторными попытками.
+
+        date_from/date_to (datetime.date) ограничивают выборку окном [date_from, date_to];
+        без них загружаются все события.
+        """
         import time
         
         max_retries = 3
         retry_delay = 2  # секунды
         
+        list_params = {
+            'calendarId': self.calendar_id,
+            'maxResults': 2500,
+            'singleEvents': True,
+            'orderBy': 'startTime',
+        }
+        if date_from:
+            list_params['timeMin'] = self._window_bound(date_from)
+        if date_to:
+            list_params['timeMax'] = self._window_bound(date_to + timedelta(days=1))
+        
         for attempt in range(max_retries):
             try:
-                events_result = self.service.events().list(
-                    calendarId=self.calendar_id,
-                    maxResults=2500,
-                    singleEvents=True,
-                    orderBy='startTime'
-                ).execute()
+                events_result = self.service.events().list(**list_params).execute()
                 events = events_result.get('items', [])
                 
                 logging.info(f"📅 Получено {len(events)} событий из календаря")
@@ -64,6 +248,43 @@ class GoogleCalendarService:
         
         return []
 
+    def index_lesson_events_outside_window(self, date_from, date_to):
+        """Индекс ID занятия -> список отдельных событий занятия вне окна [date_from, date_to].
+
+        Две выборки (до окна и после него) на всю синхронизацию вместо поиска
+        по каждому занятию. Экземпляры повторяющихся серий не включаются.
+        """
+        index = {}
+        ranges = (
+            {'timeMax': self._window_bound(date_from)},
+            {'timeMin': self._window_bound(date_to + timedelta(days=1))},
+        )
+        try:
+            for bounds in ranges:
+                page_token = None
+                while True:
+                    events_result = self.service.events().list(
+                        calendarId=self.calendar_id,
+                        maxResults=2500,
+                        singleEvents=True,
+                        pageToken=page_token,
+                        **bounds
+                    ).execute()
+                    for event in events_result.get('items', []):
+                        if event.get('recurringEventId'):
+                            continue
+                        for lesson_id in self.index_lesson_events([event]):
+                            index.setdefault(lesson_id, []).append(event)
+                    page_token = events_result.get('nextPageToken')
+                    if not page_token:
+                        break
+            logging.info(f"📅 Вне окна синхронизации найдено событий {sum(len(events) for events in index.values())} "
+                         f"для {len(index)} занятий")
+            return index
+        except Exception as e:
+            logging.error(f"❌ Ошибка при загрузке событий занятий вне окна: {e}")
+            return {}
+
     def find_event_by_lesson_id(self, lesson_id):
         """Находит событие по ID занятия."""
         try:
@@ -80,10 +301,14 @@ class GoogleCalendarService:
             logging.error(f"❌ Ошибка при поиске события по ID {lesson_id}: {e}")
             return None
 
-    def find_event_by_lesson_details(self, lesson_data, circle_name):
-        """Находит событие по деталям занятия (дата, время, ребенок, кружок)."""
+    def find_event_by_lesson_details(self, lesson_data, circle_name, events=None):
+        """Находит событие по деталям занятия (дата, время, ребенок, кружок).
+
+        Если передан уже загруженный список events, повторный запрос к API не делается.
+        """
         try:
-            events = self.get_all_events()
+            if events is None:
+                events = self.get_all_events()
             
             target_date = lesson_data.get('date', '')
             target_start_time = lesson_data.get('start_time', '')
@@ -146,6 +371,61 @@ class GoogleCalendarService:
         
         return emoji_map.get(mark, '📅')  # По умолчанию календарь, если статус не определен
 
+    def build_lesson_event_body(self, lesson_data, circle_name):
+        """Формирует тело события занятия вместе с хешем его содержимого.
+
+        Возвращает None, если дату или время занятия не удалось распарсить.
+        """
+        # Определяем эмодзи по статусу посещения
+        mark = lesson_data.get('mark', '')
+        emoji = self.get_status_emoji(mark)
+        
+        # Формируем название события: Эмодзи Ребенок - Кружок
+        summary = f"{emoji} {lesson_data['child']} - {circle_name}"
+        
+        logging.debug(f"📝 Событие занятия: отметка='{mark}', эмодзи='{emoji}', название='{summary}'")
+        
+        try:
+            # Парсим дату, время начала и окончания
+            lesson_date = datetime.strptime(lesson_data['date'], '%d.%m.%Y')
+            start_time = datetime.strptime(lesson_data['start_time'].strip(), '%H:%M').time()
+            end_time = datetime.strptime(lesson_data['end_time'].strip(), '%H:%M').time()
+        except ValueError as ve:
+            logging.error(f"❌ Не удалось парсить время: дата='{lesson_data['date']}', начало='{lesson_data['start_time']}', конец='{lesson_data['end_time']}', ошибка: {ve}")
+            return None
+        
+        # Локализуем время в часовом поясе Asia/Yekaterinburg (UTC+5)
+        local_timezone = pytz.timezone('Asia/Yekaterinburg')
+        start_datetime = local_timezone.localize(datetime.combine(lesson_date.date(), start_time))
+        end_datetime = local_timezone.localize(datetime.combine(lesson_date.date(), end_time))
+        
+        # Формируем описание с переменными для сравнения
+        description = f"""ID занятия: {lesson_data.get('lesson_id', 'N/A')}
+ID абонемента: {lesson_data.get('subscription_id', 'N/A')}
+Статус посещения: {lesson_data.get('status', 'N/A')}
+Ребенок: {lesson_data.get('child', 'N/A')}
+Отметка: {mark}
+Дата занятия: {lesson_data.get('date', 'N/A')}
+Время начала: {lesson_data.get('start_time', 'N/A')}
+Время завершения: {lesson_data.get('end_time', 'N/A')}"""
+
+        event = {
+            'summary': summary,
+            'description': description,
+            'start': {
+                'dateTime': start_datetime.isoformat(),
+                'timeZone': 'Asia/Yekaterinburg',
+            },
+            'end': {
+                'dateTime': end_datetime.isoformat(),
+                'timeZone': 'Asia/Yekaterinburg',
+            },
+        }
+        event['extendedProperties'] = {
+            'private': {PAYLOAD_HASH_KEY: compute_event_payload_hash(event)}
+        }
+        return event
+
     def remove_duplicate_events(self, child_name, circle_name, target_date, target_start_time):
         """Удаляет дублирующиеся события для одного занятия."""
         try:
@@ -260,78 +540,10 @@ class GoogleCalendarService:
         
         for attempt in range(max_retries):
             try:
-                # Определяем эмодзи по статусу посещения
-                mark = lesson_data.get('mark', '')
-                emoji = self.get_status_emoji(mark)
-                
-                # Формируем название события: Эмодзи Ребенок - Кружок
-                summary = f"{emoji} {lesson_data['child']} - {circle_name}"
-                
-                logging.info(f"📝 Создание события: отметка='{mark}', эмодзи='{emoji}', название='{summary}'")
-                
-                # Формируем дату и время
-                logging.info(f"🕐 Парсинг времени: дата='{lesson_data['date']}', начало='{lesson_data['start_time']}', конец='{lesson_data['end_time']}'")
-                
-                try:
-                    # Парсим дату
-                    lesson_date = datetime.strptime(lesson_data['date'], '%d.%m.%Y')
-                    
-                    # Парсим время начала и окончания
-                    start_time_str = lesson_data['start_time'].strip()
-                    end_time_str = lesson_data['end_time'].strip()
-                    
-                    # Пробуем парсить время
-                    start_time = datetime.strptime(start_time_str, '%H:%M').time()
-                    end_time = datetime.strptime(end_time_str, '%H:%M').time()
-                    
-                except ValueError as ve:
-                    logging.error(f"❌ Не удалось парсить время: начало='{lesson_data['start_time']}', конец='{lesson_data['end_time']}', ошибка: {ve}")
+                event = self.build_lesson_event_body(lesson_data, circle_name)
+                if event is None:
                     return None
-                
-                # Создаем datetime объекты БЕЗ часового пояса
-                start_datetime_naive = datetime.combine(lesson_date.date(), start_time)
-                end_datetime_naive = datetime.combine(lesson_date.date(), end_time)
-                
-                # Определяем часовой пояс (ваш локальный)
-                # Используем Asia/Yekaterinburg (UTC+5) вместо Europe/Moscow (UTC+3)
-                local_timezone = pytz.timezone('Asia/Yekaterinburg')
-                
-                # Локализуем время в вашем часовом поясе
-                start_datetime = local_timezone.localize(start_datetime_naive)
-                end_datetime = local_timezone.localize(end_datetime_naive)
-                
-                logging.info(f"🕐 Результат парсинга с часовым поясом: {start_datetime} - {end_datetime}")
-                
-                # Формируем описание с переменными для сравнения
-                lesson_id = lesson_data.get('lesson_id', 'N/A')
-                subscription_id = lesson_data.get('subscription_id', 'N/A')
-                status = lesson_data.get('status', 'N/A')
-                child = lesson_data.get('child', 'N/A')
-                mark = lesson_data.get('mark', '')
-                date = lesson_data.get('date', 'N/A')
-                start_time = lesson_data.get('start_time', 'N/A')
-                
-                description = f"""ID занятия: {lesson_id}
-ID абонемента: {subscription_id}
-Статус посещения: {status}
-Ребенок: {child}
-Отметка: {mark}
-Дата занятия: {date}
-Время начала: {start_time}
-Время завершения: {lesson_data.get('end_time', 'N/A')}"""
-
-                event = {
-                    'summary': summary,
-                    'description': description,
-                    'start': {
-                        'dateTime': start_datetime.isoformat(),
-                        'timeZone': 'Asia/Yekaterinburg',
-                    },
-                    'end': {
-                        'dateTime': end_datetime.isoformat(),
-                        'timeZone': 'Asia/Yekaterinburg',
-                    },
-                }
+                summary = event['summary']
 
                 created_event = self.service.events().insert(
                     calendarId=self.calendar_id, 
@@ -366,67 +578,10 @@ ID абонемента: {subscription_id}
     def update_event(self, event_id, lesson_data, circle_name):
         """Обновляет существующее событие."""
         try:
-            # Определяем эмодзи по статусу посещения
-            mark = lesson_data.get('mark', '')
-            emoji = self.get_status_emoji(mark)
-            
-            # Формируем название события: Эмодзи Ребенок - Кружок
-            summary = f"{emoji} {lesson_data['child']} - {circle_name}"
-            
-            logging.info(f"📝 Обновление события: отметка='{mark}', эмодзи='{emoji}', название='{summary}'")
-            
-            # Формируем дату и время
-            logging.info(f"🕐 Обновление времени: дата='{lesson_data['date']}', начало='{lesson_data['start_time']}', конец='{lesson_data['end_time']}'")
-            
-            lesson_date = datetime.strptime(lesson_data['date'], '%d.%m.%Y')
-            
-            # Парсим время с обработкой разных форматов
-            try:
-                start_time_str = lesson_data['start_time'].strip()
-                end_time_str = lesson_data['end_time'].strip()
-                
-                start_time = datetime.strptime(start_time_str, '%H:%M').time()
-                end_time = datetime.strptime(end_time_str, '%H:%M').time()
-                
-            except ValueError as ve:
-                logging.error(f"❌ Не удалось парсить время при обновлении: начало='{lesson_data['start_time']}', конец='{lesson_data['end_time']}', ошибка: {ve}")
+            event = self.build_lesson_event_body(lesson_data, circle_name)
+            if event is None:
                 return False
-            
-            # Создаем datetime объекты БЕЗ часового пояса
-            start_datetime_naive = datetime.combine(lesson_date.date(), start_time)
-            end_datetime_naive = datetime.combine(lesson_date.date(), end_time)
-            
-            # Определяем часовой пояс (ваш локальный)
-            local_timezone = pytz.timezone('Asia/Yekaterinburg')
-            
-            # Локализуем время в вашем часовом поясе
-            start_datetime = local_timezone.localize(start_datetime_naive)
-            end_datetime = local_timezone.localize(end_datetime_naive)
-            
-            logging.info(f"🕐 Результат парсинга при обновлении с часовым поясом: {start_datetime} - {end_datetime}")
-            
-            # Формируем описание с переменными для сравнения
-            description = f"""ID занятия: {lesson_data['lesson_id']}
-ID абонемента: {lesson_data['subscription_id']}
-Статус посещения: {lesson_data['status']}
-Ребенок: {lesson_data['child']}
-Отметка: {lesson_data['mark']}
-Дата занятия: {lesson_data['date']}
-Время начала: {lesson_data['start_time']}
-Время завершения: {lesson_data['end_time']}"""
-
-            event = {
-                'summary': summary,
-                'description': description,
-                'start': {
-                    'dateTime': start_datetime.isoformat(),
-                    'timeZone': 'Asia/Yekaterinburg',
-                },
-                'end': {
-                    'dateTime': end_datetime.isoformat(),
-                    'timeZone': 'Asia/Yekaterinburg',
-                },
-            }
+            summary = event['summary']
 
             updated_event = self.service.events().update(
                 calendarId=self.calendar_id,
@@ -441,6 +596,178 @@ ID абонемента: {lesson_data['subscription_id']}
             logging.error(f"❌ Ошибка при обновлении события {event_id}: {e}")
             return False
 
+    def build_recurring_lesson_event_body(self, slot, subscription_id, child_name, circle_name, first_date, count):
+        """Формирует тело повторяющегося события для одного слота 'Шаблон расписания'.
+
+        slot - словарь с ключами day_num (1-7), start_time, end_time.
+        Возвращает None, если время слота не удалось распарсить.
+        """
+        try:
+            start_time = datetime.strptime(slot['start_time'].strip(), '%H:%M').time()
+            end_time = datetime.strptime(slot['end_time'].strip(), '%H:%M').time()
+        except ValueError as ve:
+            logging.error(f"❌ Не удалось парсить время слота {slot}: {ve}")
+            return None
+        
+        local_timezone = pytz.timezone('Asia/Yekaterinburg')
+        start_datetime = local_timezone.localize(datetime.combine(first_date, start_time))
+        end_datetime = local_timezone.localize(datetime.combine(first_date, end_time))
+        
+        series_key = recurring_series_key(subscription_id, slot)
+        description = f"""ID абонемента: {subscription_id}
+Ребенок: {child_name}
+Слот расписания: {slot['day_num']} {slot['start_time']}-{slot['end_time']}
+Занятий в серии: {count}"""
+
+        event = {
+            'summary': f"{self.get_status_emoji('')} {child_name} - {circle_name}",
+            'description': description,
+            'start': {
+                'dateTime': start_datetime.isoformat(),
+                'timeZone': 'Asia/Yekaterinburg',
+            },
+            'end': {
+                'dateTime': end_datetime.isoformat(),
+                'timeZone': 'Asia/Yekaterinburg',
+            },
+            'recurrence': [f"RRULE:FREQ=WEEKLY;BYDAY={RRULE_WEEKDAYS[slot['day_num'] - 1]};COUNT={count}"],
+        }
+        event['extendedProperties'] = {
+            'private': {
+                PAYLOAD_HASH_KEY: compute_event_payload_hash(event),
+                SERIES_KEY: series_key,
+            }
+        }
+        return event
+
+    def get_recurring_series_events(self, date_from=None, date_to=None):
+        """Возвращает мастер-события серий занятий: ключ серии -> событие.
+
+        date_from/date_to (datetime.date) - только серии с экземплярами в окне.
+        """
+        try:
+            series = {}
+            page_token = None
+            list_params = {
+                'calendarId': self.calendar_id,
+                'maxResults': 2500,
+                'singleEvents': False,
+            }
+            if date_from:
+                list_params['timeMin'] = self._window_bound(date_from)
+            if date_to:
+                list_params['timeMax'] = self._window_bound(date_to + timedelta(days=1))
+            while True:
+                events_result = self.service.events().list(pageToken=page_token, **list_params).execute()
+                for event in events_result.get('items', []):
+                    series_key = event.get('extendedProperties', {}).get('private', {}).get(SERIES_KEY)
+                    if series_key and event.get('recurrence') and event.get('status') != 'cancelled':
+                        series[series_key] = event
+                page_token = events_result.get('nextPageToken')
+                if not page_token:
+                    break
+            
+            logging.info(f"🔁 Найдено {len(series)} повторяющихся серий занятий")
+            return series
+        except Exception as e:
+            logging.error(f"❌ Ошибка при получении повторяющихся серий: {e}")
+            return {}
+
+    def find_recurring_series_event(self, series_key):
+        """Ищет мастер-событие серии по ключу (для серий вне окна выборки) или возвращает None."""
+        try:
+            events_result = self.service.events().list(
+                calendarId=self.calendar_id,
+                singleEvents=False,
+                privateExtendedProperty=f"{SERIES_KEY}={series_key}"
+            ).execute()
+            for event in events_result.get('items', []):
+                if event.get('recurrence') and event.get('status') != 'cancelled':
+                    return event
+            return None
+        except Exception as e:
+            logging.error(f"❌ Ошибка при поиске серии {series_key}: {e}")
+            return None
+
+    def upsert_recurring_event(self, event_id, event_body):
+        """Создает серию (event_id=None) или перезаписывает существующую. Возвращает ID серии."""
+        try:
+            if event_id:
+                self.service.events().update(
+                    calendarId=self.calendar_id,
+                    eventId=event_id,
+                    body=event_body
+                ).execute()
+                logging.info(f"🔄 Обновлена серия: {event_body['summary']}")
+                return event_id
+            
+            created_event = self.service.events().insert(
+                calendarId=self.calendar_id,
+                body=event_body
+            ).execute()
+            logging.info(f"✅ Создана серия: {event_body['summary']} ({event_body['recurrence'][0]})")
+            return created_event['id']
+        except Exception as e:
+            logging.error(f"❌ Ошибка при сохранении серии {event_body.get('summary', '')}: {e}")
+            return None
+
+    def get_event_instances(self, event_id):
+        """Возвращает неотмененные экземпляры повторяющегося события."""
+        try:
+            instances = []
+            page_token = None
+            while True:
+                instances_result = self.service.events().instances(
+                    calendarId=self.calendar_id,
+                    eventId=event_id,
+                    maxResults=2500,
+                    pageToken=page_token
+                ).execute()
+                instances.extend(instances_result.get('items', []))
+                page_token = instances_result.get('nextPageToken')
+                if not page_token:
+                    return instances
+        except Exception as e:
+            logging.error(f"❌ Ошибка при получении экземпляров серии {event_id}: {e}")
+            return []
+
+    def get_instance_original_date(self, instance):
+        """Возвращает исходную дату экземпляра серии (до переноса)."""
+        original_start = instance.get('originalStartTime', {})
+        value = original_start.get('dateTime') or original_start.get('date', '')
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).date() if value else None
+
+    def patch_recurring_instance(self, instance_id, event_body):
+        """Записывает исключение для экземпляра серии (отметка, статус или перенос времени)."""
+        try:
+            self.service.events().patch(
+                calendarId=self.calendar_id,
+                eventId=instance_id,
+                body={
+                    'summary': event_body['summary'],
+                    'description': event_body['description'],
+                    'start': event_body['start'],
+                    'end': event_body['end'],
+                    'extendedProperties': event_body['extendedProperties'],
+                }
+            ).execute()
+            return True
+        except Exception as e:
+            logging.error(f"❌ Ошибка при обновлении экземпляра серии {instance_id}: {e}")
+            return False
+
+    def cancel_recurring_instance(self, instance_id):
+        """Отменяет один экземпляр серии (занятия на эту дату нет в таблице)."""
+        try:
+            self.service.events().delete(
+                calendarId=self.calendar_id,
+                eventId=instance_id
+            ).execute()
+            return True
+        except Exception as e:
+            logging.error(f"❌ Ошибка при отмене экземпляра серии {instance_id}: {e}")
+            return False
+
     def delete_event(self, event_id):
         """Удаляет событие из календаря."""
         try:
@@ -454,6 +781,49 @@ ID абонемента: {lesson_data['subscription_id']}
             logging.error(f"❌ Ошибка при удалении события {event_id}: {e}")
             return False
 
+    def delete_events(self, event_ids):
+        """Удаляет события batch-запросами Calendar API (до DELETE_BATCH_SIZE в одном запросе).
+
+        Уже удаленные (404/410) считаются удаленными, упершиеся в квоту повторяются
+        поштучно через delete_event. Возвращает список ID удаленных событий.
+        """
+        event_ids = list(dict.fromkeys(event_ids))
+        deleted = []
+        rate_limited = []
+        
+        def on_response(request_id, response, exception):
+            if exception is None:
+                deleted.append(request_id)
+            elif isinstance(exception, HttpError) and exception.resp.status in (404, 410):
+                deleted.append(request_id)
+            elif is_rate_limit_error(exception):
+                rate_limited.append(request_id)
+            else:
+                logging.error(f"❌ Ошибка при удалении события {request_id}: {exception}")
+        
+        for start in range(0, len(event_ids), self.DELETE_BATCH_SIZE):
+            chunk = event_ids[start:start + self.DELETE_BATCH_SIZE]
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for event_id in chunk:
+                batch.add(self.service.events().delete(calendarId=self.calendar_id, eventId=event_id), request_id=event_id)
+            # Каждый запрос в пакете расходует квоту как отдельный
+            for _ in chunk:
+                calendar_rate_limiter.acquire()
+            try:
+                batch.execute()
+            except Exception as e:
+                logging.error(f"❌ Ошибка batch-удаления событий: {e}")
+                done = set(deleted) | set(rate_limited)
+                rate_limited.extend(event_id for event_id in chunk if event_id not in done)
+        
+        if rate_limited:
+            calendar_rate_limiter.on_rate_limited()
+            results = self.run_concurrently(self.delete_event, rate_limited)
+            deleted.extend(event_id for event_id, ok in zip(rate_limited, results) if ok)
+        
+        logging.info(f"🗑️ Batch-удаление: удалено {len(deleted)} из {len(event_ids)} событий")
+        return deleted
+
     def delete_subscription_events(self, child_name, circle_name, subscription_id):
         """Удаляет все события абонемента из Google Calendar."""
         if not self.service:
@@ -478,36 +848,38 @@ ID абонемента: {lesson_data['subscription_id']}
             logging.info(f"📊 Найдено {len(events)} событий в календаре")
             
             # Ищем события этого абонемента
+            events_to_delete = {}
             for event in events:
+                summary = event.get('summary', '')
+                description = event.get('description', '')
+                
+                # Проверяем, относится ли событие к удаляемому абонементу
+                if (child_name in summary and circle_name in summary) or \
+                   (child_name in description and circle_name in description) or \
+                   (subscription_id in description):
+                    # Экземпляр повторяющейся серии удаляем вместе со всей серией
+                    events_to_delete.setdefault(event.get('recurringEventId', event['id']), summary)
+            
+            def delete_one(item):
+                event_id, summary = item
                 try:
-                    summary = event.get('summary', '')
-                    description = event.get('description', '')
-                    
-                    # Проверяем, относится ли событие к удаляемому абонементу
-                    if (child_name in summary and circle_name in summary) or \
-                       (child_name in description and circle_name in description) or \
-                       (subscription_id in description):
-                        
-                        event_id = event['id']
-                        
-                        # Удаляем событие
-                        self.service.events().delete(
-                            calendarId=self.calendar_id,
-                            eventId=event_id
-                        ).execute()
-                        
-                        deleted_count += 1
-                        logging.info(f"✅ Удалено событие: {summary}")
-                        
-                        # Небольшая задержка между удалениями
-                        import time
-                        time.sleep(0.1)
-                        
+                    self.service.events().delete(
+                        calendarId=self.calendar_id,
+                        eventId=event_id
+                    ).execute()
+                    logging.info(f"✅ Удалено событие: {summary}")
+                    return None
                 except Exception as e:
-                    error_msg = f"Ошибка при удалении события {event.get('id', 'unknown')}: {e}"
+                    error_msg = f"Ошибка при удалении события {event_id}: {e}"
                     logging.error(f"❌ {error_msg}")
+                    return error_msg
+            
+            # Удаляем параллельно, темп задает общий ограничитель запросов
+            for error_msg in self.run_concurrently(delete_one, events_to_delete.items()):
+                if error_msg:
                     errors.append(error_msg)
-                    continue
+                else:
+                    deleted_count += 1
             
             # Формируем результат
             if deleted_count > 0:
@@ -536,6 +908,44 @@ ID абонемента: {lesson_data['subscription_id']}
                 'message': error_msg
             }
 
+    def _index_events_by_description_key(self, events, key_prefix):
+        """Строит индекс 'значение ключа из описания' -> событие по загруженному списку."""
+        index = {}
+        for event in events:
+            for line in event.get('description', '').split('\n'):
+                if line.startswith(key_prefix):
+                    key = line.split(':', 1)[1].strip()
+                    # При дублях оставляем первое событие, дубли чистит remove_duplicate_lesson_events
+                    index.setdefault(key, event)
+                    break
+        return index
+
+    def index_lesson_events(self, events):
+        """Индекс ID занятия -> событие."""
+        return self._index_events_by_description_key(events, 'ID занятия:')
+
+    def index_forecast_events(self, events):
+        """Индекс ID прогноза -> событие."""
+        return self._index_events_by_description_key(events, 'ID прогноза:')
+
+    def event_payload_matches(self, event, event_body):
+        """Проверяет, совпадает ли сохраненный в событии хеш с хешем нового тела события."""
+        stored_hash = get_event_payload_hash(event)
+        return bool(stored_hash) and stored_hash == event_body['extendedProperties']['private'][PAYLOAD_HASH_KEY]
+
+    def set_event_payload_hash(self, event_id, event_body):
+        """Дописывает хеш в событие, созданное до появления хешей (без изменения содержимого)."""
+        try:
+            self.service.events().patch(
+                calendarId=self.calendar_id,
+                eventId=event_id,
+                body={'extendedProperties': event_body['extendedProperties']}
+            ).execute()
+            return True
+        except Exception as e:
+            logging.error(f"❌ Ошибка при записи хеша в событие {event_id}: {e}")
+            return False
+
     def extract_lesson_variables_from_event(self, event):
         """Извлекает переменные занятия из описания события."""
         try:
@@ -618,10 +1028,14 @@ ID абонемента: {lesson_data['subscription_id']}
             logging.error(f"❌ Ошибка при поиске события прогноза по ID {forecast_id}: {e}")
             return None
 
-    def find_forecast_event_by_details(self, forecast_data):
-        """Находит событие прогноза по деталям (дата, ребенок, кружок)."""
+    def find_forecast_event_by_details(self, forecast_data, events=None):
+        """Находит событие прогноза по деталям (дата, ребенок, кружок).
+
+        Если передан уже загруженный список events, повторный запрос к API не делается.
+        """
         try:
-            events = self.get_all_events()
+            if events is None:
+                events = self.get_all_events()
             
             target_date = forecast_data.get('payment_date', '')
             target_child = forecast_data.get('child', '')
@@ -676,43 +1090,10 @@ ID абонемента: {lesson_data['subscription_id']}
         
         for attempt in range(max_retries):
             try:
-                # Определяем эмодзи по статусу
-                emoji = self.get_forecast_status_emoji(forecast_data.get('status', ''))
-                
-                # Формируем название события: Эмодзи Оплата - Ребенок - Кружок
-                summary = f"{emoji} Оплата - {forecast_data['child']} - {forecast_data['circle']}"
-                
-                logging.info(f"💰 Создание события прогноза: статус='{forecast_data.get('status', '')}', эмодзи='{emoji}', название='{summary}'")
-                
-                # Парсим дату оплаты
-                try:
-                    from datetime import datetime
-                    payment_date = datetime.strptime(forecast_data['payment_date'], '%d.%m.%Y')
-                except ValueError as ve:
-                    logging.error(f"❌ Не удалось парсить дату оплаты: '{forecast_data['payment_date']}', ошибка: {ve}")
+                event = self.build_forecast_event_body(forecast_data)
+                if event is None:
                     return None
-                
-                # Формируем описание с переменными для сравнения
-                description = f"""ID прогноза: {forecast_data['forecast_id']}
-Кружок: {forecast_data['circle']}
-Ребенок: {forecast_data['child']}
-Дата оплаты: {forecast_data['payment_date']}
-Бюджет: {forecast_data['budget']}
-Статус: {forecast_data['status']}"""
-
-                # Создаем событие на весь день
-                event = {
-                    'summary': summary,
-                    'description': description,
-                    'start': {
-                        'date': payment_date.strftime('%Y-%m-%d'),
-                        'timeZone': 'Europe/Moscow',
-                    },
-                    'end': {
-                        'date': payment_date.strftime('%Y-%m-%d'),
-                        'timeZone': 'Europe/Moscow',
-                    },
-                }
+                summary = event['summary']
 
                 created_event = self.service.events().insert(
                     calendarId=self.calendar_id, 
@@ -746,43 +1127,10 @@ ID абонемента: {lesson_data['subscription_id']}
     def update_forecast_event(self, event_id, forecast_data):
         """Обновляет существующее событие прогноза."""
         try:
-            # Определяем эмодзи по статусу
-            emoji = self.get_forecast_status_emoji(forecast_data.get('status', ''))
-            
-            # Формируем название события: Эмодзи Оплата - Ребенок - Кружок
-            summary = f"{emoji} Оплата - {forecast_data['child']} - {forecast_data['circle']}"
-            
-            logging.info(f"💰 Обновление события прогноза: статус='{forecast_data.get('status', '')}', эмодзи='{emoji}', название='{summary}'")
-            
-            # Парсим дату оплаты
-            try:
-                from datetime import datetime
-                payment_date = datetime.strptime(forecast_data['payment_date'], '%d.%m.%Y')
-            except ValueError as ve:
-                logging.error(f"❌ Не удалось парсить дату оплаты при обновлении: '{forecast_data['payment_date']}', ошибка: {ve}")
+            event = self.build_forecast_event_body(forecast_data)
+            if event is None:
                 return False
-            
-            # Формируем описание с переменными для сравнения
-            description = f"""ID прогноза: {forecast_data['forecast_id']}
-Кружок: {forecast_data['circle']}
-Ребенок: {forecast_data['child']}
-Дата оплаты: {forecast_data['payment_date']}
-Бюджет: {forecast_data['budget']}
-Статус: {forecast_data['status']}"""
-
-            # Обновляем событие на весь день
-            event = {
-                'summary': summary,
-                'description': description,
-                'start': {
-                    'date': payment_date.strftime('%Y-%m-%d'),
-                    'timeZone': 'Europe/Moscow',
-                },
-                'end': {
-                    'date': payment_date.strftime('%Y-%m-%d'),
-                    'timeZone': 'Europe/Moscow',
-                },
-            }
+            summary = event['summary']
 
             updated_event = self.service.events().update(
                 calendarId=self.calendar_id,
@@ -810,6 +1158,51 @@ ID абонемента: {lesson_data['subscription_id']}
         
         return emoji_map.get(status, '💰')  # По умолчанию деньги
 
+    def build_forecast_event_body(self, forecast_data):
+        """Формирует тело события прогноза (на весь день) вместе с хешем его содержимого.
+
+        Возвращает None, если дату оплаты не удалось распарсить.
+        """
+        # Определяем эмодзи по статусу
+        emoji = self.get_forecast_status_emoji(forecast_data.get('status', ''))
+        
+        # Формируем название события: Эмодзи Оплата - Ребенок - Кружок
+        summary = f"{emoji} Оплата - {forecast_data['child']} - {forecast_data['circle']}"
+        
+        logging.debug(f"💰 Событие прогноза: статус='{forecast_data.get('status', '')}', эмодзи='{emoji}', название='{summary}'")
+        
+        # Парсим дату оплаты
+        try:
+            payment_date = datetime.strptime(forecast_data['payment_date'], '%d.%m.%Y')
+        except ValueError as ve:
+            logging.error(f"❌ Не удалось парсить дату оплаты: '{forecast_data['payment_date']}', ошибка: {ve}")
+            return None
+        
+        # Формируем описание с переменными для сравнения
+        description = f"""ID прогноза: {forecast_data['forecast_id']}
+Кружок: {forecast_data['circle']}
+Ребенок: {forecast_data['child']}
+Дата оплаты: {forecast_data['payment_date']}
+Бюджет: {forecast_data['budget']}
+Статус: {forecast_data['status']}"""
+
+        event = {
+            'summary': summary,
+            'description': description,
+            'start': {
+                'date': payment_date.strftime('%Y-%m-%d'),
+                'timeZone': 'Europe/Moscow',
+            },
+            'end': {
+                'date': payment_date.strftime('%Y-%m-%d'),
+                'timeZone': 'Europe/Moscow',
+            },
+        }
+        event['extendedProperties'] = {
+            'private': {PAYLOAD_HASH_KEY: compute_event_payload_hash(event)}
+        }
+        return event
+
     def extract_forecast_variables_from_event(self, event):
         """Извлекает переменные прогноза из описания события."""
         try:
@@ -898,32 +1291,9 @@ ID абонемента: {lesson_data['subscription_id']}
                     
                     logging.info(f"🎯 Найдено {len(forecast_events)} событий прогноза для удаления")
                     
-                    # Удаляем события с небольшими паузами
-                    for i, event in enumerate(forecast_events):
-                        try:
-                            event_id = event['id']
-                            event_summary = event.get('summary', 'Без названия')
-                            
-                            logging.info(f"🗑️ Удаляю событие прогноза ({i+1}/{len(forecast_events)}): {event_summary}")
-                            
-                            self.service.events().delete(
-                                calendarId=self.calendar_id,
-                                eventId=event_id
-                            ).execute()
-                            
-                            deleted_count += 1
-                            logging.info(f"✅ Удалено событие прогноза: {event_summary}")
-                            
-                            # Небольшая пауза между удалениями для избежания лимитов API
-                            if i < len(forecast_events) - 1:  # Не ждем после последнего
-                                time.sleep(0.5)
-                                
-                        except (ConnectionResetError, ConnectionError, TimeoutError) as network_error:
-                            logging.warning(f"🔄 Сетевая ошибка при удалении события {event.get('id', 'N/A')}: {network_error}")
-                            continue
-                        except Exception as e:
-                            logging.error(f"❌ Ошибка при удалении события прогноза {event.get('id', 'N/A')}: {e}")
-                            continue
+                    # Удаляем параллельно, темп задает общий ограничитель запросов
+                    results = self.run_concurrently(self.delete_event, [event['id'] for event in forecast_events])
+                    deleted_count += sum(1 for deleted in results if deleted)
                     
                     logging.info(f"🎉 Удаление завершено: удалено {deleted_count} событий прогноза")
                     return deleted_count
@@ -953,97 +1323,15 @@ ID абонемента: {lesson_data['subscription_id']}
             logging.error(f"❌ Критическая ошибка при удалении всех событий прогноза: {e}")
             return 0
 
-    def remove_duplicate_lesson_events(self):
-        """Удаляет дублирующиеся события занятий с одинаковым ID занятия."""
+    def remove_duplicate_lesson_events(self, date_from=None, date_to=None):
+        """Удаляет дублирующиеся события занятий (в окне дат, если задано) через общий движок очистки дублей.
+
+        События прогноза и старые события расписания не трогает - их чистит clean_duplicate_events.
+        """
         try:
-            deleted_count = 0
-            events = self.get_all_events()
-            
-            logging.info(f"🔍 Поиск дублей занятий среди {len(events)} событий...")
-            
-            # Группируем события по ID занятия
-            lesson_events = {}
-            for event in events:
-                description = event.get('description', '')
-                if "ID занятия:" in description:
-                    # Извлекаем ID занятия
-                    for line in description.split('\n'):
-                        if line.startswith('ID занятия:'):
-                            lesson_id = line.split(':', 1)[1].strip()
-                            if lesson_id not in lesson_events:
-                                lesson_events[lesson_id] = []
-                            lesson_events[lesson_id].append(event)
-                            break
-            
-            # Ищем дубли
-            for lesson_id, events_list in lesson_events.items():
-                if len(events_list) > 1:
-                    logging.info(f"🔍 Найдено {len(events_list)} дублей для занятия ID {lesson_id}")
-                    
-                    # Выбираем самое актуальное событие для сохранения
-                    # Приоритет: 1) с непустой отметкой, 2) последнее по времени обновления
-                    best_event = None
-                    best_priority = -1
-                    
-                    for event in events_list:
-                        description = event.get('description', '')
-                        mark = ''
-                        
-                        # Извлекаем отметку из описания
-                        for line in description.split('\n'):
-                            if line.startswith('Отметка:'):
-                                mark = line.split(':', 1)[1].strip()
-                                break
-                        
-                        # Определяем приоритет события
-                        priority = 0
-                        if mark and mark not in ['', 'N/A']:
-                            priority = 2  # Высокий приоритет для событий с отметкой
-                        else:
-                            priority = 1  # Низкий приоритет для событий без отметки
-                        
-                        # Если приоритет выше или равен, проверяем время обновления
-                        if priority > best_priority:
-                            best_event = event
-                            best_priority = priority
-                        elif priority == best_priority:
-                            # Если приоритет одинаковый, выбираем последнее обновленное
-                            if best_event:
-                                best_updated = best_event.get('updated', '')
-                                current_updated = event.get('updated', '')
-                                if current_updated > best_updated:
-                                    best_event = event
-                            else:
-                                best_event = event
-                    
-                    logging.info(f"✅ Выбрано для сохранения: {best_event.get('summary', 'Без названия')} (приоритет: {best_priority})")
-                    
-                    # Удаляем все события кроме лучшего
-                    events_to_delete = [e for e in events_list if e['id'] != best_event['id']]
-                    
-                    for event in events_to_delete:
-                        try:
-                            event_summary = event.get('summary', 'Без названия')
-                            logging.info(f"🗑️ Удаляю дубль занятия: {event_summary} (ID занятия: {lesson_id})")
-                            
-                            self.service.events().delete(
-                                calendarId=self.calendar_id,
-                                eventId=event['id']
-                            ).execute()
-                            
-                            deleted_count += 1
-                            logging.info(f"✅ Удален дубль: {event_summary}")
-                            
-                            # Пауза между удалениями
-                            import time
-                            time.sleep(0.5)
-                            
-                        except Exception as e:
-                            logging.error(f"❌ Ошибка при удалении дубля события {event.get('id', 'N/A')}: {e}")
-            
-            logging.info(f"🎉 Очистка дублей завершена: удалено {deleted_count} дублирующихся событий")
-            return deleted_count
-            
+            stats = DuplicateCleanupEngine(calendar_service=self).clean_calendar(date_from, date_to, kinds=('lesson',))
+            logging.info(f"🎉 Очистка дублей завершена: удалено {stats['deleted']} дублирующихся событий")
+            return stats['deleted']
         except Exception as e:
             logging.error(f"❌ Ошибка при удалении дублей занятий: {e}")
             return 0
@@ -1,13 +1,17 @@
 import gspread
 from google.oauth2 import service_account
+import hashlib
 import json
 import logging
 import os
 from datetime import datetime, timedelta
 import re
+import threading
 import time
 # Google Calendar API импорты
 import config
+from duplicate_cleanup import DuplicateCleanupEngine, default_calendar_window
+from lesson_index import LessonDateIndex
 
 # Импортируем Google Calendar сервис
 try:
@@ -18,6 +22,13 @@ except Exception as e:
     logging.warning(f"⚠️ Google Calendar сервис не доступен: {e}")
 
 class GoogleSheetsService:
+    # Кешированные представления листов, которые сбрасываются при записи в лист
+    SHEET_VIEW_CACHE_KEYS = {
+        'Абонементы': ('subscriptions_data', 'active_subscriptions'),
+        'Шаблон расписания': ('schedule_templates',),
+        'Прогноз': ('forecast_records',),
+    }
+
     def __init__(self, credentials_path, sheet_name):
         """Инициализация сервиса Google Sheets."""
         try:
@@ -39,8 +50,17 @@ class GoogleSheetsService:
             # Инициализируем кеш для снижения нагрузки на API
             self._cache = {}
             self._cache_ttl = {}
+            self._cache_loaded_at = {}
+            self._data_digests = {}  # ключ кеша -> (последние загруженные данные, дайджест или None - пересчитать)
             self._default_cache_duration = 30  # Кеш на 30 секунд по умолчанию
             
+            # Индекс занятий по датам для календаря бота (обновляется точечно)
+            self.lesson_index = LessonDateIndex()
+            self.lesson_index.add_listener(self._on_lessons_changed)
+            
+            # Подписчики на изменения листов 'Прогноз' и 'Оплачено' (метрики дашборда)
+            self._payment_listeners = []
+            
             logging.info("✅ Google Sheets сервис успешно инициализирован (с кешированием)")
             
             # Используем глобальный экземпляр Google Calendar Service
@@ -81,8 +101,29 @@ class GoogleSheetsService:
             duration = self._default_cache_duration
         self._cache[key] = data
         self._cache_ttl[key] = time.time() + duration
+        self._cache_loaded_at[key] = time.time()
+        previous = self._data_digests.get(key)
+        if previous is None or previous[0] is not data:
+            self._data_digests[key] = (data, None)
         logging.debug(f"💾 Данные '{key}' сохранены в кеш на {duration} сек")
     
+    def data_digest(self, key):
+        """SHA-256 содержимого ключа кеша: зависит только от данных, поэтому не меняется после перезапуска."""
+        entry = self._data_digests.get(key, (None, None))
+        data, digest = entry
+        if digest is None:
+            digest = hashlib.sha256(repr(data).encode('utf-8')).hexdigest()
+            # Данные могли смениться, пока считался дайджест - тогда его не запоминаем
+            if self._data_digests.get(key) is entry:
+                self._data_digests[key] = (data, digest)
+        return digest
+    
+    def _on_lessons_changed(self, lessons, rebuilt=False):
+        # Отметки и новые занятия меняют занятия календаря на месте, без перезагрузки листа
+        if not rebuilt:
+            data, _ = self._data_digests.get('calendar_lessons', (None, None))
+            self._data_digests['calendar_lessons'] = (data, None)
+    
     def _clear_cache(self, key=None):
         """Очищает кеш (полностью или конкретный ключ)."""
         if key:
@@ -96,6 +137,54 @@ class GoogleSheetsService:
             self._cache_ttl.clear()
             logging.debug("🗑️ Весь кеш очищен")
     
+    def export_cache(self, loaded_after=None):
+        """Записи кеша для сохранения на диск: {ключ: (данные, время загрузки)}.
+
+        loaded_after - брать только данные, загруженные после этого момента (unix time).
+        """
+        entries = {}
+        for key, data in list(self._cache.items()):
+            loaded_at = self._cache_loaded_at.get(key)
+            if loaded_at is None or (loaded_after is not None and loaded_at < loaded_after):
+                continue
+            entries[key] = (data, loaded_at)
+        return entries
+    
+    def import_cache(self, entries, duration=None):
+        """Восстанавливает записи кеша (из export_cache) и перестраивает индекс занятий."""
+        for key, (data, loaded_at) in entries.items():
+            self._save_to_cache(key, data, duration)
+            self._cache_loaded_at[key] = loaded_at
+        if 'calendar_lessons' in entries:
+            self.lesson_index.rebuild(entries['calendar_lessons'][0])
+        return len(entries)
+    
+    def add_payments_listener(self, listener):
+        """Подписывает listener(sheet_name, added, removed) на изменения листов 'Прогноз' и 'Оплачено'.
+
+        added/removed - строки листа (списки значений A-E), added=None - лист
+        переписан целиком и должен быть перечитан.
+        """
+        self._payment_listeners.append(listener)
+
+    def _sheet_written(self, *sheet_names):
+        """Сбрасывает кешированные представления листов после записи в них."""
+        for sheet_name in sheet_names:
+            for key in self.SHEET_VIEW_CACHE_KEYS.get(sheet_name, ()):
+                self._clear_cache(key)
+
+    def _payments_changed(self, sheet_name, added=None, removed=()):
+        self._sheet_written(sheet_name)
+        for listener in self._payment_listeners:
+            try:
+                listener(sheet_name, added, removed)
+            except Exception as e:
+                logging.error(f"❌ Ошибка подписчика изменений оплат: {e}")
+
+    def get_revision(self):
+        """Версия таблицы: время последнего изменения по Drive API (ISO-строка)."""
+        return self.spreadsheet.get_lastUpdateTime()
+    
     def handle_network_error(self, e, operation_name="операции"):
         """Обрабатывает сетевые ошибки и возвращает понятное сообщение."""
         import httpx
@@ -121,9 +210,17 @@ class GoogleSheetsService:
             logging.error(f"❌ Неизвестная ошибка при {operation_name}: {e}")
             return f"❌ Произошла ошибка при {operation_name}: {error_msg}"
 
-    def get_active_subscriptions(self):
-        """Загружает все абонементы со статусом 'Активен' или 'Ожидает'."""
+    def get_active_subscriptions(self, use_cache=False):
+        """Загружает все абонементы со статусом 'Активен' или 'Ожидает'.
+
+        use_cache=True - для экранов просмотра: берет список, загруженный
+        (или предзагруженный) за последние 30 секунд.
+        """
         try:
+            if use_cache:
+                cached_data = self._get_from_cache('active_subscriptions')
+                if cached_data is not None:
+                    return cached_data
             worksheet = self.spreadsheet.worksheet("Абонементы")
             all_values = worksheet.get_all_values()
             if not all_values: return []
@@ -139,6 +236,7 @@ class GoogleSheetsService:
                 sub for sub in records 
                 if str(sub.get('Статус', '')).strip().lower() in ['активен', 'ожидает']
             ]
+            self._save_to_cache('active_subscriptions', active_subs)
             return active_subs
         except gspread.exceptions.WorksheetNotFound:
             logging.error("Ошибка: Лист 'Абонементы' не найден.")
@@ -190,6 +288,7 @@ class GoogleSheetsService:
                 subs_sheet = self.spreadsheet.worksheet("Абонементы")
                 cell = subs_sheet.find(str(subscription_id))
                 subs_sheet.delete_rows(cell.row)
+                self._sheet_written('Абонементы')
                 deleted_counts['Абонементы'] = 1
                 logging.info(f"✅ Удален абонемент из листа 'Абонементы'")
             except gspread.exceptions.CellNotFound: 
@@ -211,6 +310,9 @@ class GoogleSheetsService:
                 if rows_to_delete:
                     for row_index in sorted(rows_to_delete, reverse=True):
                         cal_sheet.delete_rows(row_index)
+                    # Номера строк сдвинулись - индекс занятий перестроится при следующем обращении
+                    self.lesson_index.invalidate()
+                    self._clear_cache('calendar_lessons')
                     deleted_counts['Календарь занятий'] = len(rows_to_delete)
                     logging.info(f"✅ Удалено {len(rows_to_delete)} занятий из 'Календарь занятий'")
                 else:
@@ -232,6 +334,7 @@ class GoogleSheetsService:
                 if rows_to_delete:
                     for row_index in sorted(rows_to_delete, reverse=True):
                         template_sheet.delete_rows(row_index)
+                    self._sheet_written('Шаблон расписания')
                     deleted_counts['Шаблон расписания'] = len(rows_to_delete)
                     logging.info(f"✅ Удалено {len(rows_to_delete)} записей из 'Шаблон расписания'")
                 else:
@@ -285,6 +388,7 @@ class GoogleSheetsService:
                             for row_index in sorted(rows_to_delete, reverse=True):
                                 forecast_sheet.delete_rows(row_index)
                             deleted_counts['Прогноз'] = len(rows_to_delete)
+                            self._payments_changed('Прогноз')
                             logging.info(f"✅ Удалено {len(rows_to_delete)} записей из 'Прогноз'")
                         else:
                             logging.warning("⚠️ Нет записей для удаления в 'Прогноз' - проверьте точность имен")
@@ -324,6 +428,7 @@ class GoogleSheetsService:
                             for row_index in sorted(rows_to_delete, reverse=True):
                                 paid_sheet.delete_rows(row_index)
                             deleted_counts['Оплачено'] = len(rows_to_delete)
+                            self._payments_changed('Оплачено')
                             logging.info(f"✅ Удалено {len(rows_to_delete)} записей из 'Оплачено'")
                         else:
                             logging.info("ℹ️ Нет записей для удаления в 'Оплачено'")
@@ -749,6 +854,7 @@ class GoogleSheetsService:
                     entry[0] = next_available_id + i  # Уникальные ID начиная с next_available_id
                 
                 cal_sheet.append_rows(new_cal_entries, value_input_option='USER_ENTERED')
+                self.lesson_index.add_rows(new_cal_entries)
                 logging.info(f"✅ Создано {len(new_cal_entries)} занятий с уникальными ID от {next_available_id} до {next_available_id + len(new_cal_entries) - 1}")
                 logging.info(f"📋 Абонемент {sub_id}: занятия получили фиксированные ID, которые не будут изменяться")
 
@@ -785,6 +891,7 @@ class GoogleSheetsService:
                 next_template_id += 1  # Увеличиваем для следующей записи
             if template_entries:
                 template_sheet.append_rows(template_entries, value_input_option='USER_ENTERED')
+                self._sheet_written('Шаблон расписания')
                 logging.info(f"✅ Создано {len(template_entries)} записей в шаблоне расписания для абонемента {sub_id}")
                 for i, entry in enumerate(template_entries):
                     logging.info(f"  📋 Запись {i+1}: ID={entry[0]}, День={entry[2]}, Время={entry[3]}-{entry[4]}")
@@ -835,6 +942,7 @@ class GoogleSheetsService:
             logging.info(f"📋 Создаю строку абонемента: столбец O (индекс 14) = '{payment_type}'")
             
             subs_sheet.append_row(new_row, value_input_option='USER_ENTERED')
+            self._sheet_written('Абонементы')
             
             # Создаем прогноз оплат только для НЕ разовых абонементов
             if sub_data['sub_type'].lower() != 'разовый':
@@ -1302,6 +1410,8 @@ class GoogleSheetsService:
                 logging.info(f"✅ Записано {len(forecast_rows)} строк в лист 'Прогноз'")
             else:
                 logging.info("ℹ️ Нет данных для записи в прогноз")
+            # Лист очищен и записан заново
+            self._payments_changed('Прогноз')
             
             # Шаг 5: Обновляем "Дата окончания прогноз" в листе "Абонементы"
             logging.info("Шаг 5: Обновление дат окончания прогноз в абонементах...")
@@ -1344,6 +1454,7 @@ class GoogleSheetsService:
                                     
                                     # Обновляем столбец L (индекс 11) - Дата окончания прогноз
                                     subs_sheet.update_cell(i, 12, next_payment_date)  # L:L = колонка 12
+                                    self._sheet_written('Абонементы')
                                     updated_subscriptions += 1
                                     logging.info(f"✅ Обновлена дата окончания прогноз для {latest_sub['sub_id']}: {next_payment_date}")
                                     break
@@ -1469,6 +1580,9 @@ class GoogleSheetsService:
             for row_num in reversed(rows_to_delete):
                 calendar_sheet.delete_rows(row_num)
                 logging.debug(f"Удалена строка {row_num} для абонемента {sub_id}")
+            if rows_to_delete:
+                self.lesson_index.invalidate()
+                self._clear_cache('calendar_lessons')
             
             # Создаем новые записи календаря
             calendar_rows = []
@@ -1520,6 +1634,7 @@ class GoogleSheetsService:
             # Записываем все строки календаря
             if calendar_rows:
                 calendar_sheet.append_rows(calendar_rows, value_input_option='RAW')
+                self.lesson_index.add_rows(calendar_rows)
                 logging.debug(f"Добавлено {len(calendar_rows)} занятий для абонемента {sub_id}")
             
             return True
@@ -1861,6 +1976,7 @@ class GoogleSheetsService:
                         range_name = f"A{row_index}:O{row_index}"
                         subs_sheet.update(range_name, [row_data], value_input_option='RAW')
                         
+                    self._sheet_written('Абонементы')
                     logging.info(f"Обновлено {len(subscription_updates)} строк в листе 'Абонементы'")
                     
                 except Exception as e:
@@ -2483,6 +2599,9 @@ class GoogleSheetsService:
                 for row_index in sorted(rows_to_delete, reverse=True):
                     forecast_sheet.delete_rows(row_index)
                 
+                self._payments_changed('Оплачено', added=rows_to_transfer)
+                self._payments_changed('Прогноз', added=[], removed=[all_data[i - 1] for i in rows_to_delete])
+                
                 logging.info(f"✅ Перенесено {len(rows_to_transfer)} оплат из Прогноз в Оплачено для {child_name} - {circle_name}")
                 return f"✅ Перенесено {len(rows_to_transfer)} оплат в 'Оплачено'"
             else:
@@ -2518,6 +2637,8 @@ class GoogleSheetsService:
             for row_index in sorted(rows_to_delete, reverse=True):
                 forecast_sheet.delete_rows(row_index)
                 deleted_count += 1
+            if deleted_count:
+                self._payments_changed('Прогноз', added=[], removed=[all_data[i - 1] for i in rows_to_delete])
             
             return f"✅ Удалено {deleted_count} прогнозных оплат для {child_name} - {circle_name}"
             
@@ -2557,6 +2678,7 @@ class GoogleSheetsService:
             # Добавляем новые строки в шаблон
             if new_template_rows:
                 template_sheet.append_rows(new_template_rows, value_input_option='RAW')
+                self._sheet_written('Шаблон расписания')
                 logging.info(f"✅ Создано {len(new_template_rows)} записей в шаблоне расписания для абонемента {new_sub_id}")
                 return True
             else:
@@ -2647,6 +2769,7 @@ class GoogleSheetsService:
                 
                 # Сохраняем в кеш на 30 секунд
                 self._save_to_cache(cache_key, data, duration=30)
+                self.lesson_index.rebuild(data)
                 
                 return data
             else:
@@ -2656,6 +2779,18 @@ class GoogleSheetsService:
             logging.error(f"❌ Ошибка при получении календаря занятий: {e}", exc_info=True)
             return []
 
+    def get_lesson_date_index(self):
+        """Возвращает индекс занятий по датам, перестраивая его из листа, если он не построен или устарел."""
+        max_age = getattr(config, 'LESSON_INDEX_MAX_AGE', 300)
+        age = self.lesson_index.age()
+        if age is None or age > max_age:
+            lessons = self.get_calendar_lessons()
+            # Данные могли прийти из кеша - тогда индекс по ним еще не перестроен
+            age = self.lesson_index.age()
+            if age is None or age > max_age:
+                self.lesson_index.rebuild(lessons)
+        return self.lesson_index
+
     def get_subscriptions_data(self):
         """Получает данные абонементов для дашборда (с кешированием)."""
         try:
@@ -2682,6 +2817,25 @@ class GoogleSheetsService:
             logging.error(f"❌ Ошибка при получении данных абонементов: {e}", exc_info=True)
             return []
 
+    def get_forecast_records(self):
+        """Получает строки листа 'Прогноз' (с кешированием)."""
+        try:
+            cache_key = 'forecast_records'
+            cached_data = self._get_from_cache(cache_key)
+            if cached_data is not None:
+                return cached_data
+            
+            forecast_sheet = self.spreadsheet.worksheet("Прогноз")
+            data = forecast_sheet.get_all_records()
+            logging.info(f"✅ Загружено {len(data)} строк прогноза")
+            
+            self._save_to_cache(cache_key, data, duration=30)
+            return data
+            
+        except Exception as e:
+            logging.error(f"❌ Ошибка при получении прогноза: {e}", exc_info=True)
+            return []
+
     def get_lessons_by_subscription(self, subscription_id):
         """Получает занятия для конкретного абонемента с номерами строк."""
         try:
@@ -2717,6 +2871,84 @@ class GoogleSheetsService:
             logging.error(f"Ошибка при получении занятий для абонемента {subscription_id}: {e}")
             return []
 
+    # Статус посещения (столбец E), который ставится вместе с отметкой
+    LESSON_MARK_STATUSES = {
+        'посещение': 'Завершен',
+        'пропуск (по вине)': 'Пропуск',
+        'отмена (болезнь)': 'Пропуск',
+        'перенос': 'Пропуск'
+    }
+
+    # Отметки разового абонемента, после которых нужен выбор переноса
+    RAZOVIY_TRANSFER_MARKS = ('пропуск (по вине)', 'отмена (болезнь)', 'перенос')
+
+    def find_lesson_in_memory(self, lesson_id):
+        """Находит занятие в загруженном календаре по тем же правилам, что и update_lesson_mark.
+
+        Возвращает словарь занятия из get_calendar_lessons() (кеш или одно чтение листа) или None.
+        """
+        lessons = self.get_calendar_lessons()
+        if not lessons:
+            return None
+        
+        lesson_id = str(lesson_id).strip()
+        if '_' in lesson_id and len(lesson_id.split('_')) >= 3:
+            parts = lesson_id.split('_')
+            try:
+                target_index = int(parts[1])
+            except ValueError:
+                return None
+            target_date, target_child = parts[0], '_'.join(parts[2:])
+            matches = [
+                lesson for lesson in lessons
+                if str(lesson.get('Дата занятия', '')).strip() == target_date
+                and str(lesson.get('Ребенок', '')).strip() == target_child
+            ]
+            return matches[target_index] if target_index < len(matches) else None
+        
+        # Столбец A (ID занятия) - первый заголовок листа
+        id_header = next(iter(lessons[0]))
+        for lesson in lessons:
+            if str(lesson.get(id_header, '')).strip() == lesson_id:
+                return lesson
+        
+        # Как и update_lesson_mark, пробуем ID как номер строки (строка 2 - первая запись)
+        if lesson_id.isdigit() and 2 <= int(lesson_id) <= len(lessons) + 1:
+            return lessons[int(lesson_id) - 2]
+        return None
+
+    def apply_lesson_mark_in_memory(self, lesson, mark):
+        """Проставляет отметку и статус в загруженном занятии, пока запись в таблицу идет в фоне."""
+        lesson['Отметка'] = mark
+        lesson['Статус посещения'] = self.LESSON_MARK_STATUSES.get(mark.lower(), 'Запланировано')
+        self.lesson_index.lesson_changed(lesson)
+        return lesson
+
+    def revert_lesson_mark_in_memory(self, lesson_id, mark, previous_mark, previous_status):
+        """Возвращает занятию в памяти прежние отметку и статус, если запись отметки mark не удалась.
+
+        Занятие не трогается, если его отметка уже другая (календарь перечитан или отметка изменена).
+        """
+        lesson = self.find_lesson_in_memory(lesson_id)
+        if lesson is None or str(lesson.get('Отметка', '')).strip() != mark:
+            return None
+        lesson['Отметка'] = previous_mark
+        lesson['Статус посещения'] = previous_status
+        self.lesson_index.lesson_changed(lesson)
+        logging.info(f"↩️ Отметка занятия {lesson_id} в памяти возвращена к '{previous_mark}'")
+        return lesson
+
+    def needs_transfer_choice(self, lesson, mark):
+        """Нужен ли выбор переноса (разовый абонемент + отметка пропуска/отмены/переноса)."""
+        if mark.lower() not in self.RAZOVIY_TRANSFER_MARKS:
+            return False
+        subscription_id = str(lesson.get('ID абонемента', '')).strip()
+        for sub in self.get_subscriptions_data():
+            if str(sub.get('ID абонемента', '')).strip() == subscription_id:
+                return str(sub.get('Тип абонемента', '')).strip().lower() == 'разовый'
+        # Абонемент не найден - решает синхронный путь update_lesson_mark
+        return True
+
     def update_lesson_mark(self, lesson_id, mark):
         """Обновляет отметку посещения для занятия по ID."""
         try:
@@ -2774,15 +3006,10 @@ class GoogleSheetsService:
             logging.info(f"✅ Обновлена отметка для занятия (строка {lesson_row}, столбец G): {mark}")
             
             # Обновляем статус посещения в столбце E
-            status_map = {
-                'посещение': 'Завершен',
-                'пропуск (по вине)': 'Пропуск',
-                'отмена (болезнь)': 'Пропуск',
-                'перенос': 'Пропуск'
-            }
-            new_status = status_map.get(mark.lower(), 'Запланировано')
+            new_status = self.LESSON_MARK_STATUSES.get(mark.lower(), 'Запланировано')
             calendar_sheet.update_cell(lesson_row, 5, new_status)
             logging.info(f"✅ Обновлен статус для занятия (строка {lesson_row}, столбец E): {new_status}")
+            self.lesson_index.set_mark(lesson_row, mark, new_status)
             
             # Получаем данные занятия для проверки типа абонемента
             lesson_data_row = data[lesson_row - 1]  # -1 потому что lesson_row начинается с 1
@@ -2911,6 +3138,7 @@ class GoogleSheetsService:
                             subs_sheet.update_cell(cell.row, status_col, 'Завершен')
                         else:
                             subs_sheet.update_cell(cell.row, status_col, 'Активен')
+                    self._sheet_written('Абонементы')
                     
                     logging.info(f"📊 Обновлено 'Осталось занятий' для {subscription_id}: {current_remaining} → {new_remaining}")
                     return True
@@ -3045,6 +3273,7 @@ class GoogleSheetsService:
                     ]
                     
                     calendar_sheet.append_row(lesson_data)
+                    self.lesson_index.add_rows([lesson_data])
                     created_lessons += 1
                     logging.info(f"📅 Создано занятие {subscription_id} на {current_date} с ID {unique_id}")
                 
@@ -3128,6 +3357,7 @@ class GoogleSheetsService:
                 ]
                 
                 forecast_sheet.append_row(forecast_data)
+                self._payments_changed('Прогноз', added=[forecast_data])
                 logging.info(f"💰 Создана запись прогноза для {subscription_id}: {month_key}, {total_budget} руб.")
             
             return True
@@ -3274,6 +3504,7 @@ class GoogleSheetsService:
             
             # Добавляем строку в календарь
             calendar_sheet.append_row(new_lesson)
+            self.lesson_index.add_rows([new_lesson])
             
             logging.info(f"✅ Добавлено замещающее занятие: ID={next_id}, Дата={lesson_date.strftime('%d.%m.%Y')}, Ребенок={child_name}")
             
@@ -3327,6 +3558,7 @@ class GoogleSheetsService:
                     
                     # Обновляем столбец M (пропущенные занятия)
                     subs_sheet.update_cell(i, 13, new_missed)  # 13 = столбец M
+                    self._sheet_written('Абонементы')
                     logging.info(f"✅ Обновлена статистика разового абонемента {subscription_id}: пропущено {new_missed}")
                     return True
             
@@ -3374,6 +3606,7 @@ class GoogleSheetsService:
                             row_child == str(child_name).strip() and 
                             row_date == str(lesson_date).strip()):
                             forecast_sheet.delete_rows(i)
+                            self._payments_changed('Прогноз', added=[], removed=[row])
                             logging.info(f"✅ Удалена запись из 'Прогноз' (строка {i}): {child_name} - {circle_name} на {lesson_date}")
                             found_in_forecast = True
                             break
@@ -3409,6 +3642,7 @@ class GoogleSheetsService:
             # Создаем новую запись в "Оплачено"
             new_row = [circle_name, child_name, lesson_date, cost, "Оплачено"]
             paid_sheet.append_row(new_row, value_input_option='USER_ENTERED')
+            self._payments_changed('Оплачено', added=[new_row])
             
             logging.info(f"✅ Создана запись в 'Оплачено': {child_name} - {circle_name}, дата {lesson_date}, сумма {cost}")
             
@@ -3420,56 +3654,16 @@ class GoogleSheetsService:
 
     def cleanup_forecast_duplicates(self):
         """
-        Удаляет из листа 'Прогноз' все записи, которые уже есть в листе 'Оплачено'.
+        Удаляет из листа 'Прогноз' все записи, которые уже есть в листе 'Оплачено', и повторы внутри прогноза.
         Эта функция нужна для очистки старых записей, которые не были удалены автоматически.
         """
         try:
             logging.info("🧹 Начало очистки дубликатов между 'Прогноз' и 'Оплачено'...")
-            
-            # Получаем данные из обоих листов
-            try:
-                forecast_sheet = self.spreadsheet.worksheet("Прогноз")
-                paid_sheet = self.spreadsheet.worksheet("Оплачено")
-            except Exception as e:
-                logging.error(f"❌ Не удалось получить листы 'Прогноз' или 'Оплачено': {e}")
-                return 0
-            
-            forecast_data = forecast_sheet.get_all_values()
-            paid_data = paid_sheet.get_all_values()
-            
-            if len(forecast_data) < 2 or len(paid_data) < 2:
-                logging.info("ℹ️ Нет данных для проверки")
-                return 0
-            
-            # Создаем набор оплаченных записей (кружок, ребенок, дата)
-            paid_records = set()
-            for row in paid_data[1:]:  # Пропускаем заголовки
-                if len(row) >= 3:
-                    key = (str(row[0]).strip(), str(row[1]).strip(), str(row[2]).strip())
-                    paid_records.add(key)
-            
-            logging.info(f"📊 Найдено {len(paid_records)} оплаченных записей")
-            
-            # Ищем дубликаты в прогнозе и удаляем их (идем с конца, чтобы индексы не сбивались)
-            rows_to_delete = []
-            for i, row in enumerate(forecast_data[1:], start=2):  # Начинаем со строки 2
-                if len(row) >= 3:
-                    key = (str(row[0]).strip(), str(row[1]).strip(), str(row[2]).strip())
-                    if key in paid_records:
-                        rows_to_delete.append((i, row[0], row[1], row[2]))
-            
-            # Удаляем строки с конца, чтобы индексы не сбивались
-            deleted_count = 0
-            for row_index, circle, child, date in reversed(rows_to_delete):
-                try:
-                    forecast_sheet.delete_rows(row_index)
-                    logging.info(f"✅ Удалена дубликат из 'Прогноз' (строка {row_index}): {child} - {circle} на {date}")
-                    deleted_count += 1
-                except Exception as e:
-                    logging.error(f"❌ Ошибка при удалении строки {row_index}: {e}")
-            
-            logging.info(f"🎯 Очистка завершена. Удалено дубликатов: {deleted_count}")
-            return deleted_count
+            stats = DuplicateCleanupEngine(spreadsheet=self.spreadsheet).clean_forecast()
+            logging.info(f"🎯 Очистка завершена. Удалено дубликатов: {stats['deleted']}")
+            if stats['deleted']:
+                self._payments_changed('Прогноз')
+            return stats['deleted']
             
         except Exception as e:
             logging.error(f"❌ Ошибка при очистке дубликатов: {e}")
@@ -3507,11 +3701,17 @@ class GoogleSheetsService:
             logging.error(f"❌ Ошибка при создании замещающего занятия для разового абонемента: {e}")
             return False
 
-    def get_subscription_details(self, subscription_id):
-        """Получает детальную информацию об абонементе."""
+    def get_subscription_details(self, subscription_id, use_cache=False):
+        """Получает детальную информацию об абонементе.
+
+        use_cache=True - для экранов просмотра: данные из кеша get_subscriptions_data().
+        """
         try:
-            subs_sheet = self.spreadsheet.worksheet("Абонементы")
-            data = subs_sheet.get_all_records()
+            if use_cache:
+                data = self.get_subscriptions_data()
+            else:
+                subs_sheet = self.spreadsheet.worksheet("Абонементы")
+                data = subs_sheet.get_all_records()
             
             for sub in data:
                 if str(sub.get('ID абонемента', '')).strip() == str(subscription_id).strip():
@@ -3535,8 +3735,7 @@ class GoogleSheetsService:
     def get_forecast_payment_dates(self, child_name, circle_name):
         """Получает прогнозные даты оплат для ребенка и кружка."""
         try:
-            forecast_sheet = self.spreadsheet.worksheet("Прогноз")
-            data = forecast_sheet.get_all_records()
+            data = self.get_forecast_records()
             
             payment_dates = []
             for row in data:
@@ -3604,7 +3803,11 @@ class GoogleSheetsService:
             return None
 
     def get_handbook_items(self, header_name):
-        """Получает список уникальных значений из столбца в 'Справочнике'."""
+        """Получает список уникальных значений из столбца в 'Справочнике' (с кешированием)."""
+        cache_key = f'handbook:{header_name}'
+        cached_data = self._get_from_cache(cache_key)
+        if cached_data is not None:
+            return list(cached_data)
         try:
             worksheet = self.spreadsheet.worksheet("Справочник")
             headers = worksheet.row_values(1)
@@ -3620,13 +3823,15 @@ class GoogleSheetsService:
             
             filtered_values = sorted(list(set(filter(None, values))))
             logging.info(f"Отфильтрованные значения: {filtered_values}")
-            return filtered_values
+            self._save_to_cache(cache_key, filtered_values, duration=getattr(config, 'HANDBOOK_CACHE_TTL', 300))
+            return list(filtered_values)
         except Exception as e:
             logging.error(f"Ошибка при получении данных из Справочника: {e}")
             return []
 
     def add_handbook_item(self, header_name, value):
         try:
+            self._clear_cache(f'handbook:{header_name}')
             worksheet = self.spreadsheet.worksheet("Справочник")
             headers = worksheet.row_values(1)
             if header_name not in headers:
@@ -3642,6 +3847,7 @@ class GoogleSheetsService:
 
     def edit_handbook_item(self, header_name, old_value, new_value):
         try:
+            self._clear_cache(f'handbook:{header_name}')
             worksheet = self.spreadsheet.worksheet("Справочник")
             cell = worksheet.find(old_value)
             if not cell:
@@ -3653,6 +3859,7 @@ class GoogleSheetsService:
 
     def delete_handbook_item(self, header_name, value):
         try:
+            self._clear_cache(f'handbook:{header_name}')
             worksheet = self.spreadsheet.worksheet("Справочник")
             cell = worksheet.find(value)
             if not cell:
@@ -3966,6 +4173,7 @@ class GoogleSheetsService:
                         
                         # Обновляем статус на "Оплачено"
                         forecast_sheet.update_cell(row_index, 5, "Оплачено")
+                        self._sheet_written('Прогноз')
                         updated_count += 1
                         logging.info(f"Обновлен статус для {payment_date}: Оплачено")
             
@@ -3989,6 +4197,7 @@ class GoogleSheetsService:
             if current_status == "Оплата запланирована":
                 # Обновляем статус на "Оплачено"
                 forecast_sheet.update_cell(row_index, 5, "Оплачено")
+                self._sheet_written('Прогноз')
                 
                 # Получаем информацию об оплате для логирования
                 row_data = forecast_sheet.row_values(row_index)
@@ -4047,6 +4256,9 @@ class GoogleSheetsService:
             # Удаляем строку из листа "Прогноз"
             forecast_sheet.delete_rows(row_index)
             
+            self._payments_changed('Оплачено', added=[new_row])
+            self._payments_changed('Прогноз', added=[], removed=[row_data])
+            
             logging.info(f"✅ Оплата перемещена: {child_name} - {circle_name}, дата {payment_date}")
             return True, f"Оплата перемещена в лист 'Оплачено': {child_name} - {circle_name}, {payment_date}"
             
@@ -4294,106 +4506,6 @@ class GoogleSheetsService:
             logging.error(f"Ошибка при получении существующих событий: {e}")
             return {}
 
-    def _remove_duplicate_events(self, existing_events):
-        """Находит и удаляет дублированные события в календаре."""
-        try:
-            duplicates_removed = 0
-            event_groups = {}
-            
-            # Получаем полный список событий
-            all_events = existing_events.pop('_all_events', [])
-            
-            # Группируем все события по ключам
-            for event in all_events:
-                event_key = self._extract_event_key_from_event(event)
-                if event_key:
-                    if event_key not in event_groups:
-                        event_groups[event_key] = []
-                    event_groups[event_key].append(event)
-            
-            # Ищем группы с дублями (больше одного события с одинаковым ключом)
-            for event_key, events in event_groups.items():
-                if len(events) > 1:
-                    logging.info(f"Найдены дубли для ключа '{event_key}': {len(events)} событий")
-                    
-                    # Выбираем самое актуальное событие для сохранения
-                    # Приоритет: 1) с непустой отметкой, 2) последнее по времени обновления
-                    best_event = None
-                    best_priority = -1
-                    
-                    for event in events:
-                        description = event.get('description', '')
-                        mark = ''
-                        
-                        # Извлекаем отметку из описания
-                        for line in description.split('\n'):
-                            if line.startswith('Отметка:'):
-                                mark = line.split(':', 1)[1].strip()
-                                break
-                        
-                        # Определяем приоритет события
-                        priority = 0
-                        if mark and mark not in ['', 'N/A']:
-                            priority = 2  # Высокий приоритет для событий с отметкой
-                        else:
-                            priority = 1  # Низкий приоритет для событий без отметки
-                        
-                        # Если приоритет выше или равен, проверяем время обновления
-                        if priority > best_priority:
-                            best_event = event
-                            best_priority = priority
-                        elif priority == best_priority:
-                            # Если приоритет одинаковый, выбираем последнее обновленное
-                            if best_event:
-                                best_updated = best_event.get('updated', '')
-                                current_updated = event.get('updated', '')
-                                if current_updated > best_updated:
-                                    best_event = event
-                            else:
-                                best_event = event
-                    
-                    logging.info(f"✅ Выбрано для сохранения: {best_event.get('summary', 'Без названия')} (приоритет: {best_priority})")
-                    
-                    # Удаляем все события кроме лучшего
-                    events_to_delete = [e for e in events if e['id'] != best_event['id']]
-                    
-                    for duplicate_event in events_to_delete:
-                        try:
-                            self.calendar_service.events().delete(
-                                calendarId=config.GOOGLE_CALENDAR_ID,
-                                eventId=duplicate_event['id']
-                            ).execute()
-                            
-                            event_title = duplicate_event.get('summary', 'Без названия')
-                            logging.info(f"Удален дубль события: {event_title}")
-                            duplicates_removed += 1
-                            
-                            # Удаляем из словаря existing_events
-                            if event_key in existing_events and existing_events[event_key]['id'] == duplicate_event['id']:
-                                # Если это был основной элемент в словаре, заменяем его на лучшее (с отметкой)
-                                existing_events[event_key] = best_event
-                            
-                        except HttpError as e:
-                            if e.resp.status == 403:
-                                logging.error("Google Calendar API не настроен. Дубль не удален.")
-                            elif e.resp.status == 404:
-                                logging.warning(f"Событие уже удалено: {duplicate_event.get('id')}")
-                            else:
-                                logging.error(f"Ошибка Calendar API при удалении дубля: {e}")
-                        except Exception as e:
-                            logging.error(f"Ошибка при удалении дубля события: {e}")
-            
-            if duplicates_removed > 0:
-                logging.info(f"Удалено {duplicates_removed} дублированных событий")
-            else:
-                logging.info("Дублированные события не найдены")
-            
-            return duplicates_removed
-            
-        except Exception as e:
-            logging.error(f"Ошибка при поиске и удалении дублей: {e}")
-            return 0
-
     def _get_forecast_data(self):
         """Получает данные из листа Прогноз."""
         try:
@@ -5217,7 +5329,15 @@ class GoogleSheetsService:
         logging.info("Google Calendar синхронизация отключена")
         return True
 
-    def sync_calendar_with_google_calendar(self):
+    def get_calendar_sync_window(self):
+        """Возвращает окно фоновой синхронизации календаря (дата начала, дата конца)."""
+        today = datetime.now().date()
+        return (
+            today - timedelta(days=getattr(config, 'CALENDAR_SYNC_DAYS_BACK', 30)),
+            today + timedelta(days=getattr(config, 'CALENDAR_SYNC_DAYS_AHEAD', 90))
+        )
+
+    def sync_calendar_with_google_calendar(self, deep=False):
         """
         НОВАЯ ФУНКЦИЯ: Синхронизация Google Календаря с листом 'Календарь занятий'
         
@@ -5228,6 +5348,9 @@ class GoogleSheetsService:
         4. Если переменные отличаются - обновляет событие
         5. Если событие не найдено - создает новое
         6. Если все переменные совпадают - игнорирует
+        
+        По умолчанию обрабатываются только занятия и события в окне
+        get_calendar_sync_window(), остальные не трогаются. deep=True - полный проход.
         """
         try:
             import time
@@ -5236,7 +5359,11 @@ class GoogleSheetsService:
             if not self.calendar_service:
                 return "❌ Google Calendar не настроен. Проверьте GOOGLE_CALENDAR_ID в .env файле."
             
-            logging.info("🔄 Начинаю синхронизацию Google Calendar...")
+            window_from, window_to = (None, None) if deep else self.get_calendar_sync_window()
+            if deep:
+                logging.info("🔄 Начинаю глубокую синхронизацию Google Calendar (все даты)...")
+            else:
+                logging.info(f"🔄 Начинаю синхронизацию Google Calendar в окне {window_from.strftime('%d.%m.%Y')} - {window_to.strftime('%d.%m.%Y')}...")
             
             # Получаем данные из листа "Календарь занятий"
             calendar_sheet = self.spreadsheet.worksheet("Календарь занятий")
@@ -5305,10 +5432,23 @@ class GoogleSheetsService:
             ignored_count = 0
             errors = []
             
-            # Обрабатываем каждую строку календаря занятий
+            # Загружаем события один раз и индексируем по ID занятия,
+            # чтобы не запрашивать весь календарь для каждой строки.
+            # Экземпляры повторяющихся серий ведет _sync_recurring_lesson_series
+            all_calendar_events = []
+            series_instances = {}
+            for event in self.calendar_service.get_all_events(window_from, window_to):
+                if event.get('recurringEventId'):
+                    series_instances.setdefault(event['recurringEventId'], []).append(event)
+                else:
+                    all_calendar_events.append(event)
+            lesson_events_index = self.calendar_service.index_lesson_events(all_calendar_events)
+            logging.info(f"📅 Проиндексировано {len(lesson_events_index)} событий занятий")
+            
+            # Извлекаем данные из строк календаря занятий
+            lessons = []
             for row_index, row in enumerate(calendar_data[1:], start=2):
                 try:
-                    # Извлекаем данные из строки
                     lesson_data = {
                         'lesson_id': str(row[col_indices['lesson_id']]).strip(),
                         'subscription_id': str(row[col_indices['subscription_id']]).strip(),
@@ -5326,67 +5466,80 @@ class GoogleSheetsService:
                     
                     # Разовые абонементы теперь тоже синхронизируются с Google Calendar
                     # (убрали проверку, чтобы события создавались для всех типов абонементов)
-                    
-                    # Получаем название кружка
-                    circle_name = circle_names_map.get(lesson_data['subscription_id'], 'Неизвестный кружок')
-                    
-                    # Ищем событие в Google Calendar по ID занятия
-                    existing_event = None
-                    
-                    # Сначала пробуем найти по ID занятия (если ID не пустой и не N/A)
-                    if lesson_data['lesson_id'] and lesson_data['lesson_id'] not in ['', 'N/A']:
-                        existing_event = self.calendar_service.find_event_by_lesson_id(lesson_data['lesson_id'])
-                    
-                    # Если не найдено по ID, ищем по деталям (дата, время, ребенок, кружок)
-                    if not existing_event:
-                        existing_event = self.calendar_service.find_event_by_lesson_details(lesson_data, circle_name)
-                        if existing_event:
-                            logging.info(f"🔍 Найдено событие по деталям для занятия {lesson_data['lesson_id']}")
-                    
-                    if existing_event:
-                        # Событие существует - сравниваем переменные
-                        event_variables = self.calendar_service.extract_lesson_variables_from_event(existing_event)
-                        
-                        logging.info(f"🔍 Сравнение для занятия {lesson_data['lesson_id']}:")
-                        logging.info(f"   📊 Данные из таблицы: {lesson_data}")
-                        logging.info(f"   📅 Данные из календаря: {event_variables}")
-                        
-                        if self.calendar_service.compare_lesson_variables(lesson_data, event_variables):
-                            # Все переменные совпадают - игнорируем
-                            ignored_count += 1
-                            logging.info(f"✅ Занятие {lesson_data['lesson_id']}: все данные совпадают, пропускаем")
-                        else:
-                            # Есть различия - обновляем событие
-                            logging.info(f"🔄 Занятие {lesson_data['lesson_id']}: найдены различия, обновляем событие")
-                            if self.calendar_service.update_event(existing_event['id'], lesson_data, circle_name):
-                                updated_count += 1
-                                logging.info(f"✅ Занятие {lesson_data['lesson_id']}: событие успешно обновлено")
-                            else:
-                                errors.append(f"Ошибка обновления события для занятия {lesson_data['lesson_id']}")
-                                logging.error(f"❌ Ошибка обновления события для занятия {lesson_data['lesson_id']}")
-                    else:
-                        # Событие не найдено - создаем новое
-                        logging.info(f"🆕 Занятие {lesson_data['lesson_id']}: событие не найдено, создаю новое")
-                        logging.info(f"📊 Данные для создания: {lesson_data}")
-                        logging.info(f"🎯 Название кружка: {circle_name}")
-                        
-                        event_id = self.calendar_service.create_event(lesson_data, circle_name)
-                        if event_id:
-                            created_count += 1
-                            logging.info(f"✅ Занятие {lesson_data['lesson_id']}: создано новое событие с ID {event_id}")
-                        else:
-                            error_msg = f"Ошибка создания события для занятия {lesson_data['lesson_id']}"
-                            errors.append(error_msg)
-                            logging.error(f"❌ {error_msg}")
+                    lessons.append(lesson_data)
                 
                 except Exception as e:
                     error_msg = f"Ошибка обработки строки {row_index}: {e}"
                     errors.append(error_msg)
                     logging.error(error_msg)
             
+            # В режиме 'recurring' занятия по слотам шаблона уходят в повторяющиеся серии,
+            # отдельными событиями синхронизируются только занятия вне расписания
+            series_count = 0
+            if getattr(config, 'CALENDAR_SYNC_MODE', 'single') == 'recurring':
+                series_stats, lessons = self._sync_recurring_lesson_series(
+                    lessons, circle_names_map, lesson_events_index, series_instances,
+                    window=None if deep else (window_from, window_to)
+                )
+                series_count = series_stats['series']
+                created_count += series_stats['created']
+                updated_count += series_stats['updated']
+                ignored_count += series_stats['ignored']
+                errors.extend(series_stats['errors'])
+            
+            # Занятия вне окна заморожены: их события не сравниваются и не меняются
+            if not deep:
+                def in_window(lesson_data):
+                    try:
+                        lesson_date = datetime.strptime(lesson_data['date'], '%d.%m.%Y').date()
+                    except ValueError:
+                        return True  # Ошибку формата даты покажет обычная обработка
+                    return window_from <= lesson_date <= window_to
+                
+                lessons = [lesson_data for lesson_data in lessons if in_window(lesson_data)]
+            
+            # События вне окна нужны, только если занятие перенесли в окно и для него
+            # создается новое событие: загружаются один раз за синхронизацию, по первому запросу
+            outside_window = {}
+            outside_window_lock = threading.Lock()
+            
+            def events_outside_window(lesson_id):
+                with outside_window_lock:
+                    if 'index' not in outside_window:
+                        outside_window['index'] = self.calendar_service.index_lesson_events_outside_window(
+                            window_from, window_to
+                        )
+                return outside_window['index'].get(lesson_id, [])
+            
+            def sync_lesson(lesson_data):
+                try:
+                    circle_name = circle_names_map.get(lesson_data['subscription_id'], 'Неизвестный кружок')
+                    return self._sync_single_lesson_event(
+                        lesson_data, circle_name, lesson_events_index, all_calendar_events,
+                        events_outside_window=None if deep else events_outside_window
+                    )
+                except Exception as e:
+                    logging.error(f"❌ Ошибка обработки занятия {lesson_data['lesson_id']}: {e}")
+                    return 'error'
+            
+            # Пишем в календарь параллельно, темп задает общий ограничитель запросов;
+            # строки с одним ID занятия идут по порядку, чтобы не создать событие дважды
+            outcomes = self.calendar_service.run_grouped_concurrently(
+                sync_lesson, lessons, key=lambda lesson_data: lesson_data['lesson_id']
+            )
+            for lesson_data, outcome in zip(lessons, outcomes):
+                if outcome == 'created':
+                    created_count += 1
+                elif outcome == 'updated':
+                    updated_count += 1
+                elif outcome == 'ignored':
+                    ignored_count += 1
+                else:
+                    errors.append(f"Ошибка синхронизации события для занятия {lesson_data['lesson_id']}")
+            
             # Очищаем дубли занятий после синхронизации
             logging.info("🧹 Проверяю и удаляю дубли занятий...")
-            duplicates_removed = self.calendar_service.remove_duplicate_lesson_events()
+            duplicates_removed = self.calendar_service.remove_duplicate_lesson_events(window_from, window_to)
             if duplicates_removed > 0:
                 logging.info(f"🗑️ Удалено {duplicates_removed} дублирующихся событий занятий")
             
@@ -5403,7 +5556,14 @@ class GoogleSheetsService:
 • 🔄 Обновлено событий: {updated_count}  
 • ⏭️ Пропущено (без изменений): {ignored_count}
 • 🧹 Удалено дублей: {duplicates_removed}
-• ❌ Ошибок: {len(errors)}
+• ❌ Ошибок: {len(errors)}"""
+            if series_count:
+                result += f"\n• 🔁 Повторяющихся серий: {series_count}"
+            if deep:
+                result += "\n• 🗂 Режим: полная синхронизация"
+            else:
+                result += f"\n• 🗂 Окно: {window_from.strftime('%d.%m.%Y')} - {window_to.strftime('%d.%m.%Y')}"
+            result += f"""
 
 ⚡ **Производительность:**
 • 🕐 Время выполнения: {execution_time} сек
@@ -5422,6 +5582,327 @@ class GoogleSheetsService:
             logging.error(error_msg, exc_info=True)
             return error_msg
 
+    def _sync_single_lesson_event(self, lesson_data, circle_name, lesson_events_index, all_calendar_events,
+                                  events_outside_window=None):
+        """Создает, обновляет или пропускает отдельное событие занятия.
+
+        events_outside_window(lesson_id) - при синхронизации по окну события занятия
+        ищутся только внутри него, поэтому после создания нового события старые
+        события того же занятия вне окна (занятие перенесли в окно) удаляются.
+
+        Возвращает 'created', 'updated', 'ignored' или 'error'.
+        """
+        # Отрисовываем событие заранее: его хеш сравнивается с сохраненным в календаре
+        event_body = self.calendar_service.build_lesson_event_body(lesson_data, circle_name)
+        
+        # Ищем событие в Google Calendar по ID занятия
+        existing_event = None
+        
+        # Сначала пробуем найти по ID занятия (если ID не пустой и не N/A)
+        if lesson_data['lesson_id'] and lesson_data['lesson_id'] not in ['', 'N/A']:
+            existing_event = lesson_events_index.get(lesson_data['lesson_id'])
+        
+        # Если не найдено по ID, ищем по деталям (дата, время, ребенок, кружок)
+        if not existing_event:
+            existing_event = self.calendar_service.find_event_by_lesson_details(
+                lesson_data, circle_name, events=all_calendar_events
+            )
+            if existing_event:
+                logging.info(f"🔍 Найдено событие по деталям для занятия {lesson_data['lesson_id']}")
+        
+        if existing_event:
+            # Быстрый путь: хеш содержимого совпадает - событие не изменилось
+            if event_body and self.calendar_service.event_payload_matches(existing_event, event_body):
+                return 'ignored'
+            
+            # Хеш отличается или отсутствует (старое событие) - сравниваем переменные
+            event_variables = self.calendar_service.extract_lesson_variables_from_event(existing_event)
+            
+            logging.info(f"🔍 Сравнение для занятия {lesson_data['lesson_id']}:")
+            logging.info(f"   📊 Данные из таблицы: {lesson_data}")
+            logging.info(f"   📅 Данные из календаря: {event_variables}")
+            
+            if self.calendar_service.compare_lesson_variables(lesson_data, event_variables):
+                # Все переменные совпадают - игнорируем, но дописываем хеш для следующих синхронизаций
+                if event_body:
+                    self.calendar_service.set_event_payload_hash(existing_event['id'], event_body)
+                logging.info(f"✅ Занятие {lesson_data['lesson_id']}: все данные совпадают, пропускаем")
+                return 'ignored'
+            
+            # Есть различия - обновляем событие
+            logging.info(f"🔄 Занятие {lesson_data['lesson_id']}: найдены различия, обновляем событие")
+            if self.calendar_service.update_event(existing_event['id'], lesson_data, circle_name):
+                logging.info(f"✅ Занятие {lesson_data['lesson_id']}: событие успешно обновлено")
+                return 'updated'
+            
+            logging.error(f"❌ Ошибка обновления события для занятия {lesson_data['lesson_id']}")
+            return 'error'
+        
+        # Событие не найдено - создаем новое
+        logging.info(f"🆕 Занятие {lesson_data['lesson_id']}: событие не найдено, создаю новое")
+        logging.info(f"📊 Данные для создания: {lesson_data}")
+        logging.info(f"🎯 Название кружка: {circle_name}")
+        
+        event_id = self.calendar_service.create_event(lesson_data, circle_name)
+        if event_id:
+            if event_body:
+                # Повторная строка с тем же ID должна найти только что созданное событие
+                lesson_events_index[lesson_data['lesson_id']] = dict(event_body, id=event_id)
+            if events_outside_window and lesson_data['lesson_id'] not in ['', 'N/A']:
+                for stale_event in events_outside_window(lesson_data['lesson_id']):
+                    if stale_event['id'] != event_id and self.calendar_service.delete_event(stale_event['id']):
+                        logging.info(f"🗑️ Занятие {lesson_data['lesson_id']}: удалено старое событие вне окна")
+            logging.info(f"✅ Занятие {lesson_data['lesson_id']}: создано новое событие с ID {event_id}")
+            return 'created'
+        
+        logging.error(f"❌ Ошибка создания события для занятия {lesson_data['lesson_id']}")
+        return 'error'
+
+    def _sync_recurring_lesson_series(self, lessons, circle_names_map, lesson_events_index, series_instances, window=None):
+        """
+        Синхронизирует занятия по слотам 'Шаблон расписания' как повторяющиеся события.
+        
+        Для каждого слота абонемента (день недели + время) создается одна серия
+        с RRULE:FREQ=WEEKLY;COUNT=N, где N - число недель от первого до последнего
+        занятия слота. Отметки, статусы и перенос времени записываются как исключения
+        экземпляров, недели без занятия в таблице - как отмененные экземпляры.
+        
+        Границы серий считаются по всем занятиям, а экземпляры сверяются только
+        внутри window (дата начала, дата конца), если оно задано; серии целиком
+        вне окна не проверяются, из календаря загружаются только серии окна.
+        
+        Возвращает (статистика, занятия вне слотов для синхронизации отдельными событиями).
+        """
+        from google_calendar_service import PAYLOAD_HASH_KEY, get_event_payload_hash, recurring_series_key
+        
+        stats = {'series': 0, 'created': 0, 'updated': 0, 'ignored': 0, 'errors': []}
+        remaining = []
+        
+        # Слоты расписания по абонементам (день недели 1-7 и время)
+        template_records = self.get_schedule_templates()
+        if not template_records:
+            # Пустой шаблон при ошибке чтения сделал бы все серии "лишними" и удалил их
+            raise RuntimeError("Не удалось прочитать 'Шаблон расписания'")
+        slots_by_sub = {}
+        for row in template_records:
+            try:
+                day_num = int(str(row.get('День недели', '')).strip())
+            except ValueError:
+                continue
+            if not 1 <= day_num <= 7:
+                continue
+            slots_by_sub.setdefault(str(row.get('ID абонемента', '')).strip(), []).append({
+                'day_num': day_num,
+                'start_time': self.format_time(str(row.get('Время начала', '')).strip()),
+                'end_time': self.format_time(str(row.get('Время завершения', '')).strip())
+            })
+        
+        # Раскладываем занятия по слотам: абонемент -> индекс слота -> дата -> занятие
+        lessons_by_slot = {}
+        for lesson in lessons:
+            slots = slots_by_sub.get(lesson['subscription_id'])
+            try:
+                lesson_date = datetime.strptime(lesson['date'], '%d.%m.%Y').date()
+            except ValueError:
+                lesson_date = None
+            candidates = [
+                i for i, slot in enumerate(slots or [])
+                if lesson_date and slot['day_num'] == lesson_date.isoweekday()
+            ]
+            if not candidates:
+                remaining.append(lesson)
+                continue
+            
+            # Предпочитаем слот с тем же временем начала, иначе это перенос времени внутри дня
+            start_time = self.format_time(lesson['start_time'])
+            slot_index = next((i for i in candidates if slots[i]['start_time'] == start_time), candidates[0])
+            by_date = lessons_by_slot.setdefault((lesson['subscription_id'], slot_index), {})
+            if lesson_date in by_date:
+                # Второе занятие в тот же день - отдельным событием
+                remaining.append(lesson)
+                continue
+            by_date[lesson_date] = lesson
+        
+        # В режиме окна загружаются только серии с экземплярами в окне
+        series_events = self.calendar_service.get_recurring_series_events(*(window or ()))
+        current_series_keys = set()
+        
+        for (sub_id, slot_index), by_date in lessons_by_slot.items():
+            slot = slots_by_sub[sub_id][slot_index]
+            series_key = recurring_series_key(sub_id, slot)
+            current_series_keys.add(series_key)
+            circle_name = circle_names_map.get(sub_id, 'Неизвестный кружок')
+            first_date = min(by_date)
+            count = (max(by_date) - first_date).days // 7 + 1
+            
+            if window and (max(by_date) < window[0] or first_date > window[1]):
+                # Серия целиком вне окна заморожена, как и одиночные события
+                continue
+            
+            series_body = self.calendar_service.build_recurring_lesson_event_body(
+                slot, sub_id, by_date[first_date]['child'], circle_name, first_date, count
+            )
+            if series_body is None:
+                remaining.extend(by_date.values())
+                continue
+            
+            existing_series = series_events.get(series_key)
+            if existing_series is None and window:
+                # Серия могла закончиться до окна и теперь продлевается в него
+                existing_series = self.calendar_service.find_recurring_series_event(series_key)
+            if existing_series and self.calendar_service.event_payload_matches(existing_series, series_body):
+                series_id = existing_series['id']
+                instances = series_instances.get(series_id, [])
+            else:
+                series_id = self.calendar_service.upsert_recurring_event(
+                    existing_series['id'] if existing_series else None, series_body
+                )
+                if not series_id:
+                    stats['errors'].append(f"Ошибка сохранения серии {series_key}")
+                    remaining.extend(by_date.values())
+                    continue
+                stats['updated' if existing_series else 'created'] += 1
+                instances = self.calendar_service.get_event_instances(series_id)
+            stats['series'] += 1
+            
+            instances_by_date = {}
+            for instance in instances:
+                original_date = self.calendar_service.get_instance_original_date(instance)
+                if original_date:
+                    instances_by_date[original_date] = instance
+            
+            for week in range(count):
+                week_date = first_date + timedelta(weeks=week)
+                if window and not window[0] <= week_date <= window[1]:
+                    continue
+                instance = instances_by_date.get(week_date)
+                lesson = by_date.get(week_date)
+                
+                if lesson is None:
+                    # Занятия на эту неделю нет - отменяем экземпляр
+                    if instance:
+                        if self.calendar_service.cancel_recurring_instance(instance['id']):
+                            stats['updated'] += 1
+                        else:
+                            stats['errors'].append(f"Ошибка отмены экземпляра серии на {week_date.strftime('%d.%m.%Y')}")
+                    continue
+                
+                if instance is None:
+                    # Экземпляр был отменен ранее - занятие синхронизируется отдельным событием
+                    remaining.append(lesson)
+                    continue
+                
+                # Событие занятия, созданное до перехода на серии, больше не нужно
+                legacy_event = lesson_events_index.pop(lesson['lesson_id'], None)
+                if legacy_event:
+                    self.calendar_service.delete_event(legacy_event['id'])
+                
+                lesson_body = self.calendar_service.build_lesson_event_body(lesson, circle_name)
+                if lesson_body is None:
+                    stats['errors'].append(f"Ошибка подготовки экземпляра для занятия {lesson['lesson_id']}")
+                    continue
+                
+                is_plain = (
+                    not lesson['mark']
+                    and lesson['status'] in ('', 'Запланировано')
+                    and self.format_time(lesson['start_time']) == slot['start_time']
+                    and self.format_time(lesson['end_time']) == slot['end_time']
+                )
+                if is_plain:
+                    # Обычное занятие выглядит как сама серия - исключение не нужно
+                    expected_body = dict(
+                        lesson_body,
+                        summary=series_body['summary'],
+                        description=series_body['description'],
+                        extendedProperties=series_body['extendedProperties']
+                    )
+                else:
+                    expected_body = lesson_body
+                
+                expected_hash = expected_body['extendedProperties']['private'][PAYLOAD_HASH_KEY]
+                if get_event_payload_hash(instance) == expected_hash:
+                    stats['ignored'] += 1
+                elif self.calendar_service.patch_recurring_instance(instance['id'], expected_body):
+                    stats['updated'] += 1
+                else:
+                    stats['errors'].append(f"Ошибка обновления экземпляра для занятия {lesson['lesson_id']}")
+        
+        # Серии слотов, по которым больше нет занятий (абонемент удален, слот изменен),
+        # удаляются целиком, иначе они продолжают повторяться в календаре
+        orphan_keys = [series_key for series_key in series_events if series_key not in current_series_keys]
+        for series_key in orphan_keys:
+            if self.calendar_service.delete_event(series_events[series_key]['id']):
+                stats['updated'] += 1
+                logging.info(f"🗑️ Удалена серия без занятий: {series_key}")
+            else:
+                stats['errors'].append(f"Ошибка удаления серии {series_key}")
+        
+        logging.info(f"🔁 Серии: {stats['series']}, удалено серий без занятий: {len(orphan_keys)}, занятий вне серий: {len(remaining)}")
+        return stats, remaining
+
+    def _sync_single_forecast_event(self, forecast_data_item, forecast_events_index, all_calendar_events):
+        """Создает, обновляет или пропускает событие прогноза оплаты.
+
+        Возвращает 'created', 'updated', 'ignored' или 'error'.
+        """
+        logging.info(f"💰 Обрабатываю прогноз: {forecast_data_item['child']} - {forecast_data_item['circle']} на {forecast_data_item['payment_date']} (ID: {forecast_data_item['forecast_id']})")
+        
+        # Отрисовываем событие заранее: его хеш сравнивается с сохраненным в календаре
+        event_body = self.calendar_service.build_forecast_event_body(forecast_data_item)
+        
+        # Ищем существующее событие по ID прогноза
+        existing_event = forecast_events_index.get(forecast_data_item['forecast_id'])
+        
+        # Если не найдено по ID, ищем по деталям (дата, ребенок, кружок)
+        if not existing_event:
+            existing_event = self.calendar_service.find_forecast_event_by_details(
+                forecast_data_item, events=all_calendar_events
+            )
+            if existing_event:
+                logging.info(f"🔍 Найдено событие прогноза по деталям для {forecast_data_item['child']} - {forecast_data_item['circle']}")
+        
+        if existing_event:
+            # Быстрый путь: хеш содержимого совпадает - событие не изменилось
+            if event_body and self.calendar_service.event_payload_matches(existing_event, event_body):
+                return 'ignored'
+            
+            # Хеш отличается или отсутствует (старое событие) - сравниваем переменные
+            event_variables = self.calendar_service.extract_forecast_variables_from_event(existing_event)
+            
+            logging.info(f"🔍 Сравнение для прогноза {forecast_data_item['forecast_id']}:")
+            logging.info(f"   📊 Данные из таблицы: {forecast_data_item}")
+            logging.info(f"   📅 Данные из календаря: {event_variables}")
+            
+            if self.calendar_service.compare_forecast_variables(forecast_data_item, event_variables):
+                # Все данные совпадают - пропускаем, но дописываем хеш для следующих синхронизаций
+                if event_body:
+                    self.calendar_service.set_event_payload_hash(existing_event['id'], event_body)
+                logging.info(f"✅ Прогноз {forecast_data_item['forecast_id']}: все данные совпадают, пропускаем")
+                return 'ignored'
+            
+            # Есть различия - обновляем событие
+            logging.info(f"🔄 Прогноз {forecast_data_item['forecast_id']}: найдены различия, обновляем событие")
+            if self.calendar_service.update_forecast_event(existing_event['id'], forecast_data_item):
+                logging.info(f"✅ Прогноз {forecast_data_item['forecast_id']}: событие успешно обновлено")
+                return 'updated'
+            
+            logging.error(f"❌ Ошибка обновления события для прогноза {forecast_data_item['forecast_id']}")
+            return 'error'
+        
+        # Событие не найдено - создаем новое
+        logging.info(f"🆕 Прогноз {forecast_data_item['forecast_id']}: событие не найдено, создаю новое")
+        logging.info(f"📊 Данные для создания: {forecast_data_item}")
+        
+        event_id = self.calendar_service.create_forecast_event(forecast_data_item)
+        if event_id:
+            if event_body:
+                forecast_events_index[forecast_data_item['forecast_id']] = dict(event_body, id=event_id)
+            logging.info(f"✅ Прогноз {forecast_data_item['forecast_id']}: создано новое событие с ID {event_id}")
+            return 'created'
+        
+        logging.error(f"❌ Ошибка создания события для прогноза {forecast_data_item['forecast_id']}")
+        return 'error'
+
     def sync_forecast_with_google_calendar(self):
         """
         НОВАЯ ФУНКЦИЯ: Синхронизация прогноза оплат с Google Calendar
@@ -5478,9 +5959,11 @@ class GoogleSheetsService:
                     existing_forecast_events.append(event)
             
             logging.info(f"📅 Найдено {len(existing_forecast_events)} существующих событий прогноза в календаре")
+            forecast_events_index = self.calendar_service.index_forecast_events(existing_forecast_events)
             
             # Собираем ID всех прогнозов из таблицы для последующего сравнения
             table_forecast_ids = set()
+            forecast_items = []
             
             # Обрабатываем каждую строку прогноза (пропускаем заголовки)
             for row_index, row in enumerate(forecast_data[1:], 2):
@@ -5517,91 +6000,58 @@ class GoogleSheetsService:
                     # Добавляем ID в множество для отслеживания
                     table_forecast_ids.add(forecast_data_item['forecast_id'])
                     
-                    logging.info(f"💰 Обрабатываю прогноз: {forecast_data_item['child']} - {forecast_data_item['circle']} на {forecast_data_item['payment_date']} (ID: {forecast_data_item['forecast_id']})")
-                    
-                    # Ищем существующее событие по ID прогноза
-                    existing_event = None
-                    
-                    # Сначала пробуем найти по ID прогноза
-                    existing_event = self.calendar_service.find_forecast_event_by_id(forecast_data_item['forecast_id'])
-                    
-                    # Если не найдено по ID, ищем по деталям (дата, ребенок, кружок)
-                    if not existing_event:
-                        existing_event = self.calendar_service.find_forecast_event_by_details(forecast_data_item)
-                        if existing_event:
-                            logging.info(f"🔍 Найдено событие прогноза по деталям для {forecast_data_item['child']} - {forecast_data_item['circle']}")
-                    
-                    if existing_event:
-                        # Событие найдено - сравниваем данные
-                        event_variables = self.calendar_service.extract_forecast_variables_from_event(existing_event)
-                        
-                        logging.info(f"🔍 Сравнение для прогноза {forecast_data_item['forecast_id']}:")
-                        logging.info(f"   📊 Данные из таблицы: {forecast_data_item}")
-                        logging.info(f"   📅 Данные из календаря: {event_variables}")
-                        
-                        # Сравниваем переменные
-                        if self.calendar_service.compare_forecast_variables(forecast_data_item, event_variables):
-                            # Все данные совпадают - пропускаем
-                            ignored_count += 1
-                            logging.info(f"✅ Прогноз {forecast_data_item['forecast_id']}: все данные совпадают, пропускаем")
-                        else:
-                            # Есть различия - обновляем событие
-                            logging.info(f"🔄 Прогноз {forecast_data_item['forecast_id']}: найдены различия, обновляем событие")
-                            if self.calendar_service.update_forecast_event(existing_event['id'], forecast_data_item):
-                                updated_count += 1
-                                logging.info(f"✅ Прогноз {forecast_data_item['forecast_id']}: событие успешно обновлено")
-                            else:
-                                errors.append(f"Ошибка обновления события для прогноза {forecast_data_item['forecast_id']}")
-                                logging.error(f"❌ Ошибка обновления события для прогноза {forecast_data_item['forecast_id']}")
-                    else:
-                        # Событие не найдено - создаем новое
-                        logging.info(f"🆕 Прогноз {forecast_data_item['forecast_id']}: событие не найдено, создаю новое")
-                        logging.info(f"📊 Данные для создания: {forecast_data_item}")
-                        
-                        event_id = self.calendar_service.create_forecast_event(forecast_data_item)
-                        if event_id:
-                            created_count += 1
-                            logging.info(f"✅ Прогноз {forecast_data_item['forecast_id']}: создано новое событие с ID {event_id}")
-                        else:
-                            error_msg = f"Ошибка создания события для прогноза {forecast_data_item['forecast_id']}"
-                            errors.append(error_msg)
-                            logging.error(f"❌ {error_msg}")
+                    forecast_items.append(forecast_data_item)
                 
                 except Exception as e:
                     error_msg = f"Ошибка обработки строки прогноза {row_index}: {e}"
                     errors.append(error_msg)
                     logging.error(error_msg)
             
+            def sync_item(forecast_data_item):
+                try:
+                    return self._sync_single_forecast_event(
+                        forecast_data_item, forecast_events_index, all_calendar_events
+                    )
+                except Exception as e:
+                    logging.error(f"❌ Ошибка синхронизации прогноза {forecast_data_item['forecast_id']}: {e}")
+                    return 'error'
+            
+            # Пишем в календарь параллельно, темп задает общий ограничитель запросов;
+            # строки с одним ID прогноза идут по порядку, чтобы не создать событие дважды
+            outcomes = self.calendar_service.run_grouped_concurrently(
+                sync_item, forecast_items, key=lambda forecast_data_item: forecast_data_item['forecast_id']
+            )
+            for forecast_data_item, outcome in zip(forecast_items, outcomes):
+                if outcome == 'created':
+                    created_count += 1
+                elif outcome == 'updated':
+                    updated_count += 1
+                elif outcome == 'ignored':
+                    ignored_count += 1
+                else:
+                    errors.append(f"Ошибка синхронизации события для прогноза {forecast_data_item['forecast_id']}")
+            
             # Удаляем события прогноза, которых нет в таблице
             logging.info(f"🔍 Поиск событий для удаления...")
             logging.info(f"📊 ID в таблице: {len(table_forecast_ids)} штук")
             
+            obsolete_event_ids = []
             for event in existing_forecast_events:
-                try:
-                    event_variables = self.calendar_service.extract_forecast_variables_from_event(event)
-                    event_forecast_id = event_variables.get('forecast_id', '')
-                    
-                    if event_forecast_id and event_forecast_id not in table_forecast_ids:
-                        # Событие есть в календаре, но нет в таблице - удаляем
-                        event_summary = event.get('summary', 'Без названия')
-                        logging.info(f"🗑️ Удаляю лишнее событие прогноза: {event_summary} (ID: {event_forecast_id})")
-                        
-                        try:
-                            self.calendar_service.service.events().delete(
-                                calendarId=self.calendar_service.calendar_id,
-                                eventId=event['id']
-                            ).execute()
-                            
-                            deleted_count += 1
-                            logging.info(f"✅ Удалено лишнее событие: {event_summary}")
-                            
-                        except Exception as delete_error:
-                            error_msg = f"Ошибка удаления события {event_forecast_id}: {delete_error}"
-                            errors.append(error_msg)
-                            logging.error(error_msg)
-                            
-                except Exception as e:
-                    logging.error(f"❌ Ошибка при проверке события для удаления: {e}")
+                event_variables = self.calendar_service.extract_forecast_variables_from_event(event)
+                event_forecast_id = event_variables.get('forecast_id', '')
+                
+                if event_forecast_id and event_forecast_id not in table_forecast_ids:
+                    # Событие есть в календаре, но нет в таблице - удаляем
+                    logging.info(f"🗑️ Удаляю лишнее событие прогноза: {event.get('summary', 'Без названия')} (ID: {event_forecast_id})")
+                    obsolete_event_ids.append(event['id'])
+            
+            for event_id, deleted in zip(
+                obsolete_event_ids, self.calendar_service.run_concurrently(self.calendar_service.delete_event, obsolete_event_ids)
+            ):
+                if deleted:
+                    deleted_count += 1
+                else:
+                    errors.append(f"Ошибка удаления события {event_id}")
             
             # Вычисляем время выполнения
             end_time = time.time()
@@ -6571,201 +7021,17 @@ class GoogleSheetsService:
         """Исправляет дублированные ID занятий в календаре, сохраняя уникальные ID."""
         try:
             logging.info("🔧 Начинаю исправление дублированных ID занятий...")
-            
-            cal_sheet = self.spreadsheet.worksheet("Календарь занятий")
-            data = cal_sheet.get_all_values()
-            
-            if len(data) < 2:
-                logging.info("Календарь занятий пуст или содержит только заголовки")
-                return True
-            
-            headers = data[0]
-            rows = data[1:]
-            
-            # Анализируем существующие ID и находим дубли
-            id_counts = {}
-            existing_ids = set()
-            
-            for row in rows:
-                if len(row) > 0 and row[0] and str(row[0]).strip():
-                    try:
-                        lesson_id = int(row[0])
-                        id_counts[lesson_id] = id_counts.get(lesson_id, 0) + 1
-                        existing_ids.add(lesson_id)
-                    except ValueError:
-                        pass
-            
-            # Находим дубли
-            duplicates = {id_val: count for id_val, count in id_counts.items() if count > 1}
-            
-            if not duplicates:
+            stats = DuplicateCleanupEngine(spreadsheet=self.spreadsheet).fix_lesson_ids()
+            if stats['fixed']:
+                logging.info(f"✅ Одним batch-обновлением переназначено {stats['fixed']} ID из {stats['checked']} занятий")
+            else:
                 logging.info("✅ Дублированных ID не найдено")
-                return True
-            
-            logging.info(f"🔍 Найдены дубли ID: {duplicates}")
-            
-            # Находим следующий доступный ID для переназначения
-            max_id = max(existing_ids) if existing_ids else 0
-            next_available_id = max_id + 1
-            
-            # Исправляем дубли (без заголовков - они уже есть в листе)
-            fixed_data = []
-            used_ids = set()
-            
-            for row in rows:
-                if len(row) > 0:
-                    fixed_row = row.copy()
-                    
-                    try:
-                        current_id = int(row[0]) if row[0] and str(row[0]).strip() else None
-                        
-                        # Если ID уже использован (дубль) или невалидный
-                        if current_id is None or current_id in used_ids:
-                            # Присваиваем новый уникальный ID
-                            while next_available_id in existing_ids or next_available_id in used_ids:
-                                next_available_id += 1
-                            fixed_row[0] = str(next_available_id)
-                            used_ids.add(next_available_id)
-                            next_available_id += 1
-                            logging.info(f"🔧 Переназначен ID {current_id} → {fixed_row[0]}")
-                        else:
-                            # ID уникальный, сохраняем его
-                            used_ids.add(current_id)
-                            
-                    except ValueError:
-                        # Невалидный ID, присваиваем новый
-                        while next_available_id in existing_ids or next_available_id in used_ids:
-                            next_available_id += 1
-                        fixed_row[0] = str(next_available_id)
-                        used_ids.add(next_available_id)
-                        next_available_id += 1
-                        logging.info(f"🔧 Присвоен новый ID: {fixed_row[0]}")
-                    
-                    fixed_data.append(fixed_row)
-            
-            # ИСПРАВЛЕНО: Обновляем только дублированные ID, НЕ пересоздавая всю таблицу
-            logging.info("🔒 ЗАЩИТА ID: Обновляем только дублированные ID точечно")
-            
-            # Обновляем только те строки, где ID был изменен
-            updates_made = 0
-            for i, (original_row, fixed_row) in enumerate(zip(rows, fixed_data)):
-                if original_row[0] != fixed_row[0]:  # ID изменился
-                    row_number = i + 2  # +2 потому что строки начинаются с 1, и есть заголовок
-                    try:
-                        cal_sheet.update_cell(row_number, 1, fixed_row[0])  # Обновляем только столбец A (ID)
-                        updates_made += 1
-                        logging.info(f"🔧 Обновлен ID в строке {row_number}: {original_row[0]} → {fixed_row[0]}")
-                    except Exception as e:
-                        logging.error(f"❌ Ошибка обновления строки {row_number}: {e}")
-            
-            logging.info(f"✅ Точечно обновлено {updates_made} ID (вместо пересоздания всей таблицы)")
-            
-            logging.info(f"✅ Исправлено {len(duplicates)} типов дублированных ID")
-            logging.info(f"📊 Всего занятий: {len(rows)}, уникальных ID: {len(used_ids)}")
             return True
             
         except Exception as e:
             logging.error(f"❌ Ошибка при исправлении дублированных ID: {e}")
             return False
 
-    def _force_remove_duplicates_by_content(self, existing_events):
-        """Принудительно удаляет дубли по содержимому (название + дата + время)."""
-        try:
-            content_groups = {}
-            duplicates_removed = 0
-            
-            # Группируем события по содержимому
-            for event_key, event in existing_events.items():
-                if event_key == '_all_events':
-                    continue
-                    
-                summary = event.get('summary', '')
-                start = event.get('start', {})
-                
-                # Создаем ключ содержимого
-                if 'dateTime' in start:
-                    content_key = f"{summary}|{start['dateTime']}"
-                elif 'date' in start:
-                    content_key = f"{summary}|{start['date']}"
-                else:
-                    continue
-                
-                if content_key not in content_groups:
-                    content_groups[content_key] = []
-                content_groups[content_key].append((event_key, event))
-            
-            # Удаляем дубли (оставляем самое актуальное - с отметкой)
-            for content_key, events_list in content_groups.items():
-                if len(events_list) > 1:
-                    logging.info(f"Найдены дубли по содержимому '{content_key}': {len(events_list)} событий")
-                    
-                    # Выбираем самое актуальное событие для сохранения
-                    # Приоритет: 1) с непустой отметкой, 2) последнее по времени обновления
-                    best_event = None
-                    best_event_key = None
-                    best_priority = -1
-                    
-                    for event_key, event in events_list:
-                        description = event.get('description', '')
-                        mark = ''
-                        
-                        # Извлекаем отметку из описания
-                        for line in description.split('\n'):
-                            if line.startswith('Отметка:'):
-                                mark = line.split(':', 1)[1].strip()
-                                break
-                        
-                        # Определяем приоритет события
-                        priority = 0
-                        if mark and mark not in ['', 'N/A']:
-                            priority = 2  # Высокий приоритет для событий с отметкой
-                        else:
-                            priority = 1  # Низкий приоритет для событий без отметки
-                        
-                        # Если приоритет выше или равен, проверяем время обновления
-                        if priority > best_priority:
-                            best_event = event
-                            best_event_key = event_key
-                            best_priority = priority
-                        elif priority == best_priority:
-                            # Если приоритет одинаковый, выбираем последнее обновленное
-                            if best_event:
-                                best_updated = best_event.get('updated', '')
-                                current_updated = event.get('updated', '')
-                                if current_updated > best_updated:
-                                    best_event = event
-                                    best_event_key = event_key
-                            else:
-                                best_event = event
-                                best_event_key = event_key
-                    
-                    logging.info(f"✅ Выбрано для сохранения: {best_event.get('summary', 'Без названия')} (приоритет: {best_priority})")
-                    
-                    # Удаляем все кроме лучшего
-                    for event_key, event in events_list:
-                        if event_key == best_event_key:
-                            continue  # Пропускаем лучшее событие
-                        try:
-                            self.calendar_service.events().delete(
-                                calendarId=config.GOOGLE_CALENDAR_ID,
-                                eventId=event['id']
-                            ).execute()
-                            logging.info(f"Удален дубль события: {event.get('summary', '')}")
-                            duplicates_removed += 1
-                            
-                            # Удаляем из словаря existing_events
-                            if event_key in existing_events:
-                                del existing_events[event_key]
-                                
-                        except Exception as e:
-                            logging.error(f"Ошибка при удалении дубля: {e}")
-            
-            return duplicates_removed
-            
-        except Exception as e:
-            logging.error(f"Ошибка при принудительном удалении дублей: {e}")
-            return 0
-
     def auto_sync_calendar_after_changes_DISABLED(self):
         """Автоматическая синхронизация календаря после изменений в Google Sheets."""
         try:
@@ -7432,6 +7698,16 @@ class GoogleSheetsService:
             logging.error(f"❌ Ошибка при подготовке данных события: {e}")
             return None
 
+    def get_schedule_templates(self):
+        """Получает строки листа 'Шаблон расписания' (с кешированием)."""
+        cache_key = 'schedule_templates'
+        cached_data = self._get_from_cache(cache_key)
+        if cached_data is not None:
+            return cached_data
+        data = self._get_schedule_templates()
+        self._save_to_cache(cache_key, data)
+        return data
+
     def get_subscription_full_stats(self, sub_id):
         """Получает полную статистику абонемента из всех листов."""
         try:
@@ -7442,24 +7718,22 @@ class GoogleSheetsService:
                 'forecast_payments': []
             }
             
+            # Все листы читаются через кеш (их заранее прогревает prefetch)
             # 1. Данные абонемента
-            subs_sheet = self.spreadsheet.worksheet("Абонементы")
-            subs_data = subs_sheet.get_all_records()
+            subs_data = self.get_subscriptions_data()
             for sub in subs_data:
                 if str(sub.get('ID абонемента', '')).strip() == str(sub_id).strip():
                     stats['subscription'] = sub
                     break
             
             # 2. Шаблон расписания
-            template_sheet = self.spreadsheet.worksheet("Шаблон расписания")
-            template_data = template_sheet.get_all_records()
+            template_data = self.get_schedule_templates()
             for template in template_data:
                 if str(template.get('ID абонемента', '')).strip() == str(sub_id).strip():
                     stats['schedule_template'].append(template)
             
             # 3. Календарь занятий
-            calendar_sheet = self.spreadsheet.worksheet("Календарь занятий")
-            calendar_data = calendar_sheet.get_all_records()
+            calendar_data = self.get_calendar_lessons()
             for lesson in calendar_data:
                 if str(lesson.get('ID абонемента', '')).strip() == str(sub_id).strip():
                     stats['calendar_lessons'].append(lesson)
@@ -7469,8 +7743,7 @@ class GoogleSheetsService:
                 child_name = stats['subscription'].get('Ребенок', '')
                 circle_name = stats['subscription'].get('Кружок', '')
                 
-                forecast_sheet = self.spreadsheet.worksheet("Прогноз")
-                forecast_data = forecast_sheet.get_all_records()
+                forecast_data = self.get_forecast_records()
                 for forecast in forecast_data:
                     if (str(forecast.get('Ребенок', '')).strip() == str(child_name).strip() and
                         str(forecast.get('Кружок', '')).strip() == str(circle_name).strip()):
@@ -7560,6 +7833,20 @@ class GoogleSheetsService:
             logging.error(f"Ошибка при получении chat_id уведомлений: {e}")
             return None
 
+    def get_notification_recipients(self):
+        """Получает дополнительных получателей уведомлений из ячейки P2 листа Справочник.
+
+        Формат: 'chat_id:Ребенок1,Ребенок2;chat_id:*' ('*' или пусто - все дети).
+        Ячейка заполняется в таблице вручную.
+        """
+        try:
+            handbook_sheet = self.spreadsheet.worksheet("Справочник")
+            value = handbook_sheet.acell('P2').value
+            return value.strip() if value else ''
+        except Exception as e:
+            logging.error(f"Ошибка при получении получателей уведомлений: {e}")
+            return ''
+
     def get_weekly_summary(self):
         """Получает сводку на текущую неделю."""
         try:
@@ -7814,37 +8101,24 @@ class GoogleSheetsService:
             return []
 
     def clean_duplicate_events(self):
-        """Публичная функция для очистки дублированных событий в Google Calendar."""
+        """Публичная функция очистки дублей: события Google Calendar и строки 'Прогноз' одним отчетом."""
         try:
-            logging.info("🧹 Начинаю очистку дублированных событий в Google Calendar...")
-            
-            # Проверяем доступность Calendar API
-            if not hasattr(self, 'calendar_service') or not self.calendar_service:
-                logging.warning("⚠️ Calendar API недоступен - пропускаю очистку дублей")
-                return "⚠️ Calendar API недоступен - очистка дублей пропущена"
-            
-            # Получаем все существующие события за последние 6 месяцев
-            from datetime import datetime, timedelta
-            now = datetime.now()
-            start_date = now - timedelta(days=180)  # 6 месяцев назад
-            end_date = now + timedelta(days=180)    # 6 месяцев вперед
+            logging.info("🧹 Начинаю очистку дублей в Google Calendar и таблице...")
             
-            existing_events_map = self._get_existing_events_map(start_date, end_date)
-            if not existing_events_map:
-                logging.info("ℹ️ События в календаре не найдены")
-                return "ℹ️ События в календаре не найдены - очистка не требуется"
+            calendar_service = getattr(self, 'calendar_service', None)
+            if not calendar_service:
+                logging.warning("⚠️ Calendar API недоступен - чищу только таблицу")
             
-            # Запускаем очистку дублей
-            duplicates_removed = self._remove_duplicate_events(list(existing_events_map.values()))
+            # Календарь проверяем за полгода назад и вперед
+            date_from, date_to = default_calendar_window()
+            engine = DuplicateCleanupEngine(spreadsheet=self.spreadsheet, calendar_service=calendar_service)
+            report = engine.run(calendar=True, forecast=True, date_from=date_from, date_to=date_to)
+            if report.get('forecast', {}).get('deleted'):
+                self._payments_changed('Прогноз')
             
-            if duplicates_removed > 0:
-                result_message = f"✅ Очистка завершена успешно! Удалено дублей: {duplicates_removed}"
-                logging.info(result_message)
-                return result_message
-            else:
-                result_message = "ℹ️ Дублированные события не найдены - календарь чист"
-                logging.info(result_message)
-                return result_message
+            result_message = engine.format_report(report)
+            logging.info(result_message)
+            return result_message
                 
         except Exception as e:
             error_message = f"❌ Ошибка при очистке дублированных событий: {str(e)}"
@@ -7937,6 +8211,7 @@ class GoogleSheetsService:
                                 subs_sheet.update_cell(i, 13, expected_m)  # M - столбец 13
                             if not status_match and len(row) > 9:
                                 subs_sheet.update_cell(i, 10, expected_status)  # J - столбец 10
+                            self._sheet_written('Абонементы')
                             
                             fixed_count += 1
                         break
@@ -0,0 +1,340 @@
+import asyncio
+import logging
+import time
+from functools import partial
+from datetime import datetime
+from google_sheets_service import sheets_service
+import config
+
+
+def result_error(result):
+    """Текст ошибки из результата задачи или None.
+
+    Функции сервиса таблиц сообщают об ошибке не исключением, а строкой '❌ ...'
+    (или '⚠️ ... пропущен(а)' при превышении квоты API); прогноз - кортежем
+    (0, [такая строка]).
+    """
+    messages = [result] if isinstance(result, str) else []
+    if isinstance(result, tuple) and len(result) == 2 and not result[0] and isinstance(result[1], list):
+        messages = [message for message in result[1] if isinstance(message, str)]
+    for message in messages:
+        text = message.strip()
+        if text.startswith('❌') or (text.startswith('⚠️') and 'пропущен' in text):
+            return text
+    return None
+
+
+class BackgroundJob:
+    """Описание фоновой задачи и ее последнего запуска."""
+
+    def __init__(self, name, title, func, depends_on=(), debounce=None):
+        self.name = name
+        self.title = title
+        self.func = func
+        self.depends_on = tuple(depends_on)
+        self.debounce = debounce
+        self.status = 'idle'  # idle / pending / running / done / failed / skipped / cancelled
+        self.requested_count = 0
+        self.run_count = 0
+        self.last_started = None
+        self.last_duration = None
+        self.last_result = ''
+        self.last_error = ''
+        self.waiters = []  # futures запросов через run(), ждущих следующего запуска
+
+
+class BackgroundJobScheduler:
+    """Планировщик фоновых задач (прогноз, синхронизации календаря, очистка дублей).
+
+    Запрошенные задачи копятся в наборе ожидающих: повторный запрос той же задачи
+    не создает вторую копию. Пакет стартует после окна тишины (debounce), но не
+    позже max_delay от первого запроса, и выполняется в порядке зависимостей.
+    Задача, запрошенная во время своего выполнения, повторится следующим пакетом,
+    а вместе с ней и зависящие от нее задачи, даже если они уже начались.
+    run() ставит задачу в тот же поток и ждет ее результата, поэтому ручные
+    запуски не пересекаются с фоновыми; run(immediate=True) стартует пакет без
+    окна тишины. Задача, вернувшая ошибку (см. result_error), считается
+    невыполненной, и зависящие от нее задачи пропускаются.
+    """
+
+    def __init__(self, debounce=None, max_delay=None, gap=None):
+        self.debounce = debounce if debounce is not None else getattr(config, 'BACKGROUND_JOBS_DEBOUNCE', 15)
+        self.max_delay = max_delay if max_delay is not None else getattr(config, 'BACKGROUND_JOBS_MAX_DELAY', 120)
+        self.gap = gap if gap is not None else getattr(config, 'BACKGROUND_JOBS_GAP', 5)
+        self._jobs = {}
+        self._pending = set()
+        self._first_request_at = None
+        self._last_request_at = None
+        self._immediate = False
+        self._wakeup = None
+        self._runner_task = None
+        self._current_batch = []
+
+    def register(self, name, title, func, depends_on=(), debounce=None):
+        """Регистрирует задачу. depends_on - задачи, которые должны выполниться раньше в том же пакете."""
+        for dependency in depends_on:
+            if dependency not in self._jobs:
+                raise ValueError(f"Задача {name} зависит от незарегистрированной задачи {dependency}")
+        self._jobs[name] = BackgroundJob(name, title, func, depends_on, debounce)
+
+    def dependents_of(self, name):
+        """Все задачи, которые (транзитивно) зависят от name."""
+        result = set()
+        stack = [name]
+        while stack:
+            current = stack.pop()
+            for job in self._jobs.values():
+                if current in job.depends_on and job.name not in result:
+                    result.add(job.name)
+                    stack.append(job.name)
+        return result
+
+    def request(self, *names, reason='', immediate=False):
+        """Запрашивает задачи и все зависящие от них. Повторные запросы склеиваются.
+
+        immediate=True - ручной запуск: пакет стартует без ожидания окна тишины.
+        """
+        requested = set()
+        for name in names:
+            if name not in self._jobs:
+                logging.error(f"❌ Неизвестная фоновая задача: {name}")
+                continue
+            requested.add(name)
+            requested |= self.dependents_of(name)
+
+        if not requested:
+            return
+
+        now = time.monotonic()
+        if not self._pending:
+            self._first_request_at = now
+        self._last_request_at = now
+        if immediate:
+            self._immediate = True
+        for name in requested:
+            job = self._jobs[name]
+            job.requested_count += 1
+            if job.status != 'running':
+                job.status = 'pending'
+            self._pending.add(name)
+
+        logging.info(f"🗓 Фоновые задачи запрошены ({reason or 'без причины'}): {', '.join(sorted(requested))}")
+        self._ensure_runner()
+        self._wakeup.set()
+
+    async def run(self, name, reason='', immediate=False):
+        """Запрашивает задачу и ждет окончания ее запуска. Возвращает результат задачи.
+
+        Ошибка задачи (или ее отмена/пропуск) пробрасывается вызывающему.
+        """
+        job = self._jobs.get(name)
+        if not job:
+            raise ValueError(f"Неизвестная фоновая задача: {name}")
+        waiter = asyncio.get_running_loop().create_future()
+        job.waiters.append(waiter)
+        self.request(name, reason=reason, immediate=immediate)
+        return await waiter
+
+    @staticmethod
+    def _resolve_waiters(waiters, result=None, error=None):
+        for waiter in waiters:
+            if waiter.done():
+                continue
+            if error is not None:
+                waiter.set_exception(error)
+            else:
+                waiter.set_result(result)
+
+    def cancel(self, name=None):
+        """Отменяет ожидающую задачу (или все ожидающие, включая еще не начатые задачи текущего пакета).
+
+        Выполняемую задачу прервать нельзя; зависящие от отмененной задачи пропускаются.
+        """
+        if name:
+            names = [name]
+        else:
+            names = list(self._pending) + [job.name for job in self._current_batch if job.status == 'pending']
+        cancelled = []
+        for job_name in names:
+            job = self._jobs.get(job_name)
+            if job and job.status == 'pending':
+                self._pending.discard(job_name)
+                job.status = 'cancelled'
+                cancelled.append(job_name)
+                waiters, job.waiters = job.waiters, []
+                self._resolve_waiters(waiters, error=RuntimeError(f"Задача '{job.title}' отменена"))
+        logging.info(f"⏹️ Отменены фоновые задачи: {', '.join(cancelled) if cancelled else 'нет ожидающих'}")
+        return cancelled
+
+    def status(self):
+        """Состояние задач для просмотра."""
+        return [{
+            'name': job.name,
+            'title': job.title,
+            'status': job.status,
+            'requested_count': job.requested_count,
+            'run_count': job.run_count,
+            'last_started': job.last_started,
+            'last_duration': job.last_duration,
+            'last_result': job.last_result,
+            'last_error': job.last_error,
+        } for job in self._ordered(self._jobs)]
+
+    def format_status(self):
+        """Текст состояния задач для бота (HTML)."""
+        status_emoji = {
+            'idle': '⚪', 'pending': '⏳', 'running': '🔄', 'done': '✅',
+            'failed': '❌', 'skipped': '⏭', 'cancelled': '⏹️'
+        }
+        lines = ["🗂 <b>Фоновые задачи</b>\n"]
+        for item in self.status():
+            line = f"{status_emoji.get(item['status'], '❓')} <b>{item['title']}</b>"
+            if item['last_started']:
+                line += f"\n   последний запуск {item['last_started'].strftime('%d.%m %H:%M:%S')}"
+                if item['last_duration'] is not None:
+                    line += f" ({item['last_duration']:.0f} сек)"
+            line += f"\n   запросов {item['requested_count']}, запусков {item['run_count']}"
+            if item['last_error']:
+                line += f"\n   ошибка: {item['last_error'][:100]}"
+            lines.append(line)
+        if self._pending:
+            wait = max(0, self._batch_deadline() - time.monotonic())
+            lines.append(f"\n⏳ Ожидают: {len(self._pending)}, старт примерно через {wait:.0f} сек")
+        return '\n'.join(lines)
+
+    def _ordered(self, names):
+        """Топологический порядок задач (порядок регистрации сохраняется)."""
+        ordered = []
+        visited = set()
+
+        def visit(name):
+            if name in visited:
+                return
+            visited.add(name)
+            for dependency in self._jobs[name].depends_on:
+                if dependency in names:
+                    visit(dependency)
+            ordered.append(self._jobs[name])
+
+        for name in self._jobs:
+            if name in names:
+                visit(name)
+        return ordered
+
+    def _batch_deadline(self):
+        if self._immediate:
+            return time.monotonic()
+        debounce = max([self.debounce] + [self._jobs[name].debounce for name in self._pending
+                                          if self._jobs[name].debounce is not None])
+        return min(self._last_request_at + debounce, self._first_request_at + self.max_delay)
+
+    def _ensure_runner(self):
+        if self._runner_task is None or self._runner_task.done():
+            self._wakeup = asyncio.Event()
+            self._runner_task = asyncio.create_task(self._runner_loop())
+
+    async def _runner_loop(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            # Окно тишины: новые запросы сдвигают старт, но не дальше max_delay
+            while self._pending:
+                delay = self._batch_deadline() - time.monotonic()
+                if delay <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                    self._wakeup.clear()
+                except asyncio.TimeoutError:
+                    break
+
+            if not self._pending:
+                continue
+
+            batch = self._ordered(self._pending)
+            self._pending.clear()
+            self._first_request_at = None
+            self._immediate = False
+            await self._run_batch(batch)
+
+    async def _run_batch(self, batch):
+        logging.info(f"🚀 Фоновый пакет: {' → '.join(job.name for job in batch)}")
+        self._current_batch = batch
+        failed = set()
+        for index, job in enumerate(batch):
+            if job.status == 'cancelled':
+                failed.add(job.name)
+                continue
+            if failed & set(job.depends_on):
+                job.status = 'skipped'
+                failed.add(job.name)
+                if job.name not in self._pending:
+                    waiters, job.waiters = job.waiters, []
+                    self._resolve_waiters(waiters, error=RuntimeError(f"Задача '{job.title}' пропущена: не выполнена зависимость"))
+                logging.warning(f"⏭ Задача {job.name} пропущена: не выполнена зависимость")
+                continue
+            if index and self.gap:
+                # Пауза между задачами для снижения нагрузки на API
+                await asyncio.sleep(self.gap)
+
+            # Запросы, пришедшие до старта задачи, покрываются этим запуском - если только
+            # не запрошена заново ее зависимость: тогда задача повторится после нее
+            if not self._pending & set(job.depends_on):
+                self._pending.discard(job.name)
+            waiters, job.waiters = job.waiters, []
+            job.status = 'running'
+            job.last_started = datetime.now()
+            started = time.monotonic()
+            try:
+                result = await asyncio.to_thread(job.func)
+                error = result_error(result)
+                if error:
+                    raise RuntimeError(error)
+                job.last_result = str(result)[:200]
+                job.last_error = ''
+                job.status = 'done'
+                self._resolve_waiters(waiters, result=result)
+                logging.info(f"✅ Фоновая задача {job.name} завершена: {job.last_result[:100]}")
+            except Exception as e:
+                job.last_error = str(e)
+                job.status = 'failed'
+                failed.add(job.name)
+                self._resolve_waiters(waiters, error=e)
+                logging.error(f"❌ Фоновая задача {job.name} завершилась с ошибкой: {e}")
+            finally:
+                job.run_count += 1
+                job.last_duration = time.monotonic() - started
+                # Запрошена снова во время выполнения - останется в ожидании до следующего пакета
+                if job.name in self._pending:
+                    job.status = 'pending'
+        self._current_batch = []
+
+
+# Полное фоновое обновление после изменения данных
+FULL_REFRESH_JOBS = ('forecast', 'calendar_sync', 'forecast_calendar_sync', 'dedup')
+
+# Глобальный экземпляр планировщика
+background_jobs = None
+
+def get_background_jobs() -> BackgroundJobScheduler:
+    """Получает глобальный планировщик с зарегистрированными задачами обновления данных"""
+    global background_jobs
+
+    if background_jobs is None:
+        background_jobs = BackgroundJobScheduler()
+        if not sheets_service:
+            logging.warning("⚠️ Google Sheets недоступен - фоновые задачи не зарегистрированы")
+            return background_jobs
+        background_jobs.register('forecast', "💰 Прогноз бюджета", sheets_service.update_full_forecast)
+        background_jobs.register('calendar_sync', "📅 Синхронизация Google Calendar",
+                                 sheets_service.sync_calendar_with_google_calendar)
+        # Полный проход по всем датам (ручной запуск и периодический), в одном потоке с calendar_sync
+        background_jobs.register('calendar_deep_sync', "🗂 Глубокая синхронизация Google Calendar",
+                                 partial(sheets_service.sync_calendar_with_google_calendar, deep=True))
+        background_jobs.register('forecast_calendar_sync', "💵 Прогноз в Google Calendar",
+                                 sheets_service.sync_forecast_with_google_calendar, depends_on=('forecast',))
+        background_jobs.register('dedup', "🧹 Очистка дублей", sheets_service.clean_duplicate_events,
+                                 depends_on=('calendar_sync', 'forecast_calendar_sync'))
+
+    return background_jobs
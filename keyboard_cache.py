@@ -0,0 +1,60 @@
+"""
+LRU-кеш готовых inline-клавиатур (календари, выбор времени).
+
+Клавиатура однозначно задается ключом (вид, год, месяц, дайджест содержимого):
+пока месяц и его отметки не менялись, повторная навигация получает уже
+собранный InlineKeyboardMarkup без перестроения кнопок. Объекты
+InlineKeyboardMarkup в python-telegram-bot неизменяемы, поэтому их можно
+безопасно отдавать нескольким обработчикам.
+"""
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import config
+
+
+def content_digest(*parts):
+    """Короткий стабильный дайджест содержимого клавиатуры."""
+    serialized = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.md5(serialized.encode('utf-8')).hexdigest()[:16]
+
+
+class KeyboardCache:
+    """LRU-кеш InlineKeyboardMarkup по ключу (kind, year, month, digest)."""
+
+    def __init__(self, max_size):
+        self.max_size = max(1, max_size)
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, kind, year, month, digest, builder):
+        """Возвращает клавиатуру из кеша или строит ее через builder() и запоминает."""
+        key = (kind, year, month, digest)
+        with self._lock:
+            markup = self._items.get(key)
+            if markup is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return markup
+
+        markup = builder()
+        with self._lock:
+            self.misses += 1
+            self._items[key] = markup
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        logging.debug(f"⌨️ Клавиатура {kind} {year}-{month} собрана и закеширована")
+        return markup
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+keyboard_cache = KeyboardCache(getattr(config, 'KEYBOARD_CACHE_SIZE', 128))
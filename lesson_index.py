@@ -0,0 +1,200 @@
+"""
+Индекс занятий по датам для интерактивного календаря бота.
+
+(год, месяц) -> день -> занятия, плюс счетчики статусов по дням. Строится из
+get_calendar_lessons() и дальше обновляется точечно (отметки, новые занятия),
+поэтому навигация по месяцам и просмотр дня не обращаются к Google Sheets.
+Подписчики (add_listener) узнают об изменившихся занятиях без перечитывания листа.
+"""
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import date
+
+# Столбцы листа 'Календарь занятий' (A-H) для занятий, добавленных в обход загрузки листа
+LESSON_COLUMNS = [
+    '№', 'ID абонемента', 'Дата занятия', 'Время начала',
+    'Статус посещения', 'Ребенок', 'Отметка', 'Время завершения'
+]
+
+
+def parse_lesson_date(date_str):
+    """Разбирает дату занятия 'Д.М.ГГГГ' (с ведущими нулями или без) в date или None."""
+    try:
+        day, month, year = (int(part) for part in str(date_str).strip().split('.'))
+        return date(year, month, day)
+    except (ValueError, TypeError):
+        return None
+
+
+class LessonDateIndex:
+    """Поддерживаемый индекс занятий по месяцам и дням."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._months = {}      # (год, месяц) -> {день: [занятия]}
+        self._counts = {}      # (год, месяц) -> {день: Counter статусов}
+        self._by_row = {}      # номер строки листа -> занятие
+        self._row_of = {}      # id(занятия) -> номер строки листа
+        self._by_id = {}       # ID занятия (столбец A) -> занятие
+        self._headers = list(LESSON_COLUMNS)
+        self._next_row = 2
+        self.built_at = None
+        self.version = 0       # растет при каждом изменении (перестроение, новые занятия, отметки)
+        self._listeners = []
+
+    @property
+    def is_built(self):
+        return self.built_at is not None
+
+    def age(self):
+        """Сколько секунд назад индекс строился из листа (None - еще не строился)."""
+        return time.time() - self.built_at if self.built_at else None
+
+    def add_listener(self, listener):
+        """Подписывает listener(lessons, rebuilt) на изменения занятий.
+
+        rebuilt=True - индекс перестроен целиком и lessons содержит все занятия.
+        Вызывается в потоке, изменившем индекс, под его блокировкой.
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, lessons, rebuilt=False):
+        for listener in self._listeners:
+            try:
+                listener(lessons, rebuilt)
+            except Exception as e:
+                logging.error(f"❌ Ошибка подписчика индекса занятий: {e}")
+
+    def invalidate(self):
+        """Сбрасывает индекс (после удаления строк, когда номера строк сдвинулись)."""
+        with self._lock:
+            self.built_at = None
+
+    def rebuild(self, lessons):
+        """Полностью перестраивает индекс по списку занятий из листа (по порядку строк)."""
+        with self._lock:
+            self._months = {}
+            self._counts = {}
+            self._by_row = {}
+            self._row_of = {}
+            self._by_id = {}
+            if lessons:
+                self._headers = list(lessons[0].keys())
+            for row_number, lesson in enumerate(lessons, start=2):
+                self._insert(lesson, row_number)
+            self._next_row = len(lessons) + 2
+            self.built_at = time.time()
+            self.version += 1
+            self._notify(lessons, rebuilt=True)
+
+    def _insert(self, lesson, row_number):
+        self._by_row[row_number] = lesson
+        self._row_of[id(lesson)] = row_number
+        lesson_id = str(lesson.get(self._headers[0], '')).strip()
+        if lesson_id:
+            self._by_id.setdefault(lesson_id, lesson)
+        lesson_date = parse_lesson_date(lesson.get('Дата занятия', ''))
+        if not lesson_date:
+            return
+        month_key = (lesson_date.year, lesson_date.month)
+        self._months.setdefault(month_key, {}).setdefault(lesson_date.day, []).append(lesson)
+        self._recount(month_key, lesson_date.day)
+
+    def _recount(self, month_key, day):
+        lessons = self._months.get(month_key, {}).get(day, [])
+        self._counts.setdefault(month_key, {})[day] = Counter(
+            str(lesson.get('Статус посещения', '')).strip().lower() for lesson in lessons
+        )
+
+    def add_rows(self, rows):
+        """Добавляет занятия, дописанные в конец листа (строки-списки в порядке столбцов)."""
+        with self._lock:
+            if not self.is_built:
+                return
+            added = []
+            for row in rows:
+                lesson = {header: (str(row[i]) if i < len(row) else '') for i, header in enumerate(self._headers)}
+                self._insert(lesson, self._next_row)
+                self._next_row += 1
+                added.append(lesson)
+            self.version += 1
+            self._notify(added)
+
+    def lesson_changed(self, lesson):
+        """Пересчитывает счетчики дня после изменения статуса занятия (объект из индекса)."""
+        with self._lock:
+            lesson_date = parse_lesson_date(lesson.get('Дата занятия', ''))
+            if lesson_date:
+                self._recount((lesson_date.year, lesson_date.month), lesson_date.day)
+            self.version += 1
+            self._notify([lesson])
+
+    def set_mark(self, row_number, mark, status):
+        """Проставляет отметку и статус занятию по номеру строки листа."""
+        with self._lock:
+            lesson = self._by_row.get(row_number)
+            if lesson is None:
+                return None
+            lesson['Отметка'] = mark
+            lesson['Статус посещения'] = status
+            self.lesson_changed(lesson)
+            return lesson
+
+    def row_of(self, lesson):
+        """Номер строки листа для занятия из индекса."""
+        return self._row_of.get(id(lesson))
+
+    def find(self, lesson_id):
+        """Занятие по ID из кнопок бота: составной 'дата_индекс_ребенок', ID из столбца A или номер строки."""
+        lesson_id = str(lesson_id).strip()
+        if '_' in lesson_id and len(lesson_id.split('_')) >= 3:
+            parts = lesson_id.split('_')
+            target_date, target_child = parts[0], '_'.join(parts[2:])
+            try:
+                target_index = int(parts[1])
+            except ValueError:
+                return None
+            # Порядок занятий дня совпадает с порядком строк листа
+            matches = [
+                lesson for lesson in self.day(target_date)
+                if str(lesson.get('Ребенок', '')).strip() == target_child
+                and str(lesson.get('Дата занятия', '')).strip() == target_date
+            ]
+            return matches[target_index] if target_index < len(matches) else None
+
+        lesson = self._by_id.get(lesson_id)
+        if lesson is None and lesson_id.isdigit():
+            lesson = self._by_row.get(int(lesson_id))
+        return lesson
+
+    def lessons(self):
+        """Все занятия в порядке строк листа."""
+        with self._lock:
+            return [self._by_row[row] for row in sorted(self._by_row)]
+
+    def month(self, year, month):
+        """День -> занятия за месяц."""
+        return self._months.get((year, month), {})
+
+    def month_counts(self, year, month):
+        """День -> Counter статусов (в нижнем регистре) за месяц."""
+        return self._counts.get((year, month), {})
+
+    def day(self, date_str):
+        """Занятия на дату 'ДД.ММ.ГГГГ'."""
+        lesson_date = parse_lesson_date(date_str)
+        if not lesson_date:
+            return []
+        return list(self._months.get((lesson_date.year, lesson_date.month), {}).get(lesson_date.day, []))
+
+    def lessons_by_date(self, year, month):
+        """Занятия месяца в формате {'ДД.ММ.ГГГГ': [занятия]} (как ожидает generate_calendar_keyboard)."""
+        return {
+            f"{day:02d}.{month:02d}.{year}": list(lessons)
+            for day, lessons in self.month(year, month).items()
+        }
+
+    def total_lessons(self):
+        return len(self._by_row)
@@ -0,0 +1,286 @@
+"""
+Напоминания по отдельным занятиям: за N минут до 'Время начала' и напоминание
+об отметке после 'Время завершения', если занятие так и не отмечено.
+
+Таймеры хранятся в куче (heapq) с ленивой отменой: отмена только помечает
+запись, поэтому тысячи ожидающих таймеров стоят дешево, а цикл спит до
+ближайшего срабатывания. Таймеры пересчитываются точечно по событиям индекса
+занятий (новые занятия, отметки, перестроение индекса) - лист не перечитывается.
+
+Напоминания, пропущенные, пока бот не работал, досылаются после запуска
+(напоминание о начале - пока занятие не началось); повторы отсекает журнал доставки.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from google_sheets_service import sheets_service
+from lesson_index import parse_lesson_date
+from delivery_ledger import get_delivery_ledger, lesson_ref, KIND_BEFORE_START, KIND_UNMARKED
+import config
+
+REMINDER_BEFORE_START = KIND_BEFORE_START
+REMINDER_UNMARKED = KIND_UNMARKED
+
+
+def _lesson_key(lesson):
+    """Устойчивый ключ занятия (номера строк сдвигаются при удалении строк)."""
+    return (
+        str(lesson.get('ID абонемента', '')).strip(),
+        str(lesson.get('Ребенок', '')).strip(),
+        str(lesson.get('Дата занятия', '')).strip(),
+        str(lesson.get('Время начала', '')).strip(),
+    )
+
+
+def _lesson_datetime(lesson, time_column):
+    lesson_date = parse_lesson_date(lesson.get('Дата занятия', ''))
+    if not lesson_date:
+        return None
+    try:
+        lesson_time = datetime.strptime(str(lesson.get(time_column, '')).strip(), "%H:%M").time()
+    except ValueError:
+        return None
+    return datetime.combine(lesson_date, lesson_time)
+
+
+class LessonReminderScheduler:
+    """Куча таймеров напоминаний по занятиям с пересчетом по событиям индекса."""
+
+    MAX_SLEEP_SECONDS = 3600
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.chat_id = None
+        self.minutes_before = getattr(config, 'LESSON_REMINDER_MINUTES_BEFORE', 0)
+        self.unmarked_after = getattr(config, 'LESSON_UNMARKED_NUDGE_MINUTES', 0)
+        self.catch_up_seconds = getattr(config, 'NOTIFICATION_CATCH_UP_MINUTES', 180) * 60
+        self.is_running = False
+        self._heap = []       # [время срабатывания, порядковый номер, (вид, ключ занятия), занятие, активен]
+        self._timers = {}     # (вид, ключ занятия) -> запись кучи
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._wake = asyncio.Event()
+        self._loop = None
+        self._task = None
+
+    @property
+    def enabled(self):
+        return bool(self.minutes_before or self.unmarked_after)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._timers)
+
+    async def start(self, chat_id=None):
+        """Строит таймеры по индексу занятий и запускает цикл напоминаний."""
+        if self.is_running or not self.enabled:
+            return
+        self.chat_id = chat_id
+        self._loop = asyncio.get_running_loop()
+        self.is_running = True
+
+        lesson_index = await asyncio.to_thread(sheets_service.get_lesson_date_index)
+        lesson_index.add_listener(self.on_lessons_changed)
+        self.on_lessons_changed(lesson_index.lessons(), rebuilt=True)
+
+        self._task = asyncio.create_task(self._run())
+        logging.info(f"⏰ Напоминания по занятиям запущены: таймеров {self.pending_count()}")
+
+    async def stop(self):
+        self.is_running = False
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def _wanted_timers(self, lesson, now):
+        """(вид, ключ) -> время срабатывания (unix time) для занятия."""
+        if str(lesson.get('Отметка', '')).strip():
+            return {}
+        key = _lesson_key(lesson)
+        timers = {}
+        if self.minutes_before:
+            start_at = _lesson_datetime(lesson, 'Время начала')
+            if start_at and start_at.timestamp() > now:
+                fire_at = (start_at - timedelta(minutes=self.minutes_before)).timestamp()
+                timers[(REMINDER_BEFORE_START, key)] = fire_at
+        if self.unmarked_after:
+            end_at = _lesson_datetime(lesson, 'Время завершения')
+            if end_at:
+                fire_at = (end_at + timedelta(minutes=self.unmarked_after)).timestamp()
+                if fire_at > now - self.catch_up_seconds:
+                    timers[(REMINDER_UNMARKED, key)] = fire_at
+        return timers
+
+    def on_lessons_changed(self, lessons, rebuilt=False):
+        """Пересчитывает таймеры изменившихся занятий (подписка на индекс, любой поток)."""
+        now = time.time()
+        changed = False
+        with self._lock:
+            wanted = {}
+            for lesson in lessons:
+                for timer_key, fire_at in self._wanted_timers(lesson, now).items():
+                    wanted[timer_key] = (fire_at, lesson)
+
+            if rebuilt:
+                stale = [timer_key for timer_key in self._timers if timer_key not in wanted]
+            else:
+                lesson_keys = {_lesson_key(lesson) for lesson in lessons}
+                stale = [
+                    (kind, key) for kind in (REMINDER_BEFORE_START, REMINDER_UNMARKED)
+                    for key in lesson_keys if (kind, key) in self._timers and (kind, key) not in wanted
+                ]
+            for timer_key in stale:
+                self._timers.pop(timer_key)[4] = False
+                changed = True
+
+            for timer_key, (fire_at, lesson) in wanted.items():
+                entry = self._timers.get(timer_key)
+                if entry is not None and entry[0] == fire_at:
+                    entry[3] = lesson
+                    continue
+                if entry is not None:
+                    entry[4] = False
+                entry = [fire_at, next(self._counter), timer_key, lesson, True]
+                self._timers[timer_key] = entry
+                heapq.heappush(self._heap, entry)
+                changed = True
+
+            # Отмененных записей стало слишком много - пересобираем кучу
+            if len(self._heap) > 2 * len(self._timers) + 64:
+                self._heap = [entry for entry in self._heap if entry[4]]
+                heapq.heapify(self._heap)
+
+        if changed and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def _pop_due(self, now):
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                if entry[4]:
+                    self._timers.pop(entry[2], None)
+                    due.append(entry)
+            next_at = self._heap[0][0] if self._heap else None
+        return due, next_at
+
+    async def _run(self):
+        while self.is_running:
+            try:
+                self._wake.clear()
+                due, next_at = self._pop_due(time.time())
+                for entry in due:
+                    await self._fire(entry[2][0], entry[2][1], entry[3])
+                if due:
+                    continue
+
+                timeout = self.MAX_SLEEP_SECONDS
+                if next_at is not None:
+                    timeout = min(timeout, max(0.0, next_at - time.time()))
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ Ошибка в цикле напоминаний по занятиям: {e}", exc_info=True)
+                await asyncio.sleep(60)
+
+    def _resolve_chat_ids(self, child_name):
+        """Получатели напоминания: чаты уведомлений с подходящим фильтром детей."""
+        from notification_scheduler import get_notification_scheduler
+        notification_scheduler = get_notification_scheduler()
+        if notification_scheduler:
+            chat_ids = notification_scheduler.recipients_for_child(child_name)
+            if chat_ids:
+                return chat_ids
+        return [self.chat_id] if self.chat_id else []
+
+    async def _fire(self, kind, key, lesson):
+        # Занятие могли отметить или перенести после постановки таймера
+        if str(lesson.get('Отметка', '')).strip() or _lesson_key(lesson) != key:
+            return
+        child_name = lesson.get('Ребенок', '')
+        chat_ids = self._resolve_chat_ids(child_name)
+        if not chat_ids:
+            logging.warning("⚠️ Напоминание по занятию не отправлено: chat_id уведомлений не настроен")
+            return
+
+        subscription_id = str(lesson.get('ID абонемента', '')).strip()
+        start_time = lesson.get('Время начала', '')
+        end_time = lesson.get('Время завершения', '')
+        lesson_date = lesson.get('Дата занятия', '')
+        circle_name = await self._circle_name(subscription_id)
+
+        if kind == REMINDER_BEFORE_START:
+            message_text = f"⏰ *Через {self.minutes_before} мин. занятие*\n\n"
+            message_text += f"👤 *Ребенок:* {child_name}\n"
+            message_text += f"🎨 *Кружок:* {circle_name}\n"
+            message_text += f"🕐 *Время:* {start_time} - {end_time}"
+            await asyncio.gather(*(
+                self._send_start_reminder(chat_id, message_text, lesson_ref(subscription_id, child_name, start_time), lesson_date)
+                for chat_id in chat_ids
+            ))
+            logging.info(f"⏰ Напоминание о начале занятия: {child_name} - {circle_name} {start_time}")
+            return
+
+        # Занятие прошло, а отметки нет - отправляем то же уведомление с кнопками отметки
+        from notification_scheduler import get_notification_scheduler, lesson_notification_payload
+        notification_scheduler = get_notification_scheduler(self.bot)
+        lesson_index = sheets_service.lesson_index
+        if not lesson_index.is_built:
+            # Строки удалялись - номер строки берем из перестроенного индекса
+            lesson_index = await asyncio.to_thread(sheets_service.get_lesson_date_index)
+            lesson = next((item for item in lesson_index.day(lesson_date) if _lesson_key(item) == key), None)
+            if lesson is None or str(lesson.get('Отметка', '')).strip():
+                return
+        row_index = lesson_index.row_of(lesson)
+        lesson_id = str(lesson.get('ID занятия', '')).strip() or str(row_index)
+        payload = lesson_notification_payload(lesson, lesson_id, circle_name, row_index)
+        await asyncio.gather(*(
+            notification_scheduler.send_once(payload, REMINDER_UNMARKED, chat_id=chat_id) for chat_id in chat_ids
+        ))
+        logging.info(f"📝 Напоминание об отметке: {child_name} - {circle_name} ({lesson_date})")
+
+    async def _send_start_reminder(self, chat_id, message_text, lesson_id, lesson_date):
+        ledger = get_delivery_ledger()
+        ledger_key = (chat_id, lesson_id, REMINDER_BEFORE_START, lesson_date)
+        if not await asyncio.to_thread(ledger.claim, *ledger_key):
+            return
+        sent = False
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=message_text, parse_mode='Markdown')
+            sent = True
+        except Exception as e:
+            logging.error(f"❌ Ошибка при отправке напоминания о занятии в чат {chat_id}: {e}")
+        finally:
+            if sent:
+                await asyncio.to_thread(ledger.mark_sent, *ledger_key)
+            else:
+                await asyncio.to_thread(ledger.release, *ledger_key)
+
+    async def _circle_name(self, subscription_id):
+        sub_details = await asyncio.to_thread(sheets_service.get_subscription_details, subscription_id, True)
+        return sub_details.get('circle_name', 'Неизвестно') if sub_details else 'Неизвестно'
+
+
+# Глобальный экземпляр
+lesson_reminders = None
+
+def get_lesson_reminders(bot=None) -> LessonReminderScheduler:
+    """Получает глобальный экземпляр напоминаний по занятиям"""
+    global lesson_reminders
+
+    if lesson_reminders is None and bot is not None:
+        lesson_reminders = LessonReminderScheduler(bot)
+
+    return lesson_reminders
@@ -52,6 +52,16 @@ def main():
             print(f"❌ Ошибка запуска Telegram Bot: {e}")
             sys.exit(1)
             
+    elif service_mode == 'webhook':
+        # Бот в webhook-режиме и дашборд на одном асинхронном сервере
+        print("🌐 Запуск бота (webhook) и дашборда на одном сервере...")
+        try:
+            from bot_main import main as bot_main
+            bot_main(mode='webhook')
+        except Exception as e:
+            print(f"❌ Ошибка запуска webhook-сервера: {e}")
+            sys.exit(1)
+            
     elif service_mode == 'both':
         # Оба сервиса (устаревший режим)
         print("🚀 Запуск обоих сервисов...")
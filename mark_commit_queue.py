@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+from google_sheets_service import sheets_service
+import config
+
+
+class MarkCommitQueue:
+    """Фоновая запись отметок посещения в Google Sheets.
+
+    Пользователь сразу получает подтверждение, а запись (update_lesson_mark +
+    update_subscription_stats) выполняется здесь. Очередь хранится в файле, поэтому
+    незаписанные отметки переживают перезапуск бота. При ошибке (чаще всего 429)
+    задание возвращается в очередь по таймеру с растущей паузой и не задерживает
+    следующие отметки. Если все попытки исчерпаны, отметка в памяти откатывается
+    к прежнему значению, а пользователь получает новое сообщение об ошибке.
+    Новая отметка того же занятия заменяет еще не записанную.
+    """
+
+    def __init__(self, bot: Bot, path=None):
+        self.bot = bot
+        self.path = path or getattr(config, 'MARK_QUEUE_FILE', 'pending_marks.json')
+        self.max_attempts = max(1, getattr(config, 'MARK_COMMIT_MAX_ATTEMPTS', 5))
+        self.retry_delay = getattr(config, 'MARK_COMMIT_RETRY_DELAY', 15)
+        self.on_committed = None  # async callback(job) после успешной записи
+        self._jobs = {}
+        self._queue = None
+        self._worker_task = None
+
+    async def start(self, on_committed=None):
+        """Загружает незаписанные отметки из файла и запускает обработчик очереди."""
+        if self._worker_task:
+            return
+        self.on_committed = on_committed
+        self._queue = asyncio.Queue()
+        self._jobs = self._load()
+        for job in self._jobs.values():
+            self._queue.put_nowait(job['job_id'])
+        if self._jobs:
+            logging.info(f"📥 Восстановлено {len(self._jobs)} незаписанных отметок из {self.path}")
+        self._worker_task = asyncio.create_task(self._worker_loop())
+        logging.info("🚀 Очередь записи отметок запущена")
+
+    async def submit(self, lesson_id, mark, chat_id=None, retry_callback=None,
+                     previous_mark='', previous_status=''):
+        """Ставит отметку в очередь записи и возвращает задание.
+
+        previous_mark/previous_status - значения занятия до оптимистичной отметки,
+        к ним занятие в памяти откатывается, если запись так и не удалась.
+        """
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'lesson_id': str(lesson_id),
+            'mark': mark,
+            'chat_id': chat_id,
+            'retry_callback': retry_callback,
+            'previous_mark': previous_mark,
+            'previous_status': previous_status,
+            'attempts': 0,
+            'created_at': time.time(),
+        }
+        # Еще не записанная отметка того же занятия устарела: ее повтор не должен
+        # перезаписать новую, а откатывать в случае ошибки нужно к исходному значению
+        for superseded in [old for old in self._jobs.values() if old['lesson_id'] == job['lesson_id']]:
+            self._jobs.pop(superseded['job_id'])
+            job['previous_mark'] = superseded.get('previous_mark', '')
+            job['previous_status'] = superseded.get('previous_status', '')
+            logging.info(f"ℹ️ Незаписанная отметка '{superseded['mark']}' для занятия {lesson_id} заменена новой")
+        self._jobs[job['job_id']] = job
+        self._save()
+        if self._queue is None:
+            # Очередь еще не запущена - задание будет подхвачено из файла при старте
+            logging.warning("⚠️ Очередь записи отметок не запущена, отметка сохранена в файл")
+        else:
+            self._queue.put_nowait(job['job_id'])
+        logging.info(f"📝 Отметка '{mark}' для занятия {lesson_id} поставлена в очередь записи")
+        return job
+
+    def pending_count(self):
+        return len(self._jobs)
+
+    async def _worker_loop(self):
+        while True:
+            job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            if not job:
+                continue
+            try:
+                await self._process(job)
+            except Exception as e:
+                logging.error(f"❌ Ошибка обработки очереди отметок: {e}", exc_info=True)
+
+    async def _process(self, job):
+        """Одна попытка записи; при ошибке задание возвращается в очередь по таймеру."""
+        job['attempts'] += 1
+        self._save()
+        try:
+            subscription_id = await asyncio.to_thread(self._commit, job)
+        except Exception as e:
+            if job['job_id'] not in self._jobs:
+                # Пока шла запись, занятие отметили заново - повторять устаревшую отметку не нужно
+                logging.info(f"ℹ️ Отметка '{job['mark']}' для занятия {job['lesson_id']} заменена новой, повтор отменен")
+                return
+            if job['attempts'] >= self.max_attempts:
+                logging.error(f"❌ Отметка для занятия {job['lesson_id']} не записана после {job['attempts']} попыток: {e}")
+                self._finish(job)
+                await asyncio.to_thread(self._revert, job)
+                await self._notify_failure(job, e)
+                return
+            delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+            logging.warning(f"⚠️ Не удалось записать отметку для занятия {job['lesson_id']} "
+                            f"(попытка {job['attempts']}/{self.max_attempts}): {e}. Повтор через {delay} сек")
+            # Повтор вне очереди: следующие отметки записываются, пока это задание ждет
+            asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, job['job_id'])
+            return
+
+        job['subscription_id'] = subscription_id
+        self._finish(job)
+        logging.info(f"✅ Отметка '{job['mark']}' для занятия {job['lesson_id']} записана в таблицу")
+        if self.on_committed:
+            try:
+                await self.on_committed(job)
+            except Exception as e:
+                logging.error(f"❌ Ошибка обработчика после записи отметки: {e}")
+
+    def _revert(self, job):
+        """Откатывает оптимистичную отметку в памяти (календарь, индекс занятий) к прежнему значению."""
+        if any(other['lesson_id'] == job['lesson_id'] for other in self._jobs.values()):
+            # Пока шли попытки, занятие отметили заново - откатывать нечего
+            return
+        try:
+            sheets_service.revert_lesson_mark_in_memory(
+                job['lesson_id'], job['mark'], job.get('previous_mark', ''), job.get('previous_status', '')
+            )
+        except Exception as e:
+            logging.error(f"❌ Не удалось откатить отметку занятия {job['lesson_id']} в памяти: {e}")
+
+    def _commit(self, job):
+        """Синхронная запись отметки и статистики абонемента (выполняется в потоке)."""
+        result = sheets_service.update_lesson_mark(job['lesson_id'], job['mark'])
+        if not result:
+            # update_lesson_mark сам логирует причину (квота 429, сеть, таймаут)
+            raise RuntimeError("update_lesson_mark вернул ошибку")
+
+        subscription_id = result.get('subscription_id') if isinstance(result, dict) else None
+        if subscription_id:
+            stats_result = sheets_service.update_subscription_stats(subscription_id)
+            logging.info(f"✅ Статистика абонемента {subscription_id} обновлена: {stats_result}")
+        return subscription_id
+
+    def _finish(self, job):
+        self._jobs.pop(job['job_id'], None)
+        self._save()
+
+    async def _notify_failure(self, job, error):
+        """Пишет пользователю новое сообщение: отметка не сохранилась.
+
+        Исходное сообщение к этому времени уже занято другим экраном (календарь),
+        поэтому оно не редактируется.
+        """
+        if not job.get('chat_id'):
+            return
+
+        error_message = f"❌ <b>Отметка не сохранилась</b>\n\n"
+        error_message += f"Не удалось записать отметку '{job['mark']}' для занятия {job['lesson_id']} "
+        error_message += f"после {job['attempts']} попыток. Отметка в боте отменена.\n\n"
+        error_message += "⏰ <b>Рекомендация:</b> Подождите 30-60 секунд и поставьте отметку снова."
+
+        keyboard = []
+        if job.get('retry_callback'):
+            keyboard.append([InlineKeyboardButton("🔄 Попробовать снова", callback_data=job['retry_callback'])])
+        keyboard.append([InlineKeyboardButton("📅 Календарь занятий", callback_data="menu_calendar")])
+
+        try:
+            await self.bot.send_message(
+                chat_id=job['chat_id'],
+                text=error_message,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logging.error(f"❌ Не удалось сообщить об ошибке записи отметки: {e}")
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                jobs = json.load(f)
+            return {job['job_id']: job for job in jobs}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.error(f"❌ Не удалось прочитать очередь отметок {self.path}: {e}")
+            return {}
+
+    def _save(self):
+        """Атомарно сохраняет незаписанные отметки в файл."""
+        try:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(list(self._jobs.values()), f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logging.error(f"❌ Не удалось сохранить очередь отметок {self.path}: {e}")
+
+
+# Глобальный экземпляр очереди
+mark_commit_queue = None
+
+def get_mark_commit_queue(bot: Bot = None) -> MarkCommitQueue:
+    """Получает глобальный экземпляр очереди записи отметок"""
+    global mark_commit_queue
+
+    if mark_commit_queue is None and bot is not None:
+        mark_commit_queue = MarkCommitQueue(bot)
+
+    return mark_commit_queue
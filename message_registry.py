@@ -0,0 +1,128 @@
+"""
+Реестр сообщений, отправленных ботом (и полученных от пользователя), по чатам.
+
+Telegram не дает получить список сообщений чата, поэтому раньше очистка чата
+перебирала угаданные ID подряд. Теперь бот запоминает ID реальных сообщений в
+кольцевом буфере на каждый чат, а очистка удаляет именно их пачками через
+deleteMessages (до 100 ID за вызов).
+"""
+import asyncio
+import logging
+import threading
+from collections import deque
+
+from telegram import Update
+from telegram.error import TelegramError
+from telegram.ext import ContextTypes, ExtBot
+
+import config
+
+# Лимит deleteMessages на один вызов
+DELETE_MESSAGES_BATCH = 100
+
+
+class MessageRegistry:
+    """ID сообщений по чатам в ограниченных кольцевых буферах."""
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def record(self, chat_id, message_id):
+        if not chat_id or not message_id:
+            return
+        with self._lock:
+            buffer = self._chats.get(chat_id)
+            if buffer is None:
+                buffer = self._chats[chat_id] = deque(maxlen=self.size)
+            buffer.append(message_id)
+
+    def forget(self, chat_id, message_ids):
+        with self._lock:
+            buffer = self._chats.get(chat_id)
+            if not buffer:
+                return
+            forgotten = set(message_ids)
+            self._chats[chat_id] = deque((mid for mid in buffer if mid not in forgotten), maxlen=self.size)
+
+    def message_ids(self, chat_id):
+        """ID сообщений чата (без повторов, от старых к новым)."""
+        with self._lock:
+            return list(dict.fromkeys(self._chats.get(chat_id, ())))
+
+    def count(self, chat_id):
+        with self._lock:
+            return len(self._chats.get(chat_id, ()))
+
+
+message_registry = MessageRegistry(getattr(config, 'MESSAGE_REGISTRY_SIZE', 200))
+
+
+class TrackingBot(ExtBot):
+    """ExtBot, который записывает отправленные сообщения в реестр."""
+
+    def _track(self, message):
+        if message is not None:
+            message_registry.record(message.chat_id, message.message_id)
+        return message
+
+    async def send_message(self, *args, **kwargs):
+        return self._track(await super().send_message(*args, **kwargs))
+
+    async def send_photo(self, *args, **kwargs):
+        return self._track(await super().send_photo(*args, **kwargs))
+
+    async def send_document(self, *args, **kwargs):
+        return self._track(await super().send_document(*args, **kwargs))
+
+    async def delete_message(self, chat_id, message_id, *args, **kwargs):
+        result = await super().delete_message(chat_id, message_id, *args, **kwargs)
+        message_registry.forget(chat_id, [message_id])
+        return result
+
+
+async def track_incoming_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Записывает входящие сообщения пользователя (регистрируется в группе -1, до диалога)."""
+    if update.message:
+        message_registry.record(update.message.chat_id, update.message.message_id)
+
+
+async def delete_tracked_messages(bot, chat_id, exclude=()):
+    """Удаляет известные реестру сообщения чата и возвращает число удаленных.
+
+    Сообщения удаляются пачками через deleteMessages; если пачка не прошла
+    целиком, ее сообщения удаляются по одному с ограниченным параллелизмом.
+    """
+    excluded = set(exclude)
+    message_ids = [mid for mid in message_registry.message_ids(chat_id) if mid not in excluded]
+    if not message_ids:
+        return 0
+
+    deleted_count = 0
+    for start in range(0, len(message_ids), DELETE_MESSAGES_BATCH):
+        batch = message_ids[start:start + DELETE_MESSAGES_BATCH]
+        try:
+            await bot.delete_messages(chat_id=chat_id, message_ids=batch)
+            deleted_count += len(batch)
+        except TelegramError as e:
+            logging.warning(f"⚠️ Пакетное удаление {len(batch)} сообщений не удалось ({e}), удаляю по одному")
+            deleted_count += await _delete_one_by_one(bot, chat_id, batch)
+        message_registry.forget(chat_id, batch)
+    return deleted_count
+
+
+async def _delete_one_by_one(bot, chat_id, message_ids):
+    semaphore = asyncio.Semaphore(max(1, getattr(config, 'MESSAGE_DELETE_CONCURRENCY', 5)))
+
+    async def delete(message_id):
+        async with semaphore:
+            try:
+                await bot.delete_message(chat_id=chat_id, message_id=message_id)
+                return True
+            except TelegramError:
+                # Сообщение уже удалено или старше 48 часов
+                return False
+
+    results = await asyncio.gather(*(delete(message_id) for message_id in message_ids))
+    return sum(results)
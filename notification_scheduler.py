@@ -1,24 +1,114 @@
 import asyncio
+import html
 import logging
 from datetime import datetime, time, timedelta
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from google_sheets_service import sheets_service
+from delivery_ledger import get_delivery_ledger, lesson_ref, KIND_DAILY, KIND_DIGEST
 import config
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Словарь соответствия статусов и эмодзи (как в календаре)
+STATUS_EMOJIS = {
+    'посещение': '✅',
+    'пропуск (по вине)': '❌',
+    'пропуск': '❌',
+    'отмена (болезнь)': '🤒',
+    'перенос': '🔄',
+    'отмена': '🚫',
+    'болезнь': '🤒',
+    'уважительная причина': '📋',
+    'неуважительная причина': '⚠️'
+}
+
+# Лимиты Telegram для сводки: 4096 символов текста, 100 кнопок (берем с запасом)
+DIGEST_MAX_TEXT = 3800
+DIGEST_MAX_BUTTONS = 90
+DIGEST_BUTTONS_PER_ROW = 5
+
+
+def status_emoji(status: str) -> str:
+    """Эмодзи для статуса посещения: точное, затем частичное совпадение, иначе 📝."""
+    status_lower = status.lower().strip()
+    if status_lower in STATUS_EMOJIS:
+        return STATUS_EMOJIS[status_lower]
+    for key, value in STATUS_EMOJIS.items():
+        if key in status_lower:
+            return value
+    return '📝'
+
+
+def parse_recipients(value: str) -> dict:
+    """Получатели из компактной строки 'chat_id:Ребенок1,Ребенок2;chat_id:*'.
+
+    Возвращает chat_id -> frozenset имен детей (в нижнем регистре) или None (все дети).
+    """
+    recipients = {}
+    for item in str(value or '').split(';'):
+        chat_id, _, children = item.partition(':')
+        chat_id = chat_id.strip()
+        if not chat_id:
+            continue
+        names = frozenset(name.strip().lower() for name in children.split(',') if name.strip() and name.strip() != '*')
+        recipients[chat_id] = names or None
+    return recipients
+
+
+def lesson_notification_payload(lesson: dict, lesson_id: str, circle_name: str, row_index=None) -> dict:
+    """Данные занятия для уведомления (формат _send_lesson_notification)."""
+    return {
+        'lesson_id': lesson_id,
+        'child_name': lesson.get('Ребенок', '') or "Неизвестно",
+        'circle_name': circle_name,
+        'subscription_id': str(lesson.get('ID абонемента', '')).strip(),
+        'start_time': lesson.get('Время начала', ''),
+        'end_time': lesson.get('Время завершения', ''),
+        'date': lesson.get('Дата занятия', ''),
+        'row_index': row_index
+    }
+
 class NotificationScheduler:
-    """Планировщик уведомлений о занятиях"""
+    """Планировщик уведомлений о занятиях.
+
+    Уведомления отправляются точно в настроенное время: планировщик спит до
+    ближайшего срабатывания и просыпается раньше, только если время изменили
+    через reschedule(). Справочник читается один раз при запуске.
+
+    Данные для уведомлений (индекс занятий, кружки абонементов, статусы
+    посещения) готовятся заранее - за NOTIFICATION_PREPARE_HOURS до отправки,
+    поэтому утром занятия дня берутся из индекса в памяти без чтения листов.
+
+    Кроме основного чата (O2) уведомления получают дополнительные получатели
+    из ячейки P2 (например, родители с фильтром по детям). Занятия дня
+    вычисляются один раз, каждому получателю достается отфильтрованная часть,
+    а отправка идет параллельно по чатам (лимиты Telegram держит очередь отправки).
+    """
+    
+    # Дольше одного отрезка не спим, чтобы переход часов/сон сервера не сбивал срабатывание
+    MAX_SLEEP_SECONDS = 3600
     
     def __init__(self, bot: Bot):
         self.bot = bot
         self.chat_id = None  # Будет установлен динамически
         self.is_running = False
         self.current_task = None
+        self.notification_time = None  # "HH:MM"
+        self.next_run_at = None
+        self._last_sent_date = None
+        self._reschedule_event = asyncio.Event()
+        self.prepare_ahead = timedelta(hours=getattr(config, 'NOTIFICATION_PREPARE_HOURS', 12))
+        self._prepared = None  # данные уведомлений, подготовленные заранее
+        self._prepare_attempted_for = None
+        self.recipients = {}  # дополнительные получатели: chat_id -> фильтр детей или None
+        self._retry_tasks = set()  # отложенные повторы неудавшихся ежедневных отправок
         
-    async def start_scheduler(self):
-        """Запускает планировщик уведомлений"""
+    async def start_scheduler(self, notification_time: str = None):
+        """Запускает планировщик уведомлений (время по умолчанию берется из Справочника)"""
+        if notification_time:
+            self.reschedule(notification_time)
+            
         if self.is_running:
             logging.info("📅 Планировщик уведомлений уже запущен")
             return
@@ -26,6 +116,10 @@ class NotificationScheduler:
         self.is_running = True
         logging.info("🚀 Запуск планировщика уведомлений")
         
+        if not self.notification_time:
+            self.notification_time = await asyncio.to_thread(self._get_notification_time)
+        self.recipients = parse_recipients(await asyncio.to_thread(sheets_service.get_notification_recipients))
+        
         # Запускаем основной цикл планировщика
         self.current_task = asyncio.create_task(self._scheduler_loop())
         
@@ -35,51 +129,151 @@ class NotificationScheduler:
             return
             
         self.is_running = False
+        self.next_run_at = None
         if self.current_task:
             self.current_task.cancel()
             try:
                 await self.current_task
             except asyncio.CancelledError:
                 pass
+        for task in list(self._retry_tasks):
+            task.cancel()
                 
         logging.info("⏹️ Планировщик уведомлений остановлен")
         
+    def reschedule(self, notification_time: str):
+        """Меняет время уведомлений; работающий цикл сразу пересчитывает срабатывание."""
+        self.notification_time = notification_time
+        self._reschedule_event.set()
+        logging.info(f"⏰ Время уведомлений изменено: {notification_time}")
+        
     async def _scheduler_loop(self):
-        """Основной цикл планировщика"""
+        """Основной цикл планировщика: сон до ближайшего срабатывания"""
         logging.info("🔄 Планировщик уведомлений: начало основного цикла")
         
         while self.is_running:
             try:
-                from datetime import datetime
-                current_time = datetime.now().strftime("%H:%M:%S")
-                
-                # Получаем настроенное время уведомлений
-                notification_time = self._get_notification_time()
+                self._reschedule_event.clear()
+                self.next_run_at = self._next_run_time(self.notification_time)
                 
-                if notification_time:
-                    logging.debug(f"⏰ Текущее время: {current_time}, целевое время: {notification_time}")
-                    
-                    # Проверяем, пора ли отправлять уведомления
-                    if self._is_notification_time(notification_time):
-                        logging.info(f"🔔 ПОРА ОТПРАВЛЯТЬ УВЕДОМЛЕНИЯ! Текущее время: {current_time}")
-                        await self._send_daily_notifications()
-                        
-                        # Ждем до следующего дня, чтобы не отправлять дубли
-                        logging.info("⏳ Жду 1 час перед следующей проверкой (чтобы избежать дублей)")
-                        await asyncio.sleep(3600)  # Ждем час
-                    else:
-                        logging.debug(f"⏰ Еще не время для уведомлений (текущее: {current_time}, целевое: {notification_time})")
-                else:
+                if self.next_run_at is None:
                     logging.warning("⚠️ Время уведомлений не настроено в Справочнике (ячейка N2)")
+                    await self._reschedule_event.wait()
+                    continue
+                
+                run_date = self.next_run_at.date()
+                prepare_at = self.next_run_at - self.prepare_ahead
+                if self._prepare_attempted_for != run_date and datetime.now() >= prepare_at:
+                    self._prepare_attempted_for = run_date
+                    await asyncio.to_thread(self.prepare_notifications, run_date)
+                    continue
                 
-                # Проверяем каждые 5 минут
-                logging.debug(f"💤 Засыпаю на 5 минут... (текущее время: {current_time})")
-                await asyncio.sleep(300)
+                wake_at = self.next_run_at if self._prepare_attempted_for == run_date else prepare_at
+                delay = (wake_at - datetime.now()).total_seconds()
+                if delay > 0:
+                    logging.info(f"⏰ Следующие уведомления: {self.next_run_at.strftime('%d.%m.%Y %H:%M')}")
+                    try:
+                        await asyncio.wait_for(self._reschedule_event.wait(),
+                                               timeout=min(delay, self.MAX_SLEEP_SECONDS))
+                    except asyncio.TimeoutError:
+                        pass
+                    # Время изменили или проснулись на промежуточной отметке - пересчитываем
+                    continue
                 
+                logging.info(f"🔔 ПОРА ОТПРАВЛЯТЬ УВЕДОМЛЕНИЯ! Текущее время: {datetime.now().strftime('%H:%M:%S')}")
+                self._last_sent_date = self.next_run_at.date()
+                await self._send_daily_notifications()
+                
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 logging.error(f"❌ Ошибка в планировщике уведомлений: {e}", exc_info=True)
-                await asyncio.sleep(300)  # Ждем 5 минут перед повтором
+                await asyncio.sleep(60)
+                
+    def _next_run_time(self, notification_time: str):
+        """Ближайшее время отправки (сегодня, если еще не отправляли и не опоздали больше чем на NOTIFICATION_CATCH_UP_MINUTES)."""
+        if not notification_time:
+            return None
+        try:
+            target_time = datetime.strptime(notification_time.strip(), "%H:%M").time()
+        except ValueError:
+            logging.error(f"❌ Неверный формат времени уведомлений: '{notification_time}'")
+            return None
+        
+        now = datetime.now()
+        run_at = datetime.combine(now.date(), target_time)
+        # Бот запущен после времени уведомлений - досылаем пропущенные
+        # (журнал доставки не даст отправить уже отправленные)
+        catch_up = timedelta(minutes=getattr(config, 'NOTIFICATION_CATCH_UP_MINUTES', 180))
+        if run_at.date() == self._last_sent_date or run_at < now - catch_up:
+            run_at += timedelta(days=1)
+        return run_at
+        
+    def _schedule_retry(self, send, retry_until, attempt: int, what: str):
+        """Повторяет неудавшуюся отправку позже (с растущей паузой), пока не вышло окно досылки."""
+        if retry_until is None:
+            return
+        base = getattr(config, 'NOTIFICATION_RETRY_SECONDS', 60)
+        delay = min(base * 2 ** attempt, 15 * 60)
+        if base <= 0 or datetime.now() + timedelta(seconds=delay) > retry_until:
+            logging.warning(f"⚠️ {what}: окно досылки истекло, повторов больше не будет")
+            return
+        logging.info(f"🔁 {what}: повтор через {delay} с")
+        
+        async def retry():
+            await asyncio.sleep(delay)
+            await send()
+        
+        task = asyncio.create_task(retry())
+        self._retry_tasks.add(task)
+        task.add_done_callback(self._retry_tasks.discard)
                 
+    def recipient_chats(self) -> dict:
+        """Все получатели уведомлений: chat_id -> фильтр детей (None - все дети)."""
+        chats = dict(self.recipients)
+        if self.chat_id:
+            # Основной чат получает уведомления обо всех детях
+            chats[str(self.chat_id)] = None
+        return chats
+        
+    def children_filter(self, chat_id):
+        """Фильтр детей получателя (None - все дети)."""
+        return self.recipient_chats().get(str(chat_id))
+        
+    def recipients_for_child(self, child_name: str) -> list:
+        """Чаты, которым нужны уведомления о занятиях ребенка."""
+        name = str(child_name).strip().lower()
+        return [chat_id for chat_id, children in self.recipient_chats().items()
+                if children is None or name in children]
+        
+    async def send_once(self, lesson: dict, kind: str = KIND_DAILY, statuses: list = None, chat_id=None,
+                        retry_until: datetime = None, attempt: int = 0) -> bool:
+        """Отправляет уведомление о занятии, если оно еще не отправлено (по журналу доставки).
+
+        С retry_until неудавшаяся отправка повторяется до этого времени.
+        """
+        chat_id = chat_id or self.chat_id
+        ledger = get_delivery_ledger()
+        key = (chat_id, lesson_ref(lesson.get('subscription_id', ''), lesson.get('child_name', ''),
+                                        lesson.get('start_time', '')), kind, lesson.get('date', ''))
+        if not await asyncio.to_thread(ledger.claim, *key):
+            logging.info(f"⏭️ Уведомление уже отправлено: {lesson.get('child_name', '')} {lesson.get('date', '')} ({kind})")
+            return False
+        sent = False
+        try:
+            sent = await self._send_lesson_notification(lesson, statuses=statuses, chat_id=chat_id)
+        finally:
+            if sent:
+                await asyncio.to_thread(ledger.mark_sent, *key)
+            else:
+                await asyncio.to_thread(ledger.release, *key)
+                self._schedule_retry(
+                    lambda: self.send_once(lesson, kind, statuses, chat_id, retry_until, attempt + 1),
+                    retry_until, attempt,
+                    f"Уведомление {lesson.get('child_name', '')} {lesson.get('date', '')} в чат {chat_id}"
+                )
+        return sent
+        
     def _get_notification_time(self) -> str:
         """Получает настроенное время уведомлений из Справочника через централизованный метод."""
         try:
@@ -97,26 +291,6 @@ class NotificationScheduler:
             logging.error(f"❌ Ошибка при получении времени уведомлений: {e}")
             return None
             
-    def _is_notification_time(self, notification_time: str) -> bool:
-        """Проверяет, пора ли отправлять уведомления"""
-        try:
-            # Парсим время из строки (формат: "HH:MM")
-            target_time = datetime.strptime(notification_time, "%H:%M").time()
-            current_time = datetime.now().time()
-            
-            # Проверяем, что текущее время в пределах 5 минут от целевого
-            current_minutes = current_time.hour * 60 + current_time.minute
-            target_minutes = target_time.hour * 60 + target_time.minute
-            
-            diff = abs(current_minutes - target_minutes)
-            
-            # Если разница меньше 5 минут, то пора отправлять
-            return diff <= 5
-            
-        except Exception as e:
-            logging.error(f"❌ Ошибка при проверке времени уведомлений: {e}")
-            return False
-            
     def set_chat_id(self, chat_id):
         """Устанавливает ID чата для отправки уведомлений"""
         self.chat_id = chat_id
@@ -133,119 +307,247 @@ class NotificationScheduler:
                 if saved_chat_id:
                     self.chat_id = saved_chat_id
                     logging.info(f"📱 Загружен chat_id из базы: {self.chat_id}")
-                else:
-                    logging.warning("⚠️ Chat ID не найден в базе данных, уведомления не будут отправлены")
-                    return
             
-            # Получаем занятия на сегодня
-            today_lessons = self._get_today_lessons()
+            recipients = self.recipient_chats()
+            if not recipients:
+                logging.warning("⚠️ Chat ID не найден в базе данных, уведомления не будут отправлены")
+                return
+            
+            # Получаем занятия на сегодня (из подготовленных заранее данных) - один раз для всех получателей
+            prepared = self._prepared
+            today_lessons = await asyncio.to_thread(self._get_today_lessons, prepared)
             
             if not today_lessons:
                 logging.info("📅 На сегодня занятий не найдено")
                 return
                 
-            logging.info(f"📚 Найдено занятий на сегодня: {len(today_lessons)}")
+            logging.info(f"📚 Найдено занятий на сегодня: {len(today_lessons)}, получателей: {len(recipients)}")
             
-            # Отправляем уведомление по каждому занятию
-            for lesson in today_lessons:
-                await self._send_lesson_notification(lesson)
-                await asyncio.sleep(2)  # Небольшая задержка между уведомлениями
+            statuses = prepared['statuses'] if prepared else None
+            # Неудавшиеся отправки повторяются в пределах окна досылки
+            retry_until = (self.next_run_at or datetime.now()) + timedelta(
+                minutes=getattr(config, 'NOTIFICATION_CATCH_UP_MINUTES', 180))
+            digest_mode = getattr(config, 'NOTIFICATION_MODE', 'per_lesson') == 'digest'
+            semaphore = asyncio.Semaphore(max(1, getattr(config, 'NOTIFICATION_FANOUT_CONCURRENCY', 10)))
+            
+            async def deliver(chat_id, children):
+                lessons = [lesson for lesson in today_lessons
+                           if children is None or str(lesson['child_name']).strip().lower() in children]
+                if not lessons:
+                    return
+                async with semaphore:
+                    if digest_mode:
+                        # Одно сообщение со всеми занятиями дня
+                        await self.send_digest_once(lessons[0]['date'], prepared, chat_id=chat_id, children=children,
+                                                    retry_until=retry_until)
+                        return
+                    # Уведомление по каждому занятию (темп задает очередь отправки)
+                    for lesson in lessons:
+                        await self.send_once(lesson, KIND_DAILY, statuses=statuses, chat_id=chat_id,
+                                             retry_until=retry_until)
+            
+            await asyncio.gather(*(deliver(chat_id, children) for chat_id, children in recipients.items()))
                 
         except Exception as e:
             logging.error(f"❌ Ошибка при отправке ежедневных уведомлений: {e}")
             
-    def _get_today_lessons(self) -> list:
-        """Получает список занятий на сегодня"""
+    async def send_digest_once(self, date_str: str, prepared: dict = None, chat_id=None, children=None,
+                               retry_until: datetime = None, attempt: int = 0) -> bool:
+        """Отправляет сводку занятий дня одним сообщением, если она еще не отправлена (повторы - как в send_once)."""
+        chat_id = chat_id or self.chat_id
+        ledger = get_delivery_ledger()
+        key = (chat_id, 'digest', KIND_DIGEST, date_str)
+        if not await asyncio.to_thread(ledger.claim, *key):
+            logging.info(f"⏭️ Сводка занятий на {date_str} уже отправлена")
+            return False
+        sent = False
+        try:
+            text, reply_markup = await asyncio.to_thread(self.build_digest, date_str, 0, None, prepared, children)
+            await self.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode='HTML')
+            sent = True
+            logging.info(f"✅ Сводка занятий на {date_str} отправлена")
+        except Exception as e:
+            logging.error(f"❌ Ошибка при отправке сводки занятий: {e}")
+        finally:
+            if sent:
+                await asyncio.to_thread(ledger.mark_sent, *key)
+            else:
+                await asyncio.to_thread(ledger.release, *key)
+                self._schedule_retry(
+                    lambda: self.send_digest_once(date_str, prepared, chat_id, children, retry_until, attempt + 1),
+                    retry_until, attempt, f"Сводка занятий на {date_str} в чат {chat_id}"
+                )
+        return sent
+        
+    def build_digest(self, date_str: str, page: int = 0, focus_lesson_id: str = None, prepared: dict = None,
+                     children=None):
+        """Сводка занятий на дату: текст (HTML) и клавиатура с рядом кнопок отметки на каждое занятие.
+
+        Если сводка не помещается в лимиты Telegram, она делится на страницы;
+        focus_lesson_id выбирает страницу с этим занятием, children - фильтр
+        детей получателя. Данные берутся из индекса занятий в памяти, поэтому
+        отметки видны сразу.
+        """
+        if not prepared or prepared.get('date') != date_str:
+            prepared = self._prepared if self._prepared and self._prepared.get('date') == date_str else None
+        if prepared:
+            circles, statuses = prepared['circles'], prepared['statuses']
+        else:
+            circles = {
+                str(sub.get('ID абонемента', '')).strip(): sub.get('Кружок', '') or 'Неизвестно'
+                for sub in sheets_service.get_subscriptions_data()
+            }
+            statuses = sheets_service.get_handbook_items("Статусы посещения")
+        statuses = [status for status in statuses if status.strip()]
+        
+        lesson_index = sheets_service.lesson_index
+        if not lesson_index.is_built:
+            lesson_index = sheets_service.get_lesson_date_index()
+        lessons = sorted(lesson_index.day(date_str), key=lambda lesson: str(lesson.get('Время начала', '')))
+        if children is not None:
+            lessons = [lesson for lesson in lessons if str(lesson.get('Ребенок', '')).strip().lower() in children]
+        
+        # Блок текста и ряды кнопок для каждого занятия
+        blocks = []
+        for number, lesson in enumerate(lessons, 1):
+            # ID занятия - как в календаре: столбец № или номер строки
+            lesson_id = str(lesson.get('№', '')).strip() or str(lesson_index.row_of(lesson))
+            circle_name = circles.get(str(lesson.get('ID абонемента', '')).strip(), 'Неизвестно')
+            mark = str(lesson.get('Отметка', '')).strip()
+            block = f"{number}. <b>{html.escape(str(lesson.get('Ребенок', '')))}</b> - {html.escape(str(circle_name))}\n"
+            block += f"    🕐 {lesson.get('Время начала', '')} - {lesson.get('Время завершения', '')}"
+            if mark:
+                block += f"  {status_emoji(mark)} {html.escape(mark)}"
+            rows = []
+            if not mark:
+                buttons = [
+                    InlineKeyboardButton(f"{number} {status_emoji(status)}",
+                                         callback_data=f"digest_mark_{lesson_id}|||{status}")
+                    for status in statuses
+                ]
+                rows = [buttons[i:i + DIGEST_BUTTONS_PER_ROW] for i in range(0, len(buttons), DIGEST_BUTTONS_PER_ROW)]
+            blocks.append((lesson_id, block + "\n", rows))
+        
+        marked = sum(1 for lesson in lessons if str(lesson.get('Отметка', '')).strip())
+        header = f"📋 <b>Занятия на {date_str}</b>\n"
+        header += f"Всего: {len(lessons)}, отмечено: {marked}\n"
+        if statuses:
+            header += " · ".join(f"{status_emoji(status)} {html.escape(status)}" for status in statuses) + "\n"
+        header += "\n"
+        
+        # Раскладываем занятия по страницам в пределах лимитов
+        pages = [[]]
+        text_size, button_count = len(header) + 40, 0
+        for block in blocks:
+            block_buttons = sum(len(row) for row in block[2])
+            if pages[-1] and (text_size + len(block[1]) > DIGEST_MAX_TEXT
+                              or button_count + block_buttons > DIGEST_MAX_BUTTONS):
+                pages.append([])
+                text_size, button_count = len(header) + 40, 0
+            pages[-1].append(block)
+            text_size += len(block[1])
+            button_count += block_buttons
+        
+        if focus_lesson_id is not None:
+            page = next((i for i, page_blocks in enumerate(pages)
+                         if any(block[0] == str(focus_lesson_id) for block in page_blocks)), page)
+        page = max(0, min(page, len(pages) - 1))
+        
+        text = header + "".join(block[1] for block in pages[page])
+        if not lessons:
+            text += "Занятий нет."
+        keyboard = [row for block in pages[page] for row in block[2]]
+        if len(pages) > 1:
+            text += f"\n📄 Страница {page + 1}/{len(pages)}"
+            navigation = []
+            if page > 0:
+                navigation.append(InlineKeyboardButton("◀️", callback_data=f"digest_page_{date_str}_{page - 1}"))
+            navigation.append(InlineKeyboardButton(f"{page + 1}/{len(pages)}", callback_data=f"digest_page_{date_str}_{page}"))
+            if page < len(pages) - 1:
+                navigation.append(InlineKeyboardButton("▶️", callback_data=f"digest_page_{date_str}_{page + 1}"))
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("📅 Календарь занятий", callback_data="menu_calendar")])
+        return text, InlineKeyboardMarkup(keyboard)
+        
+    def prepare_notifications(self, lesson_date) -> dict:
+        """Заранее готовит данные для уведомлений на дату: индекс занятий, кружки абонементов, статусы."""
+        try:
+            date_str = lesson_date.strftime('%d.%m.%Y')
+            lesson_index = sheets_service.get_lesson_date_index()
+            
+            circles = {}
+            for sub in sheets_service.get_subscriptions_data():
+                sub_id = str(sub.get('ID абонемента', '')).strip()
+                if sub_id:
+                    circles.setdefault(sub_id, sub.get('Кружок', '') or 'Неизвестно')
+            
+            # Получатели меняются редко - перечитываем вместе с остальными данными
+            self.recipients = parse_recipients(sheets_service.get_notification_recipients())
+            
+            self._prepared = {
+                'date': date_str,
+                'circles': circles,
+                'statuses': sheets_service.get_handbook_items("Статусы посещения"),
+            }
+            logging.info(f"📦 Уведомления на {date_str} подготовлены: занятий {len(lesson_index.day(date_str))}, "
+                         f"абонементов {len(circles)}")
+            return self._prepared
+            
+        except Exception as e:
+            logging.error(f"❌ Ошибка при подготовке уведомлений: {e}")
+            return None
+            
+    def _get_today_lessons(self, prepared: dict = None) -> list:
+        """Получает список неотмеченных занятий на сегодня.
+
+        Занятия берутся из индекса занятий в памяти и соединяются со словарем
+        кружков по ID абонемента; листы читаются, только если данные не были
+        подготовлены заранее (или индекс сброшен после удаления строк).
+        """
         try:
             today = datetime.now().strftime('%d.%m.%Y')
             logging.info(f"📅 Получение занятий на {today}")
             
-            # Получаем все занятия из календаря
-            calendar_sheet = sheets_service.spreadsheet.worksheet("Календарь занятий")
-            all_data = calendar_sheet.get_all_values()
-            
-            if len(all_data) <= 1:
-                return []
-                
-            headers = all_data[0]
-            today_lessons = []
+            if not prepared or prepared['date'] != today:
+                prepared = self.prepare_notifications(datetime.now().date())
+                if not prepared:
+                    return []
             
-            # Находим индексы нужных колонок
-            date_col = None
-            child_col = None
-            circle_col = None
-            time_start_col = None
-            time_end_col = None
-            lesson_id_col = None
-            status_col = None
+            lesson_index = sheets_service.lesson_index
+            if not lesson_index.is_built:
+                # После удаления строк номера строк в индексе неверны
+                lesson_index = sheets_service.get_lesson_date_index()
             
-            for i, header in enumerate(headers):
-                if 'дата' in header.lower():
-                    date_col = i
-                elif 'ребенок' in header.lower():
-                    child_col = i
-                elif 'кружок' in header.lower():
-                    circle_col = i
-                elif 'время начала' in header.lower():
-                    time_start_col = i
-                elif 'время завершения' in header.lower():
-                    time_end_col = i
-                elif 'id занятия' in header.lower():
-                    lesson_id_col = i
-                elif 'отметка' in header.lower() or 'статус' in header.lower():
-                    status_col = i
-                    
-            # Ищем занятия на сегодня
-            for row_index, row in enumerate(all_data[1:], start=2):
-                if len(row) > max(date_col or 0, child_col or 0, circle_col or 0):
-                    lesson_date = row[date_col] if date_col is not None else ""
-                    
-                    if lesson_date == today:
-                        # Проверяем, что занятие еще не отмечено
-                        status = row[status_col] if status_col is not None and status_col < len(row) else ""
-                        
-                        if not status or status.strip() == "":
-                            # Получаем ID абонемента для поиска названия кружка
-                            subscription_id = ""
-                            for i, header in enumerate(headers):
-                                if 'id абонемента' in header.lower():
-                                    subscription_id = row[i] if i < len(row) else ""
-                                    break
-                            
-                            # Получаем название кружка из абонемента
-                            circle_name = "Неизвестно"
-                            if subscription_id:
-                                sub_details = sheets_service.get_subscription_details(subscription_id)
-                                if sub_details:
-                                    circle_name = sub_details.get('circle_name', 'Неизвестно')
-                            
-                            # Получаем реальный lesson_id или создаем на основе строки
-                            real_lesson_id = row[lesson_id_col] if lesson_id_col is not None and lesson_id_col < len(row) else ""
-                            if not real_lesson_id or real_lesson_id.strip() == "":
-                                # Если ID занятия пустой, используем номер строки как ID
-                                real_lesson_id = str(row_index)
-                                logging.warning(f"⚠️ Пустой lesson_id в строке {row_index}, используем номер строки: {real_lesson_id}")
-                            
-                            lesson_data = {
-                                'lesson_id': real_lesson_id,
-                                'child_name': row[child_col] if child_col is not None else "Неизвестно",
-                                'circle_name': circle_name,
-                                'subscription_id': subscription_id,
-                                'start_time': row[time_start_col] if time_start_col is not None else "",
-                                'end_time': row[time_end_col] if time_end_col is not None else "",
-                                'date': lesson_date,
-                                'row_index': row_index
-                            }
-                            today_lessons.append(lesson_data)
-                            
+            today_lessons = []
+            for lesson in lesson_index.day(today):
+                # Проверяем, что занятие еще не отмечено
+                if str(lesson.get('Отметка', '')).strip():
+                    continue
+                
+                subscription_id = str(lesson.get('ID абонемента', '')).strip()
+                circle_name = prepared['circles'].get(subscription_id)
+                if circle_name is None:
+                    circle_name = "Неизвестно"
+                    if subscription_id:
+                        # Абонемент создан после подготовки данных
+                        sub_details = sheets_service.get_subscription_details(subscription_id, use_cache=True)
+                        if sub_details:
+                            circle_name = sub_details.get('circle_name', 'Неизвестно')
+                
+                # ID занятия - номер строки листа (как и раньше, если нет столбца 'ID занятия')
+                row_index = lesson_index.row_of(lesson)
+                real_lesson_id = str(lesson.get('ID занятия', '')).strip() or str(row_index)
+                
+                today_lessons.append(lesson_notification_payload(lesson, real_lesson_id, circle_name, row_index))
+                
             return today_lessons
             
         except Exception as e:
             logging.error(f"❌ Ошибка при получении занятий на сегодня: {e}")
             return []
             
-    async def _send_lesson_notification(self, lesson: dict, max_retries: int = 3):
-        """Отправляет уведомление о конкретном занятии с retry логикой"""
+    async def _send_lesson_notification(self, lesson: dict, max_retries: int = 3, statuses: list = None, chat_id=None):
+        """Отправляет уведомление о конкретном занятии с retry логикой. Возвращает True при успехе."""
         for attempt in range(max_retries):
             try:
                 lesson_id = lesson['lesson_id']
@@ -262,7 +564,7 @@ class NotificationScheduler:
                 logging.info(f"🎨 circle_name: '{circle_name}'")
                 logging.info(f"⏰ start_time: '{start_time}'")
                 logging.info(f"⏰ end_time: '{end_time}'")
-                logging.info(f"📱 chat_id: '{self.chat_id}'")
+                logging.info(f"📱 chat_id: '{chat_id or self.chat_id}'")
                 logging.info(f"🔄 Попытка: {attempt + 1}/{max_retries}")
                 
                 # Формируем текст уведомления - ТОЧНАЯ КОПИЯ из select_lesson_from_date
@@ -275,48 +577,19 @@ class NotificationScheduler:
                     message_text += f"🕐 *Время:* {start_time} - {end_time}\n"
                 message_text += "\nВыберите статус посещения:"
                 
-                # Получаем статусы посещения из Справочника
-                attendance_statuses = sheets_service.get_handbook_items("Статусы посещения")
+                # Статусы посещения из подготовленных данных или Справочника
+                attendance_statuses = statuses or await asyncio.to_thread(sheets_service.get_handbook_items, "Статусы посещения")
                 
                 if not attendance_statuses:
                     logging.error("❌ Не найдены статусы посещения в Справочнике")
-                    return
+                    return False
                     
                 # Создаем кнопки с отметками (используем ту же логику, что в календаре)
                 keyboard = []
                 
-                # Словарь соответствия статусов и эмодзи (точно как в календаре)
-                status_emojis = {
-                    'посещение': '✅',
-                    'пропуск (по вине)': '❌',
-                    'пропуск': '❌',
-                    'отмена (болезнь)': '🤒',
-                    'перенос': '🔄',
-                    'отмена': '🚫',
-                    'болезнь': '🤒',
-                    'уважительная причина': '📋',
-                    'неуважительная причина': '⚠️'
-                }
-                
                 for status in attendance_statuses:
                     if status.strip():  # Пропускаем пустые значения
-                        # Ищем подходящий эмодзи для статуса
-                        emoji = ''
-                        status_lower = status.lower().strip()
-                        
-                        # Проверяем точное совпадение
-                        if status_lower in status_emojis:
-                            emoji = status_emojis[status_lower]
-                        else:
-                            # Проверяем частичное совпадение
-                            for key, value in status_emojis.items():
-                                if key in status_lower:
-                                    emoji = value
-                                    break
-                        
-                        # Если эмодзи не найден, используем стандартный
-                        if not emoji:
-                            emoji = '📝'
+                        emoji = status_emoji(status)
                         
                         button_text = f"{emoji} {status}"
                         # Используем ТОЧНО тот же формат callback_data, что в календаре
@@ -338,7 +611,7 @@ class NotificationScheduler:
                 
                 # Отправляем уведомление с таймаутом - ТОЧНАЯ КОПИЯ из select_lesson_from_date
                 await self.bot.send_message(
-                    chat_id=self.chat_id,
+                    chat_id=chat_id or self.chat_id,
                     text=message_text,
                     reply_markup=reply_markup,
                     parse_mode='Markdown',  # Изменено на Markdown как в календаре
@@ -351,7 +624,7 @@ class NotificationScheduler:
                 logging.info(f"📬 Занятие: {child_name} - {circle_name}")
                 logging.info(f"🔘 Создано кнопок: {len(keyboard)}")
                 logging.info("=" * 60)
-                return  # Успешно отправлено, выходим из цикла
+                return True  # Успешно отправлено, выходим из цикла
                 
             except Exception as e:
                 attempt_info = f"(попытка {attempt + 1}/{max_retries})"
@@ -375,6 +648,7 @@ class NotificationScheduler:
                 if attempt == max_retries - 1:
                     logging.error(f"❌ Не удалось отправить уведомление после {max_retries} попыток: {child_name} - {circle_name}")
                     break
+        return False
 
 # Глобальный экземпляр планировщика
 notification_scheduler = None
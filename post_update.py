@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Отправляет записанные обновления Telegram (JSON) на локальный webhook-сервер.
+
+Пример:
+    BOT_MODE=webhook python bot_main.py
+    python post_update.py updates/start.json updates/callback.json
+
+Файл может содержать одно обновление или список обновлений. Адрес берется из
+WEBHOOK_PATH/PORT (по умолчанию http://localhost:5001/telegram), секрет - из WEBHOOK_SECRET.
+"""
+import json
+import os
+import sys
+
+import requests
+
+
+def post_updates(paths, url, secret=''):
+    headers = {'Content-Type': 'application/json'}
+    if secret:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = secret
+
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        updates = data if isinstance(data, list) else [data]
+        for update in updates:
+            response = requests.post(url, data=json.dumps(update), headers=headers, timeout=10)
+            print(f"{'✅' if response.ok else '❌'} {path} update_id={update.get('update_id')}: HTTP {response.status_code}")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    port = os.getenv('PORT', '5001')
+    path = os.getenv('WEBHOOK_PATH', '/telegram')
+    url = os.getenv('WEBHOOK_LOCAL_URL', f"http://localhost:{port}{path}")
+    post_updates(sys.argv[1:], url, os.getenv('WEBHOOK_SECRET', ''))
+
+
+if __name__ == "__main__":
+    main()
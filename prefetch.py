@@ -0,0 +1,85 @@
+"""
+Предзагрузка данных для экранов, которые пользователь, скорее всего, откроет следующими.
+
+Пока пользователь читает текущий экран, нужные следующему экрану листы
+загружаются в кеш сервиса таблиц в фоне:
+- список абонементов -> карточка абонемента (абонементы, шаблон расписания,
+  календарь, прогноз);
+- занятия на дату -> выбор отметки (статусы посещения из Справочника, абонементы);
+- выбор отметки -> сохранение и отчет (календарь, абонементы, прогноз).
+
+Загрузка идет через те же кешируемые методы, что и у обработчиков, поэтому
+данные не расходятся, а повторный переход на экран берет их из кеша.
+Одновременно выполняется не больше одной предзагрузки каждого вида, и один и
+тот же вид не запускается чаще, чем раз в PREFETCH_MIN_INTERVAL секунд.
+"""
+import asyncio
+import logging
+import time
+
+import config
+
+# Экран -> методы сервиса таблиц, которые понадобятся на следующем экране
+PREFETCH_PLANS = {
+    'subscriptions_menu': (
+        ('subscriptions', lambda service: service.get_subscriptions_data()),
+        ('schedule_templates', lambda service: service.get_schedule_templates()),
+        ('calendar', lambda service: service.get_calendar_lessons()),
+        ('forecast', lambda service: service.get_forecast_records()),
+    ),
+    'calendar_date': (
+        ('attendance_statuses', lambda service: service.get_handbook_items("Статусы посещения")),
+        ('subscriptions', lambda service: service.get_subscriptions_data()),
+    ),
+    'lesson_from_date': (
+        ('calendar', lambda service: service.get_calendar_lessons()),
+        ('subscriptions', lambda service: service.get_subscriptions_data()),
+        ('forecast', lambda service: service.get_forecast_records()),
+    ),
+}
+
+
+class Prefetcher:
+    """Фоновая предзагрузка данных в кеш сервиса таблиц."""
+
+    def __init__(self, service):
+        self.service = service
+        self.enabled = getattr(config, 'PREFETCH_ENABLED', True)
+        self.min_interval = getattr(config, 'PREFETCH_MIN_INTERVAL', 10)
+        self._tasks = {}
+        self._started_at = {}
+
+    def schedule(self, screen):
+        """Запускает в фоне предзагрузку для экрана, следующего за screen."""
+        if not self.enabled or self.service is None:
+            return
+        now = time.monotonic()
+        for name, loader in PREFETCH_PLANS.get(screen, ()):
+            task = self._tasks.get(name)
+            if task is not None and not task.done():
+                continue
+            if now - self._started_at.get(name, float('-inf')) < self.min_interval:
+                continue
+            self._started_at[name] = now
+            self._tasks[name] = asyncio.create_task(self._load(name, loader))
+
+    async def _load(self, name, loader):
+        started = time.monotonic()
+        try:
+            await asyncio.to_thread(loader, self.service)
+            logging.debug(f"⚡ Предзагрузка '{name}' за {time.monotonic() - started:.2f} сек")
+        except Exception as e:
+            logging.warning(f"⚠️ Предзагрузка '{name}' не удалась: {e}")
+
+
+# Глобальный экземпляр
+prefetcher = None
+
+def get_prefetcher(service=None) -> Prefetcher:
+    """Получает глобальный экземпляр предзагрузки"""
+    global prefetcher
+
+    if prefetcher is None:
+        prefetcher = Prefetcher(service)
+
+    return prefetcher
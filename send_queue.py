@@ -0,0 +1,216 @@
+"""
+Очередь исходящих запросов к Telegram Bot API.
+
+Подключается к боту как BaseRateLimiter, поэтому через нее проходят все вызовы
+(ответы обработчиков, уведомления, удаления сообщений), кроме getUpdates:
+- общий лимит бота для всех запросов и лимит отправок (send*) в группу с
+  небольшим допустимым всплеском; личные чаты, правки и удаления по чату не
+  ограничиваются - у Telegram для них нет такого лимита;
+- RetryAfter: чат ставится на паузу на указанное Telegram время, запрос повторяется;
+- повторные правки одного сообщения, пока первая ждет своей очереди,
+  склеиваются: в ее слот уходит последнее содержимое, все вызовы получают
+  один результат;
+- очередь запросов по каждому чату видна через backlog().
+"""
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import config
+
+# Правки, которые можно склеивать (последняя правка сообщения заменяет ожидающие)
+COALESCED_EDIT_ENDPOINTS = ('editMessageText', 'editMessageReplyMarkup', 'editMessageCaption')
+
+
+class _Bucket:
+    """Token bucket в виде расписания (GCRA): rate запросов в секунду, всплеск до burst."""
+
+    def __init__(self, rate, burst):
+        self.interval = 1.0 / rate
+        self.tolerance = (max(1, burst) - 1) * self.interval
+        self.next_at = 0.0
+
+    def reserve(self):
+        """Резервирует слот и возвращает, сколько секунд до него ждать."""
+        now = time.monotonic()
+        next_at = max(self.next_at, now)
+        wait = max(0.0, next_at - self.tolerance - now)
+        self.next_at = next_at + self.interval
+        return wait
+
+    def pause(self, seconds):
+        self.next_at = max(self.next_at, time.monotonic() + seconds)
+
+    def idle(self):
+        return self.next_at <= time.monotonic()
+
+
+class OutboundSendQueue(BaseRateLimiter[int]):
+    """Лимиты Telegram, обработка RetryAfter и склейка правок для всех исходящих запросов."""
+
+    def __init__(self):
+        self.global_rate = getattr(config, 'SEND_QUEUE_GLOBAL_RATE', 25)
+        self.group_rate = getattr(config, 'SEND_QUEUE_GROUP_CHAT_RATE', 20 / 60)
+        self.chat_burst = getattr(config, 'SEND_QUEUE_CHAT_BURST', 3)
+        self.max_retries = getattr(config, 'SEND_QUEUE_MAX_RETRIES', 3)
+        self.backlog_warning = getattr(config, 'SEND_QUEUE_BACKLOG_WARNING', 10)
+        self._global = _Bucket(self.global_rate, self.global_rate)
+        self._chats = {}
+        self._paused_until = {}  # чат -> момент (monotonic), до которого Telegram просил подождать
+        self._backlog = Counter()
+        self._edits = {}  # (endpoint, chat_id, message_id) -> правка, ожидающая слота
+        self.coalesced_count = 0
+        self.retry_after_count = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    def backlog(self):
+        """Чат -> число запросов, ожидающих отправки или выполняющихся."""
+        return {chat_id: count for chat_id, count in self._backlog.items() if count > 0}
+
+    def format_status(self):
+        """Текст состояния очереди для бота (HTML)."""
+        backlog = self.backlog()
+        lines = ["📤 <b>Очередь отправки</b>"]
+        if backlog:
+            for chat_id, count in sorted(backlog.items(), key=lambda item: -item[1]):
+                lines.append(f"   чат {chat_id}: {count} в очереди")
+        else:
+            lines.append("   очередь пуста")
+        lines.append(f"   склеено правок: {self.coalesced_count}, пауз RetryAfter: {self.retry_after_count}")
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _is_group_send(endpoint, chat_id):
+        """Лимит на чат действует только для отправки новых сообщений в группы и каналы."""
+        if chat_id is None or not endpoint.startswith('send'):
+            return False
+        return isinstance(chat_id, str) or chat_id < 0
+
+    def _chat_bucket(self, chat_id):
+        if len(self._chats) > 512:
+            # Не держим корзины давно молчащих чатов
+            for key, bucket in list(self._chats.items()):
+                if key != chat_id and bucket.idle():
+                    del self._chats[key]
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = _Bucket(self.group_rate, self.chat_burst)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+
+        edit_key = None
+        if endpoint in COALESCED_EDIT_ENDPOINTS:
+            message_key = data.get('inline_message_id') or data.get('message_id')
+            if message_key is not None:
+                edit_key = (endpoint, chat_id, message_key)
+
+        self._backlog[chat_id] += 1
+        if self.backlog_warning and self._backlog[chat_id] == self.backlog_warning:
+            logging.warning(f"⚠️ В очереди отправки для чата {chat_id} уже {self._backlog[chat_id]} запросов")
+        try:
+            if edit_key is None:
+                return await self._send(callback, args, kwargs, chat_id, rate_limit_args, endpoint)
+            return await self._send_edit(callback, args, kwargs, chat_id, rate_limit_args, edit_key)
+        finally:
+            self._backlog[chat_id] -= 1
+            if self._backlog[chat_id] <= 0:
+                del self._backlog[chat_id]
+
+    async def _send_edit(self, callback, args, kwargs, chat_id, rate_limit_args, edit_key):
+        pending = self._edits.get(edit_key)
+        if pending is not None:
+            # Правка этого сообщения уже ждет своего слота: она уйдет с новым содержимым
+            pending['args'], pending['kwargs'] = args, kwargs
+            self.coalesced_count += 1
+            return await asyncio.shield(pending['future'])
+
+        future = asyncio.get_running_loop().create_future()
+        # Ошибку получает сам вызывающий; будущее нужно только склеенным с ним правкам
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        entry = {'args': args, 'kwargs': kwargs, 'future': future}
+        self._edits[edit_key] = entry
+        try:
+            try:
+                await self._wait_for_slot(chat_id, edit_key[0])
+            finally:
+                # С этого момента новые правки встают в очередь заново
+                self._edits.pop(edit_key, None)
+            result = await self._call(callback, entry['args'], entry['kwargs'], chat_id, rate_limit_args)
+        except BaseException as e:
+            if isinstance(e, Exception):
+                future.set_exception(e)
+            else:
+                future.cancel()
+            raise
+        future.set_result(result)
+        return result
+
+    async def _send(self, callback, args, kwargs, chat_id, rate_limit_args, endpoint):
+        await self._wait_for_slot(chat_id, endpoint)
+        return await self._call(callback, args, kwargs, chat_id, rate_limit_args)
+
+    async def _wait_for_slot(self, chat_id, endpoint):
+        if chat_id is not None:
+            paused = self._paused_until.get(chat_id)
+            if paused is not None:
+                wait = paused - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                else:
+                    del self._paused_until[chat_id]
+            if self._is_group_send(endpoint, chat_id):
+                wait = self._chat_bucket(chat_id).reserve()
+                if wait:
+                    await asyncio.sleep(wait)
+        # Общий лимит бота - для всех запросов, в том числе без chat_id
+        wait = self._global.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    async def _call(self, callback, args, kwargs, chat_id, rate_limit_args):
+        max_retries = rate_limit_args if rate_limit_args is not None else self.max_retries
+        for attempt in range(max_retries + 1):
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self.retry_after_count += 1
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                if attempt == max_retries:
+                    logging.error(f"❌ Лимит Telegram для чата {chat_id}: исчерпано {max_retries} повторов")
+                    raise
+                logging.warning(f"⏳ Лимит Telegram для чата {chat_id}, пауза {retry_after} сек "
+                                f"(повтор {attempt + 1}/{max_retries})")
+                if chat_id is not None:
+                    self._paused_until[chat_id] = max(self._paused_until.get(chat_id, 0.0),
+                                                      time.monotonic() + retry_after)
+                else:
+                    self._global.pause(retry_after)
+                await asyncio.sleep(retry_after + 0.1)
+
+
+# Глобальный экземпляр очереди
+send_queue = None
+
+def get_send_queue() -> OutboundSendQueue:
+    """Получает глобальный экземпляр очереди исходящих запросов"""
+    global send_queue
+
+    if send_queue is None:
+        send_queue = OutboundSendQueue()
+
+    return send_queue
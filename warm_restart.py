@@ -0,0 +1,104 @@
+"""
+Теплый перезапуск: кеш данных таблицы сохраняется на диск и восстанавливается при старте.
+
+Вместе с кешем сохраняется версия таблицы (время последнего изменения по Drive
+API). Сохраняются только данные, загруженные после этого изменения, а при
+старте кеш восстанавливается, только если таблица с тех пор не менялась, -
+иначе первый запрос честно перечитает листы. Индекс занятий перестраивается из
+восстановленного календаря.
+
+Состояние диалогов и user_data сохраняет PicklePersistence (см. bot_main).
+"""
+import asyncio
+import logging
+import os
+import pickle
+import time
+from datetime import datetime
+
+import config
+
+# Запас на расхождение часов сервера и Google при сравнении времени загрузки с версией таблицы
+CLOCK_SKEW_SECONDS = 2
+
+
+def _revision_timestamp(revision):
+    """ISO-время изменения из Drive API ('2025-10-15T08:30:00.123Z') в unix time."""
+    return datetime.fromisoformat(revision.replace('Z', '+00:00')).timestamp()
+
+
+class WarmCacheStore:
+    """Файл с кешем данных таблицы для теплого перезапуска."""
+
+    def __init__(self, service, path=None):
+        self.service = service
+        self.path = path or getattr(config, 'WARM_CACHE_FILE', 'warm_cache.pickle')
+        self.restore_duration = getattr(config, 'WARM_CACHE_RESTORE_TTL', 120)
+
+    def save(self):
+        """Сохраняет кеш, актуальный для текущей версии таблицы. Возвращает число записей."""
+        try:
+            revision = self.service.get_revision()
+            entries = self.service.export_cache(
+                loaded_after=_revision_timestamp(revision) + CLOCK_SKEW_SECONDS
+            )
+            snapshot = {'revision': revision, 'saved_at': time.time(), 'entries': entries}
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            logging.info(f"💾 Кеш таблицы сохранен для теплого перезапуска: {', '.join(entries) or 'нет актуальных данных'}")
+            return len(entries)
+        except Exception as e:
+            logging.error(f"❌ Не удалось сохранить кеш таблицы {self.path}: {e}")
+            return 0
+
+    def restore(self):
+        """Восстанавливает кеш, если таблица не менялась с момента сохранения. Возвращает число записей."""
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return 0
+        except Exception as e:
+            logging.error(f"❌ Не удалось прочитать кеш таблицы {self.path}: {e}")
+            return 0
+
+        try:
+            revision = self.service.get_revision()
+        except Exception as e:
+            logging.warning(f"⚠️ Не удалось проверить версию таблицы, кеш не восстановлен: {e}")
+            return 0
+
+        if revision != snapshot.get('revision'):
+            logging.info(f"ℹ️ Таблица изменилась после сохранения кеша ({snapshot.get('revision')} → {revision}), "
+                         f"данные будут загружены заново")
+            return 0
+
+        restored = self.service.import_cache(snapshot['entries'], duration=self.restore_duration)
+        age = time.time() - snapshot.get('saved_at', time.time())
+        logging.info(f"♻️ Восстановлено {restored} записей кеша таблицы (сохранены {age:.0f} сек назад)")
+        return restored
+
+
+async def periodic_warm_cache_save(store):
+    """Периодически сохраняет кеш таблицы (на случай падения без штатной остановки)."""
+    interval = getattr(config, 'WARM_CACHE_SAVE_INTERVAL', 300)
+    if not interval or interval <= 0:
+        return
+    while True:
+        await asyncio.sleep(interval)
+        await asyncio.to_thread(store.save)
+
+
+# Глобальное хранилище
+warm_cache_store = None
+
+def get_warm_cache_store(service=None) -> WarmCacheStore:
+    """Получает глобальное хранилище кеша для теплого перезапуска"""
+    global warm_cache_store
+
+    if warm_cache_store is None and service is not None:
+        warm_cache_store = WarmCacheStore(service)
+
+    return warm_cache_store
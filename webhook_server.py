@@ -0,0 +1,133 @@
+"""
+Webhook-режим: один асинхронный HTTP-сервер (tornado) в цикле событий бота.
+
+- POST {WEBHOOK_PATH} - обновления Telegram, кладутся в update_queue приложения;
+- все остальные пути - дашборд (Flask-приложение dashboard_server), его
+  блокирующие обработчики выполняются в пуле потоков и не тормозят бота.
+
+Локальная проверка без Telegram: если WEBHOOK_URL не задан, webhook у Telegram
+не регистрируется, а обновления можно отправлять на сервер вручную
+(см. post_update.py). Если WEBHOOK_URL задан, а WEBHOOK_SECRET пуст, секрет
+генерируется при старте: без него любой мог бы слать боту поддельные обновления.
+"""
+import asyncio
+import json
+import logging
+import secrets
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Update
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as TornadoApplication, FallbackHandler, RequestHandler
+from tornado.wsgi import WSGIContainer
+
+import config
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class TelegramUpdateHandler(RequestHandler):
+    """Принимает обновления Telegram и передает их приложению бота."""
+
+    def initialize(self, bot_application, secret_token):
+        self.bot_application = bot_application
+        self.secret_token = secret_token
+
+    async def post(self):
+        if self.secret_token and self.request.headers.get(SECRET_HEADER) != self.secret_token:
+            logging.warning("⚠️ Webhook: запрос с неверным секретным токеном отклонен")
+            self.set_status(403)
+            return
+
+        try:
+            data = json.loads(self.request.body)
+            update = Update.de_json(data, self.bot_application.bot)
+        except Exception as e:
+            logging.warning(f"⚠️ Webhook: не удалось разобрать обновление: {e}")
+            self.set_status(400)
+            return
+
+        if update is None:
+            self.set_status(400)
+            return
+
+        await self.bot_application.update_queue.put(update)
+        self.set_status(200)
+
+
+def resolve_secret_token():
+    """Секрет webhook: WEBHOOK_SECRET или, при публичном WEBHOOK_URL без секрета, случайный на время запуска."""
+    secret_token = getattr(config, 'WEBHOOK_SECRET', '')
+    if not secret_token and getattr(config, 'WEBHOOK_URL', ''):
+        secret_token = secrets.token_urlsafe(32)
+        logging.warning("⚠️ WEBHOOK_SECRET не задан - для публичного webhook сгенерирован случайный секрет")
+    return secret_token
+
+
+def build_web_app(application, secret_token=None):
+    """Tornado-приложение: webhook Telegram + дашборд."""
+    if secret_token is None:
+        secret_token = getattr(config, 'WEBHOOK_SECRET', '')
+    handlers = [
+        (getattr(config, 'WEBHOOK_PATH', '/telegram'), TelegramUpdateHandler,
+         {'bot_application': application, 'secret_token': secret_token}),
+    ]
+    try:
+        from dashboard_server import app as dashboard_app
+        executor = ThreadPoolExecutor(max_workers=getattr(config, 'WEBHOOK_DASHBOARD_WORKERS', 4),
+                                      thread_name_prefix='dashboard')
+        dashboard = WSGIContainer(dashboard_app, executor=executor)
+        handlers.append((r'.*', FallbackHandler, {'fallback': dashboard}))
+    except Exception as e:
+        logging.error(f"❌ Дашборд не подключен к webhook-серверу: {e}")
+    return TornadoApplication(handlers)
+
+
+async def run_webhook_server(application):
+    """Запускает бота в webhook-режиме вместе с дашбордом и работает до сигнала остановки."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    path = getattr(config, 'WEBHOOK_PATH', '/telegram')
+    port = getattr(config, 'WEBHOOK_PORT', 5001)
+    listen = getattr(config, 'WEBHOOK_LISTEN', '0.0.0.0')
+    secret_token = resolve_secret_token()
+    server = HTTPServer(build_web_app(application, secret_token), xheaders=True)
+    server.listen(port, address=listen)
+    logging.info(f"🌐 Webhook-сервер слушает {listen}:{port}, обновления Telegram: POST {path}")
+
+    public_url = getattr(config, 'WEBHOOK_URL', '')
+    if public_url:
+        webhook_url = public_url.rstrip('/') + path
+        await application.bot.set_webhook(
+            url=webhook_url,
+            secret_token=secret_token,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=True
+        )
+        logging.info(f"✅ Webhook установлен: {webhook_url}")
+    else:
+        logging.info("ℹ️ WEBHOOK_URL не задан - webhook у Telegram не регистрируется (локальный режим)")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    try:
+        await stop_event.wait()
+    finally:
+        logging.info("⏹️ Остановка webhook-сервера...")
+        server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)